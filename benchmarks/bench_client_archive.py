@@ -0,0 +1,71 @@
+"""Бенчмарк переноса истории клиента в архив.
+История за три года переносится в архив с хранением последних
+HOT_DAYS дней. Сравниваются размер файла БД, открытие переписки и
+поиск до и после переноса, а также прокрутка и поиск в архиве.
+Запуск из корня проекта: python -m benchmarks.bench_client_archive"""
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from database.client_db import ClientDatabase
+
+MESSAGES = 300000
+CONTACTS = 10
+DAYS = 3 * 365
+HOT_DAYS = 90
+NOW = datetime(2023, 1, 1)
+QUERIES = 20
+WORDS = ['привет', 'как', 'дела', 'встреча', 'завтра', 'проект', 'отчёт',
+         'документ', 'согласовать', 'позвонить', 'сегодня', 'вечером']
+
+
+def fill(database):
+    """MESSAGES сообщений с CONTACTS собеседниками за DAYS дней"""
+    generator = random.Random(1)
+    start = NOW - timedelta(days=DAYS)
+    step = timedelta(days=DAYS) / MESSAGES
+    with database.database_engine.begin() as connection:
+        connection.execute(database.history_table.insert(), [
+            {'from_user': f'user{number % CONTACTS}',
+             'to_user': 'in' if number % 2 else 'out',
+             'message': ' '.join(generator.choices(WORDS, k=6)) +
+                        f' №{number}',
+             'date': start + step * number}
+            for number in range(MESSAGES)])
+
+
+def timed(function, *args, rounds=QUERIES, **kwargs):
+    """Миллисекунд на вызов"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(*args, **kwargs)
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def report(database, title):
+    print(f'{title}: файл {os.path.getsize("client_bench.db3") >> 20} МиБ, '
+          f'открытие переписки '
+          f'{timed(database.get_history_page, "user3"):.2f} мс, '
+          f'поиск "отчёт" {timed(database.search_messages, "отчёт"):.1f} мс')
+
+
+if __name__ == '__main__':
+    os.chdir(tempfile.mkdtemp())
+    database = ClientDatabase('bench', flush_interval=0)
+    fill(database)
+    report(database, f'{MESSAGES} сообщений за {DAYS} дней')
+
+    start = time.perf_counter()
+    moved = database.archive_history(HOT_DAYS, now=NOW)
+    print(f'В архив перенесено {moved} сообщений за '
+          f'{time.perf_counter() - start:.1f} с')
+    report(database, f'Хранятся последние {HOT_DAYS} дней')
+
+    old = NOW - timedelta(days=2 * 365)
+    print(f'Страница архива двухлетней давности: '
+          f'{timed(database.get_history_page, "user3", old):.2f} мс')
+    print(f'Поиск в архиве редкого сообщения: '
+          f'{timed(database.search_archive, "№1000", rounds=3):.0f} мс')
+    database.close()
@@ -0,0 +1,117 @@
+"""Бенчмарк истории сообщений клиента на миллионе сообщений.
+Сравнивает открытие переписки (последняя страница) и прокрутку к
+середине истории ClientDatabase.get_history_page с индексом
+ix_message_history_contact и без него, а также чтение всей истории
+собеседника get_history и поиск search_messages по полнотекстовому
+индексу в сравнении с просмотром таблицы через LIKE.
+Запуск из корня проекта: python -m benchmarks.bench_client_history"""
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from database.client_db import ClientDatabase
+
+MESSAGES = 1000000
+CONTACTS = 10
+QUERIES = 100
+INDEX = 'ix_message_history_contact'
+# Словарь сообщений из случайных слов: частота слова убывает с его
+# номером, первые слова встречаются в большей части сообщений
+LETTERS = 'абвгдежзийклмнопрстуфхцчшщыэюя'
+WORDS = list(dict.fromkeys(
+    ''.join(random.Random(number).choices(LETTERS, k=3 + number % 6))
+    for number in range(50000)))
+
+
+def text(generator):
+    """Сообщение из 3-12 слов словаря"""
+    return ' '.join(WORDS[min(int(generator.paretovariate(0.7)),
+                              len(WORDS)) - 1]
+                    for _ in range(generator.randint(3, 12)))
+
+
+def fill(database):
+    """MESSAGES сообщений с CONTACTS собеседниками, раз в секунду"""
+    generator = random.Random(1)
+    start = datetime(2020, 1, 1)
+    with database.database_engine.begin() as connection:
+        connection.execute(database.history_table.insert(), [
+            {'from_user': f'user{number % CONTACTS}',
+             'to_user': 'in' if number % 2 else 'out',
+             'message': text(generator),
+             'date': start + timedelta(seconds=number)}
+            for number in range(MESSAGES)])
+
+
+def bench_pages(database):
+    """Миллисекунд на страницу: последняя страница и страница из
+    середины истории собеседника"""
+    contact = 'user3'
+    middle = datetime(2020, 1, 1) + timedelta(seconds=MESSAGES // 2)
+    start = time.perf_counter()
+    for _ in range(QUERIES):
+        database.get_history_page(contact)
+    last_page = (time.perf_counter() - start) / QUERIES * 1000
+    start = time.perf_counter()
+    for _ in range(QUERIES):
+        database.get_history_page(contact, middle, MESSAGES)
+    middle_page = (time.perf_counter() - start) / QUERIES * 1000
+    return last_page, middle_page
+
+
+def bench_search(database, phrase, contact=None, rounds=10):
+    """Миллисекунд на поиск и число найденных сообщений"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        found = database.search_messages(phrase, contact)
+    return (time.perf_counter() - start) / rounds * 1000, len(found)
+
+
+def bench_like(database, phrase, rounds=3):
+    """Миллисекунд на поиск просмотром таблицы"""
+    history = database.history_table.c
+    query = select(history.id).where(
+        history.message.like(f'%{phrase}%')).limit(100)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        database.session.execute(query).all()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+if __name__ == '__main__':
+    os.chdir(tempfile.mkdtemp())
+    database = ClientDatabase('bench')
+    start = time.perf_counter()
+    fill(database)
+    print(f'{MESSAGES} сообщений записаны за '
+          f'{time.perf_counter() - start:.1f} с')
+
+    last_page, middle_page = bench_pages(database)
+    print(f'С индексом: открытие переписки {last_page:.2f} мс, '
+          f'страница из середины {middle_page:.2f} мс')
+    start = time.perf_counter()
+    history = database.get_history('user3')
+    print(f'Вся история собеседника ({len(history)} сообщений): '
+          f'{(time.perf_counter() - start) * 1000:.0f} мс')
+
+    for phrase, contact in ((WORDS[4000], None), (WORDS[40], None),
+                            (WORDS[0], None), (f'{WORDS[0]} {WORDS[1]}', None),
+                            (WORDS[0], 'user3')):
+        elapsed, found = bench_search(database, phrase, contact)
+        print(f'Поиск "{phrase}"{" у " + contact if contact else ""} '
+              f'({found} результатов): {elapsed:.1f} мс, '
+              f'LIKE без ранжирования: {bench_like(database, phrase):.0f} мс')
+    start = time.perf_counter()
+    database.rebuild_search_index()
+    print(f'Перестроение индекса поиска: '
+          f'{time.perf_counter() - start:.1f} с')
+
+    with database.database_engine.begin() as connection:
+        connection.exec_driver_sql(f'DROP INDEX {INDEX}')
+    last_page, middle_page = bench_pages(database)
+    print(f'Без индекса: открытие переписки {last_page:.2f} мс, '
+          f'страница из середины {middle_page:.2f} мс')
@@ -0,0 +1,71 @@
+"""Бенчмарк записи в БД клиента.
+Сравнивает сохранение пачки входящих сообщений с фиксацией транзакции
+на каждое сообщение и через буфер истории database.history_buffer,
+а также обновление списка контактов с сервера прежним способом
+(очистка таблицы и add_contact для каждого контакта) и
+ClientDatabase.replace_contacts.
+Запуск из корня проекта: python -m benchmarks.bench_client_writes"""
+import os
+import tempfile
+import time
+
+from common.variables import HISTORY_FLUSH_INTERVAL, HISTORY_FLUSH_SIZE
+from database.client_db import ClientDatabase
+from database.history_buffer import HistoryBuffer
+
+MESSAGES = 5000
+CONTACTS = 5000
+
+
+def bench_messages(database):
+    """Микросекунд на сообщение, включая запись последнего в БД"""
+    start = time.perf_counter()
+    for number in range(MESSAGES):
+        database.save_message(f'user{number % 10}', 'in',
+                              f'Сообщение номер {number}')
+    database.flush()
+    return (time.perf_counter() - start) / MESSAGES * 1000000
+
+
+def sync_contacts_by_one(database, contacts):
+    database.contacts_clear()
+    for contact in contacts:
+        database.add_contact(contact)
+
+
+def bench_contacts(sync, database):
+    """Миллисекунд на полную синхронизацию и на синхронизацию с
+    изменением одного контакта"""
+    contacts = [f'contact{number}' for number in range(CONTACTS)]
+    start = time.perf_counter()
+    sync(database, contacts)
+    full = (time.perf_counter() - start) * 1000
+    contacts[0] = 'new_contact'
+    start = time.perf_counter()
+    sync(database, contacts)
+    changed = (time.perf_counter() - start) * 1000
+    database.contacts_clear()
+    return full, changed
+
+
+if __name__ == '__main__':
+    os.chdir(tempfile.mkdtemp())
+    # Буфер подключается после замера записи без него:
+    # ClientDatabase можно создать один раз за процесс
+    database = ClientDatabase('bench', flush_interval=0)
+    print(f'{MESSAGES} входящих сообщений:')
+    print(f'  транзакция на сообщение: {bench_messages(database):.0f} мкс '
+          f'на сообщение')
+    database.history_buffer = HistoryBuffer(
+        database.database_engine, database.history_table,
+        HISTORY_FLUSH_INTERVAL, HISTORY_FLUSH_SIZE)
+    print(f'  буфер истории: {bench_messages(database):.0f} мкс '
+          f'на сообщение')
+    database.close()
+
+    print(f'Синхронизация {CONTACTS} контактов (полная / изменился один):')
+    full, changed = bench_contacts(sync_contacts_by_one, database)
+    print(f'  очистка и add_contact: {full:.0f} мс / {changed:.0f} мс')
+    full, changed = bench_contacts(ClientDatabase.replace_contacts,
+                                   database)
+    print(f'  replace_contacts: {full:.0f} мс / {changed:.0f} мс')
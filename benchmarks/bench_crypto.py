@@ -0,0 +1,55 @@
+"""Бенчмарк шифрования сообщений клиента.
+Сравнивает шифрование каждого сообщения ключом RSA получателя
+(PKCS1_OAEP, как было в ClientWindow) с гибридной схемой client.crypto:
+RSA один раз на сеанс, AES-GCM для текста.
+Запуск из корня проекта: python -m benchmarks.bench_crypto"""
+import base64
+import time
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+
+from client.crypto import MessageCipher
+
+MESSAGES = 200
+# Больше не помещается в одно сообщение RSA-2048 с OAEP
+SHORT_TEXT = 'Привет! ' * 10
+LONG_TEXT = 'x' * 64 * 1024
+
+
+def bench_rsa(sender_keys, recipient_keys, text):
+    """Сообщений в секунду: шифрование и расшифровка RSA-OAEP"""
+    encryptor = PKCS1_OAEP.new(recipient_keys.publickey())
+    decrypter = PKCS1_OAEP.new(recipient_keys)
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        encrypted = base64.b64encode(encryptor.encrypt(text.encode('utf-8')))
+        decrypter.decrypt(base64.b64decode(encrypted)).decode('utf-8')
+    return MESSAGES / (time.perf_counter() - start)
+
+
+def bench_hybrid(sender_keys, recipient_keys, text, messages=MESSAGES):
+    """Сообщений в секунду: гибридная схема, включая установку сеанса"""
+    sender = MessageCipher(sender_keys, 'alice')
+    recipient = MessageCipher(recipient_keys, 'bob')
+    pubkey = recipient_keys.publickey().export_key().decode('ascii')
+    start = time.perf_counter()
+    for _ in range(messages):
+        recipient.decrypt('alice', sender.encrypt('bob', pubkey, text))
+    return messages / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    alice_keys = RSA.generate(2048)
+    bob_keys = RSA.generate(2048)
+    print(f'Сообщение {len(SHORT_TEXT.encode("utf-8"))} байт, '
+          f'{MESSAGES} сообщений:')
+    print(f'  RSA-OAEP: {bench_rsa(alice_keys, bob_keys, SHORT_TEXT):.0f} '
+          f'сообщений/с')
+    print(f'  RSA + AES-GCM: '
+          f'{bench_hybrid(alice_keys, bob_keys, SHORT_TEXT, 20000):.0f} '
+          f'сообщений/с')
+    rate = bench_hybrid(alice_keys, bob_keys, LONG_TEXT)
+    print(f'Сообщение 64 КиБ (для RSA-OAEP невозможно): '
+          f'{rate:.0f} сообщений/с, {rate * len(LONG_TEXT) / 2 ** 20:.0f} '
+          f'МиБ/с')
@@ -0,0 +1,81 @@
+"""Микробенчмарк стоимости декоратора decos.log в пути отправки
+сообщения. Сравнивает send_message без декоратора, с прежним
+декоратором (f-строка с repr всех аргументов на каждый вызов) и с
+текущим, записывающим каждый вызов или, как send_message по умолчанию,
+каждый LOG_MESSAGE_SAMPLE-й, при отключённом и включённом уровне DEBUG.
+Записи лога форматируются и отбрасываются, сокет ничего не отправляет,
+поэтому замеряются только кодирование сообщения и логирование.
+Запуск из корня проекта: python -m benchmarks.bench_log"""
+import logging
+import time
+import timeit
+
+from common.variables import ACTION, MESSAGE, SENDER, DESTINATION, TIME, \
+    MESSAGE_TEXT, LOG_MESSAGE_SAMPLE
+from common import utils
+from decos import LOGGER, log
+
+NUMBER = 100000
+REPEAT = 5
+MESSAGE_DICT = {ACTION: MESSAGE, SENDER: 'alice', DESTINATION: 'bob',
+                TIME: time.time(), MESSAGE_TEXT: 'x' * 300}
+
+
+class NullSocket:
+    """Сокет, отбрасывающий данные"""
+
+    def sendall(self, data):
+        pass
+
+
+class NullStream:
+    """Поток лога, отбрасывающий записи. Буфер в памяти рос бы от замера
+    к замеру и замедлял каждый следующий"""
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def old_log(func_to_log):
+    """Декоратор в том виде, в каком он был в decos"""
+    def log_saver(*args, **kwargs):
+        LOGGER.debug(
+            f'Была вызвана функция {func_to_log.__name__} c параметрами '
+            f'{args} , {kwargs}. Вызов из модуля {func_to_log.__module__}')
+        ret = func_to_log(*args, **kwargs)
+        return ret
+
+    return log_saver
+
+
+def bench(function):
+    """Микросекунд на вызов, лучшее из REPEAT повторов"""
+    sock = NullSocket()
+    return min(timeit.repeat(lambda: function(sock, MESSAGE_DICT),
+                             number=NUMBER, repeat=REPEAT)) / NUMBER * 1000000
+
+
+if __name__ == '__main__':
+    bare = utils.send_message.__wrapped__
+    old = old_log(bare)
+    every_call = log(bare)
+    sampled = utils.send_message
+    # Записи лога форматируются, но не пишутся в файл
+    handlers = LOGGER.handlers[:]
+    for handler in handlers:
+        LOGGER.removeHandler(handler)
+    LOGGER.addHandler(logging.StreamHandler(NullStream()))
+
+    base = bench(bare)
+    print(f'Без декоратора: {base:.2f} мкс')
+    for level, title in ((logging.INFO, 'DEBUG отключён'),
+                         (logging.DEBUG, 'DEBUG включён')):
+        LOGGER.setLevel(level)
+        print(f'{title}:')
+        print(f'  прежний декоратор: +{bench(old) - base:.2f} мкс')
+        print(f'  decos.log: +{bench(every_call) - base:.2f} мкс')
+        print(f'  decos.log(sample={LOG_MESSAGE_SAMPLE}): '
+              f'+{bench(sampled) - base:.2f} мкс')
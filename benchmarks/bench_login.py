@@ -0,0 +1,83 @@
+"""Бенчмарк входа клиентов на сервер.
+Сравнивает стоимость входа, когда хэш пароля вычисляется при каждом
+подключении (как было в ClientTransport), и с хэшем, вычисленным один
+раз на сеанс common.credentials.Credentials: для одного клиента и для
+многих ботов в одном процессе, переподключающихся к серверу.
+Запуск из корня проекта: python -m benchmarks.bench_login"""
+import binascii
+import hmac
+import os
+import socket
+import tempfile
+import time
+
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, \
+    PUBLIC_KEY, RESPONSE, DATA, KDF_ITERATIONS, PASSWORD_ITERATIONS
+from common.utils import get_message, send_message
+from common.credentials import Credentials, password_hash
+from database.server_db import ServerStorage
+from server.core import MessageProcessor
+
+CLIENTS = 20
+RECONNECTS = 5
+PORT = 17777
+
+
+def bench_derive(iterations, rounds=20):
+    """Миллисекунд на одно вычисление хэша пароля"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        password_hash('user', 'password', iterations)
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def login(name, passwd_hash):
+    """Вход на сервер, passwd_hash(iterations) - хэш пароля"""
+    sock = socket.create_connection(('127.0.0.1', PORT))
+    send_message(sock, {ACTION: PRESENCE, TIME: time.time(),
+                        USER: {ACCOUNT_NAME: name, PUBLIC_KEY: 'key'}})
+    ans = get_message(sock)
+    digest = hmac.new(passwd_hash(ans[KDF_ITERATIONS]),
+                      ans[DATA].encode('utf-8'), 'MD5').digest()
+    send_message(sock, {RESPONSE: 511,
+                        DATA: binascii.b2a_base64(digest).decode('ascii')})
+    assert get_message(sock)[RESPONSE] == 200
+    sock.close()
+
+
+def bench_logins(names, cached):
+    """Миллисекунд на вход: CLIENTS ботов, каждый входит RECONNECTS раз"""
+    credentials = {name: Credentials(name, 'password') for name in names}
+    start = time.perf_counter()
+    for _ in range(RECONNECTS):
+        for name in names:
+            if cached:
+                login(name, credentials[name].passwd_hash)
+            else:
+                login(name, lambda iterations: password_hash(
+                    name, 'password', iterations))
+            # Сервер обрабатывает отключение асинхронно
+            while server.is_online(name):
+                time.sleep(0.001)
+    return (time.perf_counter() - start) / RECONNECTS / len(names) * 1000
+
+
+if __name__ == '__main__':
+    for iterations in (PASSWORD_ITERATIONS, 10 * PASSWORD_ITERATIONS):
+        print(f'PBKDF2-SHA512, {iterations} итераций: '
+              f'{bench_derive(iterations):.2f} мс')
+
+    database = ServerStorage(os.path.join(tempfile.mkdtemp(), 'bench.db3'))
+    names = [f'bot{number}' for number in range(CLIENTS)]
+    database.add_users([(name, password_hash(name, 'password'))
+                        for name in names])
+    server = MessageProcessor('127.0.0.1', PORT, database)
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+    print(f'{CLIENTS} ботов, {RECONNECTS} входов каждого:')
+    print(f'  хэш при каждом входе: {bench_logins(names, False):.2f} мс '
+          f'на вход')
+    print(f'  хэш один раз на сеанс: {bench_logins(names, True):.2f} мс '
+          f'на вход')
+    server.stop()
@@ -0,0 +1,50 @@
+"""Микробенчмарк стоимости кодирования одного ответа сервера.
+Сравнивает старую схему (правка общего словаря RESPONSE_* и json.dumps
+на каждый ответ) с неизменяемыми шаблонами common.responses.
+Запуск из корня проекта: python -m benchmarks.bench_responses"""
+import json
+import timeit
+
+from common.variables import RESPONSE, ERROR, ENCODING
+from common.utils import FRAME_HEADER
+from common.responses import FRAME_200, frame_400
+
+NUMBER = 200000
+
+# Изменяемые словари в том виде, в каком они были в common.variables
+OLD_RESPONSE_200 = {RESPONSE: 200}
+OLD_RESPONSE_400 = {RESPONSE: 400, ERROR: None}
+
+
+def old_reply_200():
+    payload = json.dumps(OLD_RESPONSE_200).encode(ENCODING)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def old_reply_400():
+    response = OLD_RESPONSE_400
+    response[ERROR] = 'Пользователь не в сети'
+    payload = json.dumps(response).encode(ENCODING)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def new_reply_200():
+    return FRAME_200
+
+
+def new_reply_400():
+    return frame_400('Пользователь не в сети')
+
+
+def measure(func):
+    """Среднее время одного вызова в микросекундах"""
+    return min(timeit.repeat(func, number=NUMBER, repeat=3)) / NUMBER * 1e6
+
+
+if __name__ == '__main__':
+    for name, old, new in (('200', old_reply_200, new_reply_200),
+                           ('400', old_reply_400, new_reply_400)):
+        old_time = measure(old)
+        new_time = measure(new)
+        print(f'Ответ {name}: было {old_time:.3f} мкс, '
+              f'стало {new_time:.3f} мкс, ускорение {old_time / new_time:.1f}x')
@@ -0,0 +1,122 @@
+"""Бенчмарк БД сервера на 100 тысячах пользователей.
+Сравнивает типовые запросы с индексами и без них, а также скорость
+записи с настройками database.sqlite_setup и с настройками SQLite по
+умолчанию (журнал отката, synchronous=FULL).
+Запуск из корня проекта: python -m benchmarks.bench_server_db"""
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+from database.server_db import ServerStorage
+from database.sqlite_setup import create_sqlite_engine, SQLITE_PRAGMAS
+
+USERS = 100000
+CONTACTS = 5
+QUERIES = 200
+COMMITS = 300
+
+
+def fill(database):
+    """Заполнение БД через Core-вставку пачками"""
+    now = datetime.now()
+    rnd = random.Random(1)
+    with database.engine.begin() as connection:
+        connection.execute(
+            database.AllUsers.__table__.insert(),
+            [{'id': number, 'login': f'user{number}', 'passwd_hash': 'h',
+              'last_connect': now} for number in range(1, USERS + 1)])
+        connection.execute(
+            database.UsersHistory.__table__.insert(),
+            [{'user': number, 'sent': 0, 'accepted': 0}
+             for number in range(1, USERS + 1)])
+        connection.execute(
+            database.UsersContacts.__table__.insert(),
+            [{'user': number, 'contact': rnd.randint(1, USERS)}
+             for number in range(1, USERS + 1) for _ in range(CONTACTS)])
+        connection.execute(
+            database.LoginHistory.__table__.insert(),
+            [{'user': number, 'ip': '127.0.0.1', 'port': 7777,
+              'last_connection': now} for number in range(1, USERS + 1)])
+
+
+def bench_queries(database):
+    """Среднее время запросов в микросекундах"""
+    contacts = database.UsersContacts.__table__
+    history = database.UsersHistory.__table__
+    ids = [random.randint(1, USERS) for _ in range(QUERIES)]
+    results = {}
+    with database.engine.connect() as connection:
+        start = time.perf_counter()
+        for user_id in ids:
+            connection.execute(contacts.select().where(
+                contacts.c.user == user_id)).fetchall()
+        results['контакты пользователя'] = start
+        start = time.perf_counter()
+        for user_id in ids:
+            connection.execute(contacts.select().where(
+                contacts.c.contact == user_id)).fetchall()
+        results['у кого пользователь в контактах'] = start
+        start = time.perf_counter()
+        for user_id in ids:
+            connection.execute(history.update().where(
+                history.c.user == user_id).values(sent=history.c.sent + 1))
+        results['счётчик сообщений'] = start
+    # Время каждого запроса - от его начала до начала следующего
+    marks = list(results.values()) + [time.perf_counter()]
+    return {name: (marks[i + 1] - marks[i]) / QUERIES * 1e6
+            for i, name in enumerate(results)}
+
+
+def drop_indexes(database):
+    with database.engine.begin() as connection:
+        for table in database.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.exec_driver_sql(f'DROP INDEX {index.name}')
+
+
+def bench_commits(path, pragmas):
+    """Среднее время транзакции из одной вставки в микросекундах"""
+    engine = create_sqlite_engine(path, pragmas)
+    table = ServerStorage.LoginHistory.__table__
+    table.metadata.create_all(engine)
+    start = time.perf_counter()
+    for number in range(COMMITS):
+        with engine.begin() as connection:
+            connection.execute(table.insert(), {
+                'user': number, 'ip': '127.0.0.1', 'port': 7777,
+                'last_connection': datetime.now()})
+    result = (time.perf_counter() - start) / COMMITS * 1e6
+    engine.dispose()
+    return result
+
+
+def report(title, timings):
+    print(title)
+    for name, value in timings.items():
+        print(f'  {name}: {value:.1f} мкс')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        database = ServerStorage(os.path.join(directory, 'bench.db3'))
+        start = time.perf_counter()
+        fill(database)
+        print(f'Пользователей: {USERS}, контактов: {USERS * CONTACTS}, '
+              f'заполнение {time.perf_counter() - start:.1f} с')
+        start = time.perf_counter()
+        database.load_users()
+        print(f'Загрузка справочника пользователей: '
+              f'{time.perf_counter() - start:.2f} с')
+        report('С индексами:', bench_queries(database))
+        drop_indexes(database)
+        report('Без индексов:', bench_queries(database))
+        database.session.close()
+        database.engine.dispose()
+
+        print('Транзакция из одной вставки:')
+        print(f'  WAL, synchronous=NORMAL: '
+              f'{bench_commits(os.path.join(directory, "wal.db3"), SQLITE_PRAGMAS):.0f} мкс')
+        print(f'  настройки по умолчанию: '
+              f'{bench_commits(os.path.join(directory, "default.db3"), ()):.0f} мкс')
@@ -0,0 +1,99 @@
+"""Бенчмарк диспетчеризации сообщений при большом числе сессий.
+Сравнивает линейный поиск по словарю имён (как было в login_required и
+remove_client) с реестром сессий server.sessions.
+Запуск из корня проекта: python -m benchmarks.bench_sessions"""
+import contextlib
+import io
+import logging
+import time
+
+from common.variables import ACTION, MESSAGE, SENDER, DESTINATION, TIME, \
+    MESSAGE_TEXT
+from server.core import MessageProcessor
+
+SESSIONS = 10000
+MESSAGES = 20000
+
+
+class FakeSocket:
+    """Сокет-заглушка, отбрасывающий отправленные данные"""
+
+    def sendall(self, data):
+        pass
+
+    def getpeername(self):
+        return '127.0.0.1', 0
+
+
+class FakeDatabase:
+    """БД-заглушка, чтобы измерять только диспетчеризацию"""
+
+    def process_message(self, sender, recipient):
+        pass
+
+    def user_logout(self, name):
+        pass
+
+
+def legacy_login_check(names, sock):
+    """Проверка авторизации в том виде, в каком она была в login_required"""
+    found = False
+    for client in names:
+        if names[client] == sock:
+            found = True
+    return found
+
+
+def make_server():
+    server = MessageProcessor('127.0.0.1', 7777, FakeDatabase())
+    socks = [FakeSocket() for _ in range(SESSIONS)]
+    for number, sock in enumerate(socks):
+        server.sessions.add(f'user{number}', sock)
+        server.clients.add(sock)
+    server.listen_sockets = set(socks)
+    return server, socks
+
+
+def bench_dispatch(server, socks):
+    """Среднее время обработки одного сообщения в микросекундах"""
+    messages = [({ACTION: MESSAGE, SENDER: f'user{i % SESSIONS}',
+                  DESTINATION: f'user{(i + 1) % SESSIONS}', TIME: 1.0,
+                  MESSAGE_TEXT: 'test'}, socks[i % SESSIONS])
+                for i in range(MESSAGES)]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for message, sock in messages:
+            server.process_client_message(message, sock)
+    return (time.perf_counter() - start) / MESSAGES * 1e6
+
+
+def bench_legacy_check(socks):
+    """Среднее время старой проверки авторизации в микросекундах"""
+    names = {f'user{number}': sock for number, sock in enumerate(socks)}
+    probes = socks[::SESSIONS // 100]
+    start = time.perf_counter()
+    for sock in probes:
+        legacy_login_check(names, sock)
+    return (time.perf_counter() - start) / len(probes) * 1e6
+
+
+def bench_remove(server, socks):
+    """Среднее время отключения клиента в микросекундах"""
+    start = time.perf_counter()
+    for sock in socks:
+        server.sessions.remove(sock)
+        server.clients.discard(sock)
+    return (time.perf_counter() - start) / len(socks) * 1e6
+
+
+if __name__ == '__main__':
+    # Отладочное логирование не должно попадать в замер
+    logging.getLogger('server').setLevel(logging.WARNING)
+    logging.getLogger('client').setLevel(logging.WARNING)
+    server, socks = make_server()
+    print(f'Сессий: {SESSIONS}')
+    print(f'Старая проверка авторизации (линейный поиск): '
+          f'{bench_legacy_check(socks):.1f} мкс на сообщение')
+    print(f'Диспетчеризация сообщения с реестром сессий: '
+          f'{bench_dispatch(server, socks):.1f} мкс на сообщение')
+    print(f'Отключение клиента: {bench_remove(server, socks):.2f} мкс')
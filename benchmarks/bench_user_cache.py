@@ -0,0 +1,55 @@
+"""Бенчмарк поиска пользователей в ServerStorage.
+Сравнивает запрос к таблице all_users по логину (как было в get_hash,
+get_pubkey, check_user и других методах) со справочником пользователей
+в памяти.
+Запуск из корня проекта: python -m benchmarks.bench_user_cache"""
+import os
+import tempfile
+import time
+
+from database.server_db import ServerStorage
+
+USERS = 5000
+LOOKUPS = 5000
+
+
+def make_storage(directory):
+    os.chdir(directory)
+    database = ServerStorage(os.path.join(directory, 'bench.db3'))
+    database.session.add_all(database.AllUsers(f'user{number}', 'hash')
+                             for number in range(USERS))
+    database.session.commit()
+    database.load_users()
+    return database
+
+
+def legacy_get_pubkey(database, name):
+    """Получение ключа в том виде, в каком оно было до справочника"""
+    user = database.session.query(database.AllUsers).\
+        filter_by(login=name).first()
+    return user.pubkey
+
+
+def bench(func, database):
+    """Среднее время одного поиска в микросекундах"""
+    names = [f'user{number * 7 % USERS}' for number in range(LOOKUPS)]
+    start = time.perf_counter()
+    for name in names:
+        func(database, name)
+    return (time.perf_counter() - start) / LOOKUPS * 1e6
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        database = make_storage(directory)
+        print(f'Пользователей: {USERS}')
+        print(f'Запрос к БД по логину: '
+              f'{bench(legacy_get_pubkey, database):.1f} мкс')
+        print(f'Справочник, get_pubkey: '
+              f'{bench(ServerStorage.get_pubkey, database):.2f} мкс')
+        print(f'Справочник, check_user: '
+              f'{bench(ServerStorage.check_user, database):.2f} мкс')
+        database.session.close()
+        database.engine.dispose()
+        os.chdir(cwd)
@@ -0,0 +1,122 @@
+"""Шифрование сообщений между клиентами"""
+import base64
+import os
+import time
+from collections import OrderedDict
+
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+
+# Признак сообщения, зашифрованного сеансовым ключом. Сообщения без него
+# зашифрованы ключом RSA получателя целиком, как в прежних версиях
+ENVELOPE_PREFIX = 'h1'
+# Смена сеансового ключа: после числа сообщений или времени, секунд
+SESSION_KEY_MESSAGES = 1000
+SESSION_KEY_LIFETIME = 3600
+# Сколько ключей собеседников держать расшифрованными
+KEY_CACHE_SIZE = 256
+
+KEY_SIZE = 32
+NONCE_SIZE = 12
+KEY_ID_SIZE = 8
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+class OutgoingSession:
+    """Сеансовый ключ для сообщений одному собеседнику"""
+
+    def __init__(self, pubkey, encryptor):
+        self.pubkey = pubkey
+        self.key = os.urandom(KEY_SIZE)
+        self.key_id = os.urandom(KEY_ID_SIZE).hex()
+        # Сеансовый ключ, зашифрованный ключом RSA собеседника,
+        # передаётся с каждым сообщением: получатель расшифрует его один
+        # раз, даже если часть сообщений сеанса до него не дошла
+        self.wrapped = b64encode(encryptor.encrypt(self.key))
+        self.created = time.monotonic()
+        self.messages = 0
+
+    def expired(self, pubkey):
+        return pubkey != self.pubkey or \
+            self.messages >= SESSION_KEY_MESSAGES or \
+            time.monotonic() - self.created >= SESSION_KEY_LIFETIME
+
+
+class MessageCipher:
+    """
+    Гибридное шифрование: текст шифруется AES-GCM сеансовым ключом,
+    сам ключ - RSA-OAEP ключом получателя. Дорогие операции RSA
+    выполняются один раз на сеанс, а не на каждое сообщение, и длина
+    сообщения не ограничена размером ключа RSA.
+    Сообщение: h1.<id ключа>.<ключ RSA>.<nonce>.<шифротекст и тег>
+    """
+
+    def __init__(self, keys, username):
+        self.username = username
+        self.decrypter = PKCS1_OAEP.new(keys)
+        # Исходящие сеансы по собеседникам
+        self.sessions = {}
+        # Шифраторы RSA по открытому ключу: разбор ключа тоже недёшев
+        self.encryptors = {}
+        # Расшифрованные входящие сеансовые ключи по (отправитель, id)
+        self.incoming = OrderedDict()
+
+    def encryptor(self, pubkey):
+        encryptor = self.encryptors.get(pubkey)
+        if encryptor is None:
+            encryptor = self.encryptors[pubkey] = PKCS1_OAEP.new(
+                RSA.import_key(pubkey))
+        return encryptor
+
+    def session(self, contact, pubkey):
+        session = self.sessions.get(contact)
+        if session is None or session.expired(pubkey):
+            session = self.sessions[contact] = OutgoingSession(
+                pubkey, self.encryptor(pubkey))
+        return session
+
+    def encrypt(self, contact, pubkey, text):
+        """Шифрование текста для собеседника с открытым ключом pubkey"""
+        session = self.session(contact, pubkey)
+        session.messages += 1
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = AES.new(session.key, AES.MODE_GCM, nonce=nonce)
+        # Отправитель и получатель защищены тегом вместе с текстом
+        cipher.update(f'{self.username}>{contact}'.encode('utf-8'))
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode('utf-8'))
+        return '.'.join((ENVELOPE_PREFIX, session.key_id, session.wrapped,
+                         b64encode(nonce), b64encode(ciphertext + tag)))
+
+    def session_key(self, sender, key_id, wrapped):
+        # Ключ кэшируется вместе с отправителем, чтобы чужое сообщение
+        # с тем же id не подменило ключ собеседника
+        cache_key = (sender, key_id)
+        key = self.incoming.get(cache_key)
+        if key is None:
+            key = self.decrypter.decrypt(base64.b64decode(wrapped))
+            self.incoming[cache_key] = key
+            if len(self.incoming) > KEY_CACHE_SIZE:
+                self.incoming.popitem(last=False)
+        else:
+            self.incoming.move_to_end(cache_key)
+        return key
+
+    def decrypt(self, sender, message):
+        """Расшифровка сообщения от sender, ValueError при ошибке"""
+        parts = message.split('.')
+        if parts[0] != ENVELOPE_PREFIX:
+            # Сообщение прежнего формата: RSA-OAEP целиком
+            return self.decrypter.decrypt(
+                base64.b64decode(message)).decode('utf-8')
+        if len(parts) != 5:
+            raise ValueError('Некорректный формат сообщения')
+        _, key_id, wrapped, nonce, data = parts
+        key = self.session_key(sender, key_id, wrapped)
+        data = base64.b64decode(data)
+        cipher = AES.new(key, AES.MODE_GCM, nonce=base64.b64decode(nonce))
+        cipher.update(f'{sender}>{self.username}'.encode('utf-8'))
+        text = cipher.decrypt_and_verify(data[:-16], data[-16:])
+        return text.decode('utf-8')
@@ -0,0 +1,88 @@
+"""Модель истории переписки с собеседником для окна клиента"""
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+from PyQt5.QtGui import QBrush, QColor
+
+from common.variables import HISTORY_PAGE_SIZE
+
+# Оформление входящих и исходящих сообщений
+INCOMING = 'in'
+BACKGROUND = {INCOMING: QBrush(QColor(255, 213, 213)),
+              'out': QBrush(QColor(204, 255, 204))}
+ALIGNMENT = {INCOMING: Qt.AlignLeft, 'out': Qt.AlignRight}
+
+
+class HistoryModel(QAbstractListModel):
+    """
+    История переписки с собеседником: записи (id, направление, текст,
+    дата) по возрастанию даты. При создании загружается последняя
+    страница, более ранние - по fetch_older, когда пользователь
+    прокручивает историю вверх. Новое сообщение добавляется в конец
+    без перечитывания истории
+    """
+
+    def __init__(self, database, contact, page_size=HISTORY_PAGE_SIZE):
+        super().__init__()
+        self.database = database
+        self.contact = contact
+        self.page_size = page_size
+        self.rows = []
+        self.exhausted = False
+        self.load_page()
+
+    def load_page(self):
+        """Загрузка страницы сообщений старше загруженных,
+        возвращает число загруженных"""
+        before_date, before_id = (self.rows[0][3], self.rows[0][0]) \
+            if self.rows else (None, None)
+        page = self.database.get_history_page(
+            self.contact, before_date, before_id, self.page_size)
+        if len(page) < self.page_size:
+            self.exhausted = True
+        if page:
+            self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+            # Страница приходит от новых к старым
+            self.rows[:0] = reversed(page)
+            self.endInsertRows()
+        return len(page)
+
+    def can_fetch_older(self):
+        return not self.exhausted
+
+    def fetch_older(self):
+        """Подгрузка более ранней истории, возвращает число записей"""
+        if self.exhausted:
+            return 0
+        return self.load_page()
+
+    def append(self, row):
+        """Добавление нового сообщения в конец истории"""
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.rows.append(row)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = True
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        _, direction, message, date = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            kind = 'Входящее' if direction == INCOMING else 'Исходящее'
+            return f'{kind} от {date.replace(microsecond=0)}:\n {message}'
+        if role == Qt.BackgroundRole:
+            return BACKGROUND.get(direction)
+        if role == Qt.TextAlignmentRole:
+            return ALIGNMENT.get(direction)
+        return None
+
+    def flags(self, index):
+        # Сообщения нельзя редактировать
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
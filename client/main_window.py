@@ -1,14 +1,11 @@
-import base64
 import sys
 import json
 import logging
 
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, \
+    QAbstractItemView
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtCore import pyqtSlot, QEvent, Qt
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
-
 from common.errors import ServerError
 sys.path.append('../')
 from client.main_window_conv import Ui_MainClientWindow
@@ -17,6 +14,8 @@ from client.del_contact import DelContactDialog
 from database.client_db import ClientDatabase
 from client.transport import ClientTransport
 from client.start_dialog import UserNameDialog
+from client.crypto import MessageCipher
+from client.history_model import HistoryModel
 from common.variables import *
 
 LOGGER =logging.getLogger('client')
@@ -30,8 +29,8 @@ class ClientWindow(QMainWindow):
         self.database = database
         self.transport = transport
 
-        # дешифровщик сообщений с предзагруженным ключом
-        self.decrypter = PKCS1_OAEP.new(keys)
+        # шифрование сообщений сеансовыми ключами собеседников
+        self.cipher = MessageCipher(keys, transport.username)
 
         # Загрузка конфигурации окна
         self.ui = Ui_MainClientWindow()
@@ -57,10 +56,11 @@ class ClientWindow(QMainWindow):
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
-        self.encryptor = None
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.
                                                            ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(
+            self.history_scrolled)
 
         # Двоейное нажатие по списку контактов отправляется в обработчик
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
@@ -83,50 +83,34 @@ class ClientWindow(QMainWindow):
         self.ui.btn_send.setDisabled(True)
         self.ui.text_message.setDisabled(True)
 
-        self.encryptor = None
         self.current_chat = None
         self.current_chat_key = None
 
-    # метод заполнения истории сообщений
+    # метод заполнения истории сообщений: последняя страница переписки,
+    # более ранние сообщения подгружаются при прокрутке вверх
     def history_list_update(self):
-        # Получаем историю сортированную по дате
-        list_messages = sorted(self.database.get_history(self.current_chat),
-                               key=lambda item: item[3])
-        # Если модель не создана, создадим.
-        if not self.history_model:
-            self.history_model = QStandardItemModel()
-            self.ui.list_messages.setModel(self.history_model)
-        # Очистим от старых записей
-        self.history_model.clear()
-        # Берём не более 20 последних записей.
-        length = len(list_messages)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-        # Заполнение истории, разделение входящих и исходящих выравниванием
-        # и разным фоном.
-        # Записи в обратном порядке, выбираем их с конца и не более 20
-        for i in range(start_index, length):
-            item = list_messages[i]
-            if item[1] == 'in':
-                print(item[0])
-                mess = QStandardItem(f'Входящее от '
-                                     f'{item[3].replace(microsecond=0)}:'
-                                     f'\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(f'Исходящее от '
-                                     f'{item[3].replace(microsecond=0)}:'
-                                     f'\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
+        self.history_model = HistoryModel(self.database, self.current_chat)
+        self.ui.list_messages.setModel(self.history_model)
+        self.ui.list_messages.scrollToBottom()
+
+    # Новое сообщение добавляется в конец истории без её перечитывания
+    def history_append(self, row):
+        self.history_model.append(row)
         self.ui.list_messages.scrollToBottom()
 
+    # Прокрутка к началу загруженной истории
+    def history_scrolled(self, value):
+        if not self.history_model or \
+                value != self.ui.list_messages.verticalScrollBar().minimum() \
+                or not self.history_model.can_fetch_older():
+            return
+        loaded = self.history_model.fetch_older()
+        if loaded:
+            # Просмотр остаётся на сообщении, бывшем первым
+            self.ui.list_messages.scrollTo(
+                self.history_model.index(loaded, 0),
+                QAbstractItemView.PositionAtTop)
+
     # Функция обработчик двойного клика
     def select_active_user(self):
         # Выбираем пользователя и помещаем в QListView
@@ -138,21 +122,20 @@ class ClientWindow(QMainWindow):
     def set_active_user(self):
         # активируем чат с собеседником
         try:
-            self.current_chat_key = self.transport.key_request(
+            self.current_chat_key = self.transport.get_pubkey(
                 self.current_chat)
             LOGGER.debug(f'Загружен открытый ключ для {self.current_chat}')
-            if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_chat_key))
         except OSError:
             self.current_chat_key = None
-            self.encryptor = None
             LOGGER.debug(f'Не удалось получить ключ для {self.current_chat}')
         if not self.current_chat_key:
             self.messages.warning(
                 self, 'Ошибка', 'Для выбранного пользователя нет ключа '
                                 'шифрования')
             return
+        # Разбор ключа RSA выполняется при выборе собеседника,
+        # а не при отправке первого сообщения
+        self.cipher.encryptor(self.current_chat_key)
 
         # Ставим надпись и активируем кнопки
         self.ui.label_new_message.setText(f'Введите сообщение для '
@@ -194,11 +177,12 @@ class ClientWindow(QMainWindow):
         try:
             self.transport.add_contact(new_contact)
         except OSError as err:
+            # Транспорт переподключается сам, окно остаётся открытым
             if err.errno:
-                self.messages.critical(self, 'Ошибка', 'Потеряно соединение '
+                self.messages.critical(self, 'Ошибка', 'Нет соединения '
                                                        'с сервером')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения')
+            else:
+                self.messages.critical(self, 'Ошибка', 'Таймаут соединения')
         else:
             self.database.add_contact(new_contact)
             new_contact = QStandardItem(new_contact)
@@ -224,10 +208,10 @@ class ClientWindow(QMainWindow):
             self.transport.remove_contact(selected)
         except OSError as err:
             if err.errno:
-                self.messages.critical(self, 'Ошибка', 'Потеряно соединения с '
-                                                       'сервером!')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения')
+                self.messages.critical(self, 'Ошибка', 'Нет соединения с '
+                                                       'сервером')
+            else:
+                self.messages.critical(self, 'Ошибка', 'Таймаут соединения')
         else:
             self.database.del_contact(selected)
             self.clients_list_update()
@@ -247,32 +231,22 @@ class ClientWindow(QMainWindow):
         self.ui.text_message.clear()
         if not message_text:
             return
-        # Шифруем сообщение ключом получателя
-        message_text_encrypted = self.encryptor.encrypt(
-            message_text.encode('utf-8'))
-        message_text_encrypted_base64 = base64.b64encode(
-            message_text_encrypted)
+        # Шифруем сообщение сеансовым ключом для получателя
+        message_text_encrypted = self.cipher.encrypt(
+            self.current_chat, self.current_chat_key, message_text)
+        # Без связи с сервером сообщение остаётся в очереди транспорта
+        # и будет отправлено после переподключения
         try:
             self.transport.send_message(self.current_chat,
-                                message_text_encrypted_base64.decode('ascii'))
-            pass
+                                        message_text_encrypted)
         except ServerError as err:
             self.messages.critical(self, 'Ошибка', err.text)
-        except OSError as err:
-            if err.errno:
-                self.messages.critical(self, 'Ошибка', 'Потеряно соединение с '
-                                                       'сервером')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения')
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.messages.critical(self, 'Ошибка', 'Потеряно соединение с '
-                                                   'сервером')
-            self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
+            row = self.database.save_message(self.current_chat, 'out',
+                                             message_text)
             LOGGER.debug(f'Отправлено сообщение для {self.current_chat}:'
                          f'{message_text}')
-            self.history_list_update()
+            self.history_append(row)
 
     # Слот приёма нового сообщения
     @pyqtSlot(dict)
@@ -283,25 +257,22 @@ class ClientWindow(QMainWindow):
         пришло не от текущего собеседника. При необходимости меняет
         собеседника
         """
-        # Получаем строку байтов
-        encrypted_message = base64.b64decode(message[MESSAGE_TEXT])
-        # Декодируем строку, при ошибке выдаём сообщение и завершаем функцию
+        # Расшифровываем сообщение, при ошибке выдаём сообщение и
+        # завершаем функцию
         try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
+            decrypted_message = self.cipher.decrypt(message[SENDER],
+                                                    message[MESSAGE_TEXT])
         except (ValueError, TypeError):
             self.messages.warning(
                 self, 'Ошибка', 'Не удалось декодировать сообщение')
             return
-        # Сохраняем сообщение в БД и обновляем историю сообщений или открывае
-        # новый чат
-        self.database.save_message(
-            self.current_chat,
-            'in',
-            decrypted_message.decode('utf-8'))
+        # Сохраняем сообщение в истории переписки с отправителем и
+        # добавляем его в окно или открываем новый чат
         sender = message[SENDER]
+        row = self.database.save_message(sender, 'in', decrypted_message)
 
         if sender == self.current_chat:
-            self.history_list_update()
+            self.history_append(row)
         else:
             # Проверим есть ли такой пользователь у нас в контактах:
             if self.database.check_contact(sender):
@@ -312,10 +283,6 @@ class ClientWindow(QMainWindow):
                                       f'открыть чат с ним?', QMessageBox.Yes,
                                       QMessageBox.No) == QMessageBox.Yes:
                     self.current_chat = sender
-                    self.database.save_message(
-                        self.current_chat,
-                        'in',
-                        decrypted_message.decode('utf-8'))
                     self.set_active_user()
             else:
                 print('NO')
@@ -327,10 +294,6 @@ class ClientWindow(QMainWindow):
                           QMessageBox.Yes, QMessageBox.No) == QMessageBox.Yes:
                     self.add_contact(sender)
                     self.current_chat = sender
-                    self.database.save_message(
-                        self.current_chat,
-                        'in',
-                        decrypted_message.decode('utf-8'))
                     self.set_active_user()
 
     # Слот потери соединения
@@ -341,6 +304,12 @@ class ClientWindow(QMainWindow):
                                                        'сервером.')
         self.close()
 
+    @pyqtSlot(str, str)
+    def message_failed(self, contact, error):
+        """Сообщение, отправленное повторно, сервер не доставил"""
+        self.messages.warning(self, 'Ошибка', f'Сообщение для {contact} '
+                                              f'не доставлено: {error}')
+
     @pyqtSlot()
     def sig_205(self):
         """Обновление баз данных по команде сервера"""
@@ -355,3 +324,4 @@ class ClientWindow(QMainWindow):
     def make_connection(self, trans_obj):
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
+        trans_obj.message_failed.connect(self.message_failed)
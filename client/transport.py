@@ -1,12 +1,17 @@
 import binascii
-import hashlib
+import errno
 import hmac
+import itertools
+import os
+import random
 import sys
-import json
 import socket
 import time
 import threading
 import logging
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from functools import partial
 
 from PyQt5.QtCore import pyqtSignal, QObject
 
@@ -14,20 +19,39 @@ sys.path.append(('../'))
 from common.errors import ServerError
 from common.variables import *
 from common.utils import get_message, send_message
+from common.credentials import Credentials, upgrade_key, seal_hash
+from common.responses import response_511
 
 
 LOGGER = logging.getLogger('client')
-sock_lock = threading.Lock()
+
+
+def backoff(attempt):
+    """Пауза перед попыткой подключения номер attempt (с нуля): растёт
+    экспоненциально, а случайный разброс не даёт клиентам, одновременно
+    потерявшим сервер, одновременно к нему и вернуться"""
+    return random.uniform(0, min(RECONNECT_MAX_DELAY,
+                                 RECONNECT_DELAY * 2 ** min(attempt, 16)))
 
 
 class ClientTransport(threading.Thread, QObject):
     """Тарнспорт отвечающий за взаимодействие
-    клиента и сервера
+    клиента и сервера.
+    Поток транспорта - единственный читатель сокета: ответы сервера
+    он передаёт ожидающим их Future по номеру запроса, остальные
+    сообщения - сигналами. Запросы отправляются из любого потока
+    без ожидания ответов на предыдущие.
+    При обрыве связи поток переподключается к серверу, а сообщения, на
+    которые сервер не ответил, отправляет повторно. Повторно принятые
+    сообщения получатель узнаёт по номеру и отбрасывает
     """
     # Сигнал нового сообщения и потери соедининения
     new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
     connection_lost = pyqtSignal()
+    # Сервер отказался доставить повторно отправленное сообщение:
+    # получатель и текст ошибки
+    message_failed = pyqtSignal(str, str)
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
         # Конструктор предка
@@ -37,9 +61,43 @@ class ClientTransport(threading.Thread, QObject):
         # База данных, имя пользователя, сокет
         self.database = database
         self.username = username
-        self.password = passwd
+        # Хэш пароля вычисляется один раз на сеанс, а не при каждом
+        # подключении
+        self.credentials = Credentials(username, passwd)
+        self.port = port
+        self.ip_address = ip_address
         self.transport = None
         self.keys = keys
+        # Открытые ключи собеседников: имя -> (ключ, время получения)
+        self.pubkeys = {}
+        # Запросы, ожидающие ответа: номер -> Future
+        self.requests = {}
+        self.requests_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # Поток приёма запущен, соединение установлено
+        self.reader_started = False
+        self.connected = False
+        # Кадр отправляется в сокет целиком одним потоком
+        self.send_lock = threading.Lock()
+        # Рекомендованное сервером число итераций хэша пароля и ключ,
+        # которым новый хэш шифруется при отправке
+        self.kdf_upgrade = None
+        self.kdf_upgrade_key = None
+        # Номера сообщений уникальны и между запусками клиента
+        self.message_epoch = os.urandom(4).hex()
+        self.message_ids = itertools.count(1)
+        # Отправленные сообщения без ответа сервера: номер -> сообщение
+        self.unsent = OrderedDict()
+        # Номера последних принятых сообщений (отправитель, номер)
+        self.received = OrderedDict()
+        # Сообщения, принятые до подключения получателя сигнала
+        # new_message, передаются ему в start_delivery
+        self.delivering = False
+        self.held = []
+        self.delivery_lock = threading.Lock()
+        # Флаг продолжения работы транспорта
+        self.running = True
+        self.stopping = threading.Event()
         # Установка соединения
         self.connection_init(port, ip_address)
 
@@ -52,75 +110,117 @@ class ClientTransport(threading.Thread, QObject):
                 raise ServerError('Потеряно соединение с сервером')
             LOGGER.error('Timeout соединения при обновлении списков '
                          'пользователей')
-        # Флаг продолжения работы транспорта
-        self.running = True
 
     def connection_init(self, port, ip):
         """установка соединения с сервером"""
-        self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.transport.settimeout(5)
-
-        connected = False
-        for i in range(5):
-            LOGGER.info(f'Попытка подключения №{i + 1}')
+        for attempt in range(CONNECT_ATTEMPTS):
+            LOGGER.info(f'Попытка подключения №{attempt + 1}')
             try:
-                self.transport.connect((ip, port))
-            except (OSError, ConnectionRefusedError):
-                pass
-            else:
-                connected = True
-                LOGGER.debug(f'Соединение установлено {self.transport}')
-                break
-            time.sleep(1)
-        if not connected:
-            LOGGER.critical('Не удалось подключится к серверу')
-            raise ServerError('Не удалость подключится к серверу')
-
-        LOGGER.debug('Установлено соединение с сервером')
+                self.connect(port, ip)
+                return
+            except OSError as err:
+                LOGGER.debug(f'Не удалось подключиться: {err}')
+            if attempt + 1 < CONNECT_ATTEMPTS:
+                self.stopping.wait(backoff(attempt))
+        LOGGER.critical('Не удалось подключится к серверу')
+        raise ServerError('Не удалость подключится к серверу')
 
-        # Запускаем авторизацию
-        passwd_bytes = self.password.encode('utf-8')
-        salt = self.username.lower().encode('utf-8')
-        passwd_hash = hashlib.pbkdf2_hmac('sha512', passwd_bytes, salt, 10000)
-        passwd_hash_string = binascii.hexlify(passwd_hash)
+    def connect(self, port, ip):
+        """Подключение и авторизация. OSError при сбое сети,
+        ServerError при отказе сервера"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        try:
+            sock.connect((ip, port))
+            LOGGER.debug(f'Соединение установлено {sock}')
+            self.transport = sock
+            self.authorize()
+        except (OSError, ServerError):
+            sock.close()
+            raise
+        with self.requests_lock:
+            self.connected = True
+        if self.kdf_upgrade:
+            self.upgrade_password()
 
-        LOGGER.debug(f'Хэш пароля готов: {passwd_hash_string}')
+    def authorize(self):
+        """Авторизация на сервере после установки соединения"""
+        LOGGER.debug('Установлено соединение с сервером')
 
         # публичный ключ получаем и декодируем из байтов
         pubkey = self.keys.publickey().export_key().decode('ascii')
 
-        with sock_lock:
-            presence = {
-                ACTION: PRESENCE,
-                TIME: time.time(),
-                USER: {
-                    ACCOUNT_NAME: self.username,
-                    PUBLIC_KEY: pubkey
-                }
+        presence = {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {
+                ACCOUNT_NAME: self.username,
+                PUBLIC_KEY: pubkey
             }
-            LOGGER.debug(f"Сообщение приветствия = {presence}"
-                         f"направлеяем серверу - {self.transport}")
-            # Отправляем серверу приветственное сообщение.
-            try:
-                send_message(self.transport, presence)
-                ans = get_message(self.transport)
-                LOGGER.debug(f'Ответ сервера - {ans}')
-                if RESPONSE in ans:
-                    if ans[RESPONSE] == 400:
-                        raise ServerError(ans[ERROR])
-                    elif ans[RESPONSE] == 511:
-                        ans_data = ans[DATA]
-                        hash = hmac.new(passwd_hash_string,
-                                        ans_data.encode('utf-8'), 'MD5')
-                        digest = hash.digest()
-                        my_ans = RESPONSE_511
-                        my_ans[DATA] = binascii.b2a_base64(
-                            digest).decode('ascii')
-                        send_message(self.transport, my_ans)
-                        self.process_ans(get_message(self.transport))
-            except OSError:
-                LOGGER.debug('Ошибка соединения')
-                raise ServerError('Сбой соединения в процессе авторизации')
+        }
+        LOGGER.debug(f"Сообщение приветствия = {presence}"
+                     f"направлеяем серверу - {self.transport}")
+        # Отправляем серверу приветственное сообщение.
+        send_message(self.transport, presence)
+        ans = get_message(self.transport)
+        LOGGER.debug(f'Ответ сервера - {ans}')
+        if RESPONSE in ans:
+            if ans[RESPONSE] == 400:
+                raise ServerError(ans[ERROR])
+            elif ans[RESPONSE] == 511:
+                # Сервер прежней версии не сообщает число итераций
+                iterations = self.check_iterations(
+                    ans.get(KDF_ITERATIONS, PASSWORD_ITERATIONS))
+                ans_data = ans[DATA]
+                passwd_hash = self.credentials.passwd_hash(iterations)
+                hash = hmac.new(passwd_hash, ans_data.encode('utf-8'), 'MD5')
+                digest = hash.digest()
+                my_ans = response_511(binascii.b2a_base64(
+                    digest).decode('ascii'))
+                send_message(self.transport, my_ans)
+                self.process_ans(get_message(self.transport))
+                self.kdf_upgrade = ans.get(KDF_UPGRADE)
+                if self.kdf_upgrade:
+                    self.kdf_upgrade_key = upgrade_key(
+                        passwd_hash, ans_data.encode('utf-8'))
+
+    @staticmethod
+    def check_iterations(iterations):
+        """Число итераций от сервера: слишком большое заняло бы
+        процессор клиента надолго"""
+        if not isinstance(iterations, int) or \
+                not 0 < iterations <= PASSWORD_ITERATIONS_MAX:
+            raise ServerError(f'Некорректное число итераций: {iterations}')
+        return iterations
+
+    def upgrade_password(self):
+        """Замена хэша пароля на сервере вычисленным с рекомендованным
+        сервером числом итераций. Новый хэш шифруется ключом из прежнего
+        хэша и случайной строки авторизации этого соединения. Ответ не
+        ждётся: при неудаче вход продолжит работать с прежним хэшем"""
+        iterations, self.kdf_upgrade = self.kdf_upgrade, None
+        key, self.kdf_upgrade_key = self.kdf_upgrade_key, None
+        try:
+            self.check_iterations(iterations)
+            LOGGER.info(f'Пересчёт хэша пароля с {iterations} итерациями')
+            self.request({
+                ACTION: PASSWORD_UPGRADE,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.username,
+                DATA: seal_hash(key, self.username, iterations,
+                                self.credentials.passwd_hash(iterations)),
+                KDF_ITERATIONS: iterations
+            }).add_done_callback(self.password_upgraded)
+        except (OSError, ServerError) as err:
+            # Обрыв связи обнаружит поток приёма
+            LOGGER.error(f'Не удалось обновить хэш пароля: {err}')
+
+    def password_upgraded(self, future):
+        if future.exception() is None and \
+                future.result().get(RESPONSE) == 200:
+            LOGGER.info('Хэш пароля на сервере обновлён')
+        else:
+            LOGGER.error('Не удалось обновить хэш пароля на сервере')
 
     def process_ans(self, message):
         """Функция разбирает ответ сервера"""
@@ -130,23 +230,163 @@ class ClientTransport(threading.Thread, QObject):
                 return
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
-            elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
-                self.message_205.emit()
             else:
                 LOGGER.error(f'Ошибка полученного ответа от сервера {message}')
+
+    def process_server_message(self, message):
+        """Разбор сообщений, присланных сервером не в ответ на запрос"""
+        if RESPONSE in message and message[RESPONSE] == 205:
+            # Контакты меняет только сам клиент, а удалённые
+            # пользователи убираются из них при обновлении списка.
+            # Ответ читает этот же поток, поэтому он не ждёт его здесь
+            self.users_request().add_done_callback(self.users_updated)
         elif ACTION in message and message[ACTION] == MESSAGE and \
                 SENDER in message and DESTINATION in message and \
                 MESSAGE_TEXT in message and \
                 message[DESTINATION] == self.username:
+            if not self.first_delivery(message):
+                LOGGER.debug(f'Повторно получено сообщение '
+                             f'{message[MESSAGE_ID]} от {message[SENDER]}')
+                return
             LOGGER.debug(f'Получено сообщение от пользователя: '
                          f'{message[SENDER]} - {message[MESSAGE_TEXT]}')
-            self.new_message.emit(message)
+            with self.delivery_lock:
+                if self.delivering:
+                    self.new_message.emit(message)
+                else:
+                    self.held.append(message)
+        else:
+            LOGGER.error(f'Некорректное сообщение от сервера {message}')
+
+    def start_delivery(self):
+        """Передача сообщений получателю сигнала new_message. Вызывается
+        после его подключения: принятые до этого сообщения передаются
+        сразу, затем с сервера запрашиваются накопленные для клиента,
+        пока он был не в сети"""
+        with self.delivery_lock:
+            self.delivering = True
+            held, self.held = self.held, []
+            for message in held:
+                self.new_message.emit(message)
+        try:
+            self.spooled_request()
+        except OSError as err:
+            # После переподключения запрос будет повторён
+            LOGGER.error(f'Не удалось запросить накопленные сообщения: {err}')
+
+    def spooled_request(self):
+        """Запрос сообщений, накопленных сервером, пока клиент был не в
+        сети. Сервер присылает их перед ответом на запрос"""
+        self.request({
+            ACTION: SPOOL_REQUEST,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.username
+        }).add_done_callback(self.spooled_received)
+
+    def spooled_received(self, future):
+        """Ответ на запрос накопленных сообщений. Ответ читается после
+        самих сообщений, поэтому они уже переданы получателю и сервер
+        может удалить их из журнала. Сообщения присылаются частями, после
+        каждой запрашивается следующая, пока журнал не опустеет"""
+        if future.exception() is not None:
+            return
+        count = future.result().get(SPOOL_COUNT)
+        if not count:
+            return
+        LOGGER.info(f'Получено сообщений, накопленных сервером: {count}')
+        try:
+            self.request({
+                ACTION: SPOOL_DELIVERED,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.username,
+                SPOOL_COUNT: count
+            })
+            self.spooled_request()
+        except OSError:
+            # Неподтверждённые сообщения сервер пришлёт повторно
+            pass
+
+    def first_delivery(self, message):
+        """Сообщение принято впервые: после обрыва связи отправитель
+        повторяет сообщения, ответа на которые не получил"""
+        message_id = message.get(MESSAGE_ID)
+        if not isinstance(message_id, str):
+            return True
+        key = (message[SENDER], message_id)
+        if key in self.received:
+            return False
+        self.received[key] = None
+        if len(self.received) > RECEIVED_IDS_SIZE:
+            self.received.popitem(last=False)
+        return True
+
+    def request(self, message):
+        """Отправка запроса, возвращает Future, который получит ответ
+        сервера. Ответа на предыдущие запросы ждать не нужно"""
+        future = Future()
+        with self.requests_lock:
+            if not self.connected:
+                raise ConnectionResetError(errno.ECONNRESET,
+                                           'Потеряно соединение с сервером')
+            future.request_id = next(self.request_ids)
+            self.requests[future.request_id] = future
+        message[REQUEST_ID] = future.request_id
+        try:
+            with self.send_lock:
+                send_message(self.transport, message)
+        except OSError:
+            with self.requests_lock:
+                self.requests.pop(future.request_id, None)
+            raise
+        return future
+
+    def wait(self, future):
+        """Ожидание ответа на запрос не дольше REQUEST_TIMEOUT"""
+        try:
+            if not self.reader_started:
+                # Поток приёма ещё не запущен: ответы читаются здесь же
+                while not future.done():
+                    self.route(get_message(self.transport))
+            return future.result(REQUEST_TIMEOUT)
+        except (OSError, FutureTimeout) as err:
+            with self.requests_lock:
+                self.requests.pop(future.request_id, None)
+            if isinstance(err, FutureTimeout):
+                raise socket.timeout('Сервер не ответил на запрос')
+            raise
+
+    def call(self, message):
+        """Запрос с ожиданием ответа сервера"""
+        return self.wait(self.request(message))
+
+    def route(self, message):
+        """Передача ответа ожидающему его запросу"""
+        LOGGER.debug(f'Принято сообщение с сервера: {message}')
+        if RESPONSE not in message or message[RESPONSE] == 205:
+            self.process_server_message(message)
+            return
+        with self.requests_lock:
+            future = self.requests.pop(message.get(REQUEST_ID), None)
+            if future is None and REQUEST_ID not in message and \
+                    self.requests:
+                # Сервер без номеров запросов отвечает по порядку
+                future = self.requests.pop(next(iter(self.requests)))
+        if future is None:
+            LOGGER.error(f'Ответ на неизвестный запрос {message}')
+        else:
+            future.set_result(message)
+
+    def fail_requests(self):
+        """Завершение ожидающих запросов при потере соединения"""
+        with self.requests_lock:
+            self.connected = False
+            requests, self.requests = self.requests, {}
+        for future in requests.values():
+            future.set_exception(ConnectionResetError(
+                errno.ECONNRESET, 'Потеряно соединение с сервером'))
 
     def contacts_list_update(self):
         """Обновление списка контактов с сервера"""
-        self.database.contacts_clear()
         LOGGER.debug(f'Запрос контакт листа для пользователя {self.username}')
         req = {
             ACTION: GET_CONTACTS,
@@ -154,29 +394,52 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username
         }
         LOGGER.debug(f'Сформирован запрос {req}')
-        with sock_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.call(req)
         LOGGER.debug(f'Получен ответ {ans}')
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            for contact in ans[LIST_INFO]:
-                self.database.add_contact(contact)
+            self.database.replace_contacts(ans[LIST_INFO])
         else:
             LOGGER.error('Не удалось обновить список контактов.')
 
-    def user_list_update(self):
-        """Обновление с сервера списка пользователей"""
+    def users_request(self):
+        """Запрос изменений списка пользователей после известной
+        клиенту версии, возвращает Future ответа"""
         LOGGER.debug(f'Запрос списка известных пользователей {self.username}')
-        req = {
+        epoch, version = self.database.get_directory_version()
+        return self.request({
             ACTION: USERS_REQUEST,
             TIME: time.time(),
-            ACCOUNT_NAME: self.username
-        }
-        with sock_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+            ACCOUNT_NAME: self.username,
+            DIRECTORY_EPOCH: epoch,
+            DIRECTORY_VERSION: version
+        })
+
+    def users_updated(self, future):
+        """Применение ответа на запрос, отправленный по уведомлению 205"""
+        if future.exception() is None:
+            self.users_apply(future.result())
+            self.message_205.emit()
+
+    def user_list_update(self):
+        """Обновление с сервера списка пользователей. Сервер присылает
+        изменения после известной клиенту версии списка или, если
+        клиент сильно отстал, полный список"""
+        self.users_apply(self.wait(self.users_request()))
+
+    def users_apply(self, ans):
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            self.database.add_users(ans[LIST_INFO])
+            if LIST_INFO in ans:
+                self.database.add_users(ans[LIST_INFO])
+                # Изменения неизвестны, ключи будут запрошены заново
+                self.drop_pubkeys()
+            else:
+                self.database.update_users(ans[USERS_ADDED],
+                                           ans[USERS_REMOVED])
+                # Новые, удалённые и сменившие ключ пользователи
+                self.drop_pubkeys(ans[USERS_ADDED] + ans[USERS_REMOVED])
+            if DIRECTORY_VERSION in ans:
+                self.database.set_directory_version(ans[DIRECTORY_EPOCH],
+                                                    ans[DIRECTORY_VERSION])
         else:
             LOGGER.error('Не удалось обновить список известных пользователей')
 
@@ -188,14 +451,37 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with sock_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.call(req)
         if RESPONSE in ans and ans[RESPONSE] == 511:
             return ans[DATA]
         else:
             LOGGER.error(f'Не удалось получить ключ пользователя {user}')
 
+    def get_pubkey(self, user):
+        """Открытый ключ собеседника: из памяти, из БД клиента или, если
+        сохранённый ключ старше PUBKEY_CACHE_TTL, с сервера"""
+        cached = self.pubkeys.get(user) or self.database.get_pubkey(user)
+        if cached and time.time() - cached[1] < PUBKEY_CACHE_TTL:
+            self.pubkeys[user] = cached
+            return cached[0]
+        pubkey = self.key_request(user)
+        if pubkey:
+            if cached and cached[0] != pubkey:
+                LOGGER.info(f'Изменился открытый ключ пользователя {user}')
+            self.pubkeys[user] = (pubkey, time.time())
+            self.database.save_pubkey(user, pubkey, self.pubkeys[user][1])
+        return pubkey
+
+    def drop_pubkeys(self, users=None):
+        """Сброс сохранённых ключей пользователей, всех - если users
+        не задан"""
+        if users is None:
+            self.pubkeys.clear()
+        else:
+            for user in users:
+                self.pubkeys.pop(user, None)
+        self.database.drop_pubkeys(users)
+
     def add_contact(self, contact):
         """уведомление для сервера о добавлении контакта"""
         LOGGER.debug(f'Создание контакта {contact}')
@@ -205,9 +491,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with sock_lock:
-            send_message(self.transport, req)
-            self.process_ans(get_message(self.transport))
+        self.process_ans(self.call(req))
 
     def remove_contact(self, contact):
         """уведомление удаления контакта из списка"""
@@ -218,65 +502,157 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with sock_lock:
-            send_message(self.transport, req)
-            self.process_ans(get_message(self.transport))
+        self.process_ans(self.call(req))
 
     def transport_shutdown(self):
         """Уведомление для сервера о завершении работы клиента"""
         self.running = False
+        self.stopping.set()
         message = {
             ACTION: EXIT,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with sock_lock:
-            try:
+        try:
+            with self.send_lock:
                 send_message(self.transport, message)
-            except OSError:
-                pass
+        except OSError:
+            pass
         LOGGER.debug('Транспорт завершает работу')
         time.sleep(0.5)
+        # Поток приёма завершится, получив конец потока
+        try:
+            self.transport.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def send_message(self, to, message):
-        """Отправка сообщений на сервер для пользователя"""
+        """Отправка сообщений на сервер для пользователя. Если связи с
+        сервером нет, сообщение будет отправлено после переподключения"""
+        message_id = f'{self.message_epoch}-{next(self.message_ids)}'
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.username,
             DESTINATION: to,
             TIME: time.time(),
-            MESSAGE_TEXT: message
+            MESSAGE_TEXT: message,
+            MESSAGE_ID: message_id
         }
         LOGGER.debug(f'Сформирован словарь сообщения: {message_dict}')
 
-        # Необходимо дождаться освобождения сокета для отправки сообщения
-        with sock_lock:
-            send_message(self.transport, message_dict)
-            self.process_ans(get_message(self.transport))
-            LOGGER.info(f'Отправлено сообщение для пользователя {to}')
+        self.unsent[message_id] = message_dict
+        try:
+            ans = self.call(message_dict)
+        except socket.timeout:
+            # Связь есть, но ответ не пришёл: сообщение отправляется
+            # повторно, не дожидаясь переподключения. Получатель
+            # отбросит повтор по номеру
+            LOGGER.warning(f'Сервер не ответил на сообщение для {to}, '
+                           f'оно отправлено повторно')
+            self.resend(message_id)
+            return
+        except OSError as err:
+            LOGGER.warning(f'Сообщение для {to} не подтверждено сервером '
+                           f'({err}), оно будет отправлено повторно')
+            return
+        self.unsent.pop(message_id, None)
+        self.process_ans(ans)
+        LOGGER.info(f'Отправлено сообщение для пользователя {to}')
+
+    def resend(self, message_id):
+        """Повторная отправка сообщения без ответа сервера. Ответ
+        обрабатывает message_sent, при обрыве связи сообщение будет
+        отправлено после переподключения"""
+        message = self.unsent.get(message_id)
+        if message is None:
+            return
+        try:
+            self.request(message).add_done_callback(
+                partial(self.message_sent, message_id))
+        except OSError:
+            pass
+
+    def message_sent(self, message_id, future):
+        """Ответ на повторно отправленное сообщение"""
+        if future.exception() is not None:
+            return
+        message = self.unsent.pop(message_id, None)
+        ans = future.result()
+        if ans.get(RESPONSE) != 200:
+            LOGGER.error(f'Сообщение {message_id} не доставлено: '
+                         f'{ans.get(ERROR)}')
+            if message is not None:
+                self.message_failed.emit(message[DESTINATION],
+                                         str(ans.get(ERROR)))
+
+    def reconnect(self):
+        """Восстановление соединения после сбоя. False, если транспорт
+        остановлен или сервер отказал в авторизации"""
+        self.transport.close()
+        attempt = 0
+        while self.running:
+            if self.stopping.wait(backoff(attempt)):
+                return False
+            attempt += 1
+            LOGGER.info(f'Попытка переподключения №{attempt}')
+            try:
+                self.connect(self.port, self.ip_address)
+            except OSError as err:
+                LOGGER.debug(f'Не удалось подключиться: {err}')
+                continue
+            except ServerError as err:
+                LOGGER.critical(f'Сервер отказал в авторизации: {err}')
+                return False
+            LOGGER.info('Соединение с сервером восстановлено')
+            self.resume()
+            return True
+        return False
+
+    def resume(self):
+        """Продолжение работы после переподключения: повтор сообщений
+        без ответа, обновление списка пользователей и запрос
+        сообщений, накопленных сервером за время обрыва. Ответы читает
+        этот же поток, поэтому здесь они не ждутся"""
+        for message_id in list(self.unsent):
+            self.resend(message_id)
+        self.users_request().add_done_callback(self.users_updated)
+        if self.delivering:
+            self.spooled_request()
 
     def run(self):
-        """Основной цикл работы транспортного потока"""
+        """Основной цикл работы транспортного потока: приём всех
+        сообщений сервера"""
         LOGGER.debug('Запущен процесс - приёмник сообщений с сервера')
+        self.reader_started = True
         while self.running:
-            time.sleep(1)
-            message = None
-            with sock_lock:
+            try:
+                message = get_message(self.transport)
+            except socket.timeout:
+                # Неполный кадр остаётся в буфере декодера
+                continue
+            except (OSError, ValueError, TypeError):
+                self.fail_requests()
+                if not self.running:
+                    break
+                LOGGER.warning('Потеряно соединение с сервером, '
+                               'переподключение')
                 try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        LOGGER.critical(f'Потеряно соединение с сервером')
+                    reconnected = self.reconnect()
+                except OSError:
+                    # Связь снова потеряна при повторе запросов
+                    continue
+                if not reconnected:
+                    if self.running:
+                        LOGGER.critical('Потеряно соединение с сервером')
                         self.running = False
                         self.connection_lost.emit()
-                except (ConnectionError, ConnectionAbortedError,
-                        ConnectionResetError, json.JSONDecodeError, TypeError):
-                    LOGGER.debug(f'Потеряно соединение с сервером')
-                    self.running = False
-                    self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
-            if message:
-                LOGGER.debug(f'Принято сообщение с сервера: {message}')
-                self.process_ans(message)
+                    break
+                continue
+            try:
+                self.route(message)
+            except OSError:
+                # Запрос по уведомлению не отправлен: обрыв связи
+                # обнаружит следующее чтение
+                pass
+        self.fail_requests()
+        self.credentials.clear()
@@ -8,7 +8,7 @@ from client.start_dialog import UserNameDialog
 from common.variables import *
 import logging
 import logs.client_log_config
-from decos import log
+from decos import log, set_message_sample
 from database.client_db import ClientDatabase
 from PyQt5.QtWidgets import QApplication, QMessageBox
 
@@ -19,28 +19,53 @@ LOGGER = logging.getLogger('client')
 @log
 def arg_parser():
     """Создаём парсер аргументов коммандной строки
-    и читаем параметры, возвращаем 3 параметра"""
+    и читаем параметры, возвращаем 5 параметров"""
     parser = argparse.ArgumentParser()
     parser.add_argument('addr', default=DEFAULT_IP_ADDRESS, nargs='?')
     parser.add_argument('port', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-n', '--name', default=None, nargs='?')
     parser.add_argument('-p', '--password', default='', nargs='?')
+    parser.add_argument('--history-days', default=0, type=int,
+                        help='хранить в рабочей БД историю за столько '
+                             'последних дней, более раннюю переносить '
+                             'в архив (0 - не переносить)')
+    parser.add_argument('--rebuild-search', action='store_true',
+                        help='перестроить индекс поиска по истории '
+                             'пользователя --name и выйти')
+    parser.add_argument('--log-sample', default=LOG_MESSAGE_SAMPLE, type=int,
+                        help='записывать в лог каждый N-й приём и отправку '
+                             'сообщения (1 - каждый)')
     namespace = parser.parse_args(sys.argv[1:])
+    set_message_sample(namespace.log_sample)
     server_address = namespace.addr
     server_port = namespace.port
     client_name = namespace.name
     client_password = namespace.password
+    history_days = namespace.history_days
+
+    if namespace.rebuild_search:
+        if not client_name:
+            LOGGER.critical('Для перестроения индекса поиска нужно имя '
+                            'пользователя')
+            sys.exit(1)
+        database = ClientDatabase(client_name)
+        database.rebuild_search_index()
+        database.close()
+        LOGGER.info(f'Индекс поиска пользователя {client_name} перестроен')
+        sys.exit(0)
 
     if server_port < 1023 or server_port > 65536:
         LOGGER.critical(f'Порт {server_port} недопустим')
         sys.exit(1)
 
-    return server_address, server_port, client_name, client_password
+    return server_address, server_port, client_name, client_password, \
+        history_days
 
 
 if __name__ == '__main__':
     # Загрузка параметров
-    server_address, server_port, client_name, client_password = arg_parser()
+    server_address, server_port, client_name, client_password, \
+        history_days = arg_parser()
     LOGGER.debug('аргументы загружены')
     # Создаем клиентское приложение
     client_app = QApplication(sys.argv)
@@ -74,7 +99,7 @@ if __name__ == '__main__':
             keys = RSA.import_key(key.read())
     LOGGER.debug('Ключи успешно загружены')
     # Создаём объект базы данных
-    database = ClientDatabase(client_name)
+    database = ClientDatabase(client_name, hot_days=history_days)
     try:
         transport = ClientTransport(server_port,
                                     server_address,
@@ -95,8 +120,11 @@ if __name__ == '__main__':
     # Создаём GUI
     main_window = ClientWindow(database, transport, keys)
     main_window.make_connection(transport)
+    # Сообщения передаются окну только после подключения его сигналов
+    transport.start_delivery()
     main_window.setWindowTitle(f'Чат клиента {client_name}')
     client_app.exec_()
 
     transport.transport_shutdown()
     transport.join()
+    database.close()
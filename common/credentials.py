@@ -0,0 +1,83 @@
+"""Хэш пароля пользователя"""
+import binascii
+import hashlib
+import hmac
+import os
+
+from Crypto.Cipher import AES
+
+from .variables import PASSWORD_ITERATIONS
+
+# Новый хэш при замене передаётся зашифрованным AES-GCM: по сети, как и
+# при авторизации, не идёт ни один хэш, которым можно войти
+UPGRADE_NONCE_SIZE = 12
+UPGRADE_TAG_SIZE = 16
+
+
+def password_hash(username, password, iterations=PASSWORD_ITERATIONS):
+    """Хэш пароля, который хранит сервер: PBKDF2-SHA512, соль - имя
+    пользователя в нижнем регистре, результат в hex"""
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha512', password, username.lower().encode('utf-8'), iterations))
+
+
+def upgrade_key(passwd_hash, challenge):
+    """Ключ шифрования нового хэша пароля: его знают только клиент и
+    сервер, у которых есть прежний хэш, и он свой для каждой случайной
+    строки авторизации"""
+    return hmac.new(bytes(passwd_hash), b'kdf-upgrade:' + challenge,
+                    'sha256').digest()
+
+
+def seal_hash(key, username, iterations, passwd_hash):
+    """Новый хэш пароля, зашифрованный ключом upgrade_key, в hex.
+    Имя и число итераций защищены от подмены тегом"""
+    nonce = os.urandom(UPGRADE_NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(f'{username}:{iterations}'.encode('utf-8'))
+    data, tag = cipher.encrypt_and_digest(bytes(passwd_hash))
+    return (nonce + tag + data).hex()
+
+
+def open_hash(key, username, iterations, sealed):
+    """Расшифровка хэша от seal_hash. ValueError, если данные
+    повреждены, подменены или зашифрованы другим ключом"""
+    sealed = bytes.fromhex(sealed)
+    nonce = sealed[:UPGRADE_NONCE_SIZE]
+    tag = sealed[UPGRADE_NONCE_SIZE:UPGRADE_NONCE_SIZE + UPGRADE_TAG_SIZE]
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(f'{username}:{iterations}'.encode('utf-8'))
+    return cipher.decrypt_and_verify(
+        sealed[UPGRADE_NONCE_SIZE + UPGRADE_TAG_SIZE:], tag)
+
+
+class Credentials:
+    """
+    Имя и пароль пользователя клиента. Хэш пароля вычисляется один раз
+    для каждого числа итераций и хранится до clear(), поэтому
+    переподключения не повторяют дорогой PBKDF2.
+    Пароль и хэши хранятся в bytearray и затираются при clear(). Строку,
+    из которой получен пароль, Python затереть не позволяет
+    """
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = bytearray(password.encode('utf-8'))
+        # число итераций -> хэш пароля
+        self.hashes = {}
+
+    def passwd_hash(self, iterations=PASSWORD_ITERATIONS):
+        """Хэш пароля с iterations итерациями PBKDF2"""
+        result = self.hashes.get(iterations)
+        if result is None:
+            result = self.hashes[iterations] = bytearray(password_hash(
+                self.username, self.password, iterations))
+        return result
+
+    def clear(self):
+        """Затирание пароля и хэшей в памяти"""
+        for value in (self.password, *self.hashes.values()):
+            value[:] = bytes(len(value))
+        self.hashes.clear()
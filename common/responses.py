@@ -0,0 +1,74 @@
+"""Ответы сервера.
+Постоянные ответы (200, 205) кодируются в кадры один раз при загрузке
+модуля. Ответы с параметрами собираются из неизменяемых шаблонов
+common.variables: либо новым словарём, либо сразу кадром, в котором
+заранее закодированная часть шаблона склеивается с параметром.
+Номер запроса добавляется в готовый кадр так же, без разбора JSON"""
+import json
+
+from .variables import RESPONSE_200, RESPONSE_202, RESPONSE_205, \
+    RESPONSE_400, RESPONSE_511, LIST_INFO, ERROR, DATA, ENCODING, \
+    REQUEST_ID
+from .utils import encode_message, FRAME_HEADER
+
+# Готовые кадры постоянных ответов
+FRAME_200 = encode_message(dict(RESPONSE_200))
+FRAME_205 = encode_message(dict(RESPONSE_205))
+
+
+def _compile_template(template, key):
+    """JSON шаблона без значения key: часть до значения и после него"""
+    head = {name: value for name, value in template.items() if name != key}
+    prefix = f'{json.dumps(head)[:-1]}, {json.dumps(key)}: '
+    return prefix.encode(ENCODING), b'}'
+
+
+_TEMPLATE_202 = _compile_template(RESPONSE_202, LIST_INFO)
+_TEMPLATE_400 = _compile_template(RESPONSE_400, ERROR)
+_TEMPLATE_511 = _compile_template(RESPONSE_511, DATA)
+
+
+def _build_frame(template, value):
+    prefix, suffix = template
+    payload = prefix + json.dumps(value).encode(ENCODING) + suffix
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def response_202(list_info):
+    """Ответ 202 со списком"""
+    return {**RESPONSE_202, LIST_INFO: list_info}
+
+
+def response_400(error):
+    """Ответ 400 с текстом ошибки"""
+    return {**RESPONSE_400, ERROR: error}
+
+
+def response_511(data):
+    """Ответ 511 с данными авторизации или ключом"""
+    return {**RESPONSE_511, DATA: data}
+
+
+def frame_202(list_info):
+    """Кадр ответа 202 со списком"""
+    return _build_frame(_TEMPLATE_202, list_info)
+
+
+def frame_400(error):
+    """Кадр ответа 400 с текстом ошибки"""
+    return _build_frame(_TEMPLATE_400, error)
+
+
+def frame_511(data):
+    """Кадр ответа 511 с данными авторизации или ключом"""
+    return _build_frame(_TEMPLATE_511, data)
+
+
+def with_request_id(frame, request_id):
+    """Кадр ответа с номером запроса request_id, если он задан"""
+    if request_id is None:
+        return frame
+    payload = frame[FRAME_HEADER.size:-1] + \
+        f', {json.dumps(REQUEST_ID)}: {json.dumps(request_id)}}}'.encode(
+            ENCODING)
+    return FRAME_HEADER.pack(len(payload)) + payload
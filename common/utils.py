@@ -2,31 +2,110 @@
 import os
 import sys
 import json
-from .variables import MAX_PACKAGE_LENGTH, ENCODING
+import struct
+import weakref
+from collections import deque
+from .variables import MAX_PACKAGE_LENGTH, MAX_FRAME_LENGTH, ENCODING
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 from decos import log
 
+# Заголовок кадра: длина полезной нагрузки, 4 байта в сетевом порядке
+FRAME_HEADER = struct.Struct('!I')
 
-@log
+# Декодеры кадров для каждого сокета, удаляются вместе с сокетом
+_DECODERS = weakref.WeakKeyDictionary()
+
+
+def encode_message(message):
+    """
+    Кодирование словаря в кадр протокола:
+    заголовок с длиной и JSON в кодировке проекта
+    """
+    payload = json.dumps(message).encode(ENCODING)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Потоковый декодер кадров. Принимает байты в том виде, в каком они
+    пришли из сокета, и возвращает 0 или более полностью принятых
+    сообщений. Неполный кадр остаётся в буфере до следующего приёма.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Принятые, но ещё не выданные get_message сообщения
+        self.pending = deque()
+
+    def feed(self, data):
+        """Добавление данных в буфер, возвращает список сообщений"""
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_LENGTH:
+                raise ValueError(f'Слишком большой кадр: {length} байт')
+            end = offset + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = self.buffer[offset + FRAME_HEADER.size:end]
+            response = json.loads(payload.decode(ENCODING))
+            if not isinstance(response, dict):
+                raise ValueError
+            messages.append(response)
+            offset = end
+        del self.buffer[:offset]
+        return messages
+
+
+def get_decoder(sock):
+    """Декодер, закреплённый за сокетом"""
+    decoder = _DECODERS.get(sock)
+    if decoder is None:
+        decoder = _DECODERS[sock] = FrameDecoder()
+    return decoder
+
+
+def _recv_into_decoder(sock, decoder):
+    encoded_response = sock.recv(MAX_PACKAGE_LENGTH)
+    if not isinstance(encoded_response, bytes):
+        raise ValueError
+    if not encoded_response:
+        raise ConnectionResetError('Соединение закрыто удалённой стороной')
+    return decoder.feed(encoded_response)
+
+
+@log(sample=None)
 def get_message(client):
     """
     Утилита приёма и декодирования сообщения,
     Принимает байты, выдаёт словарь, если принято что-то
-    другое возвращает ValueError (ошибку значения)
+    другое возвращает ValueError (ошибку значения).
+    Читает из сокета, пока не будет принят целый кадр, лишние
+    сообщения сохраняются и выдаются следующими вызовами
     """
+    decoder = get_decoder(client)
+    while not decoder.pending:
+        decoder.pending.extend(_recv_into_decoder(client, decoder))
+    return decoder.pending.popleft()
 
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    if isinstance(encoded_response, bytes):
-        json_response = encoded_response.decode(ENCODING)
-        response = json.loads(json_response)
-        if isinstance(response, dict):
-            return response
-        raise ValueError
-    raise ValueError
+
+@log(sample=None)
+def get_messages(client):
+    """
+    Один приём из сокета, готового к чтению. Возвращает все
+    полностью принятые сообщения (возможно ни одного)
+    """
+    decoder = get_decoder(client)
+    messages = list(decoder.pending)
+    decoder.pending.clear()
+    messages.extend(_recv_into_decoder(client, decoder))
+    return messages
 
 
-@log
+@log(sample=None)
 def send_message(sock, message):
     """
     Утилита кодирования и отправки сообщения:
@@ -35,6 +114,13 @@ def send_message(sock, message):
     """
     if not isinstance(message, dict):
         raise TypeError
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    sock.sendall(encode_message(message))
+
+
+@log(sample=None)
+def send_frame(sock, frame):
+    """
+    Отправка заранее закодированного кадра, например
+    постоянного ответа из common.responses
+    """
+    sock.sendall(frame)
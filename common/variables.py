@@ -2,20 +2,93 @@
 
 # Порт по умолчанию для сетевого взаимодействия
 import logging
+from types import MappingProxyType
 
 DEFAULT_PORT = 7777
 # IP адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
 # Максимальная очередь подключений
 MAX_CONNECTIONS = 5
-# Максимальная длинна сообщения в байтах
-MAX_PACKAGE_LENGTH = 1024
+# Очередь подключений asyncio-движка, рассчитанного на тысячи клиентов
+LISTEN_BACKLOG = 1024
+# Размер буфера одного чтения из сокета в байтах
+MAX_PACKAGE_LENGTH = 65536
+# Максимальная длинна одного кадра (сообщения) в байтах
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+# Таймаут ожидания select-цикла сервера, секунд
+SELECT_TIMEOUT = 0.5
+# Очередь отправки клиента: при превышении верхней границы (байт)
+# срабатывает политика disconnect или drop, при drop отбрасывание
+# прекращается после разгрузки очереди до нижней границы
+OUTBOX_HIGH_WATERMARK = 1024 * 1024
+OUTBOX_LOW_WATERMARK = 256 * 1024
+OUTBOX_POLICY = 'disconnect'
+OUTBOX_POLICIES = ('disconnect', 'drop')
+# Время на ответ клиента при авторизации, секунд, и число потоков
+# для проверки ответов
+AUTH_TIMEOUT = 5
+AUTH_WORKERS = 4
+# Размер сегмента журнала сообщений для пользователей не в сети
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024
+# Отложенная запись статистики в БД сервера: не реже чем раз в
+# WRITE_BEHIND_INTERVAL секунд или по накоплении WRITE_BEHIND_SIZE событий
+WRITE_BEHIND_INTERVAL = 1.0
+WRITE_BEHIND_SIZE = 1000
+# Число изменений справочника пользователей, по которым сервер может
+# прислать клиенту разницу вместо полного списка
+DIRECTORY_LOG_SIZE = 10000
+# Окно объединения уведомлений 205 об изменении списка пользователей, секунд
+UPDATE_BROADCAST_WINDOW = 0.5
+# Время хранения открытого ключа собеседника на клиенте, секунд
+PUBKEY_CACHE_TTL = 24 * 3600
+# Время ожидания клиентом ответа сервера на запрос, секунд
+REQUEST_TIMEOUT = 5
+# Подключение клиента: число попыток при запуске и пауза между
+# попытками переподключения, растущая от RECONNECT_DELAY до
+# RECONNECT_MAX_DELAY секунд
+CONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+# Сколько номеров принятых сообщений клиент помнит для отбрасывания повторов
+RECEIVED_IDS_SIZE = 10000
+# Число сообщений истории, загружаемых окном клиента за раз
+HISTORY_PAGE_SIZE = 50
+# История сообщений клиента записывается в БД раз в столько секунд
+# или при накоплении стольких сообщений
+HISTORY_FLUSH_INTERVAL = 0.2
+HISTORY_FLUSH_SIZE = 500
+# Столько попыток записи сообщения в историю, после чего оно
+# отбрасывается
+HISTORY_FLUSH_RETRIES = 20
+# Перенос в архив истории клиента старше заданного числа дней:
+# раз в столько секунд, частями по столько сообщений в транзакции,
+# блоками архива по столько сообщений
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_BATCH = 10000
+ARCHIVE_BLOCK = 256
+# Наибольшее число результатов поиска по истории сообщений
+SEARCH_LIMIT = 100
+# Число последних найденных сообщений, ранжируемых поиском по истории
+SEARCH_WINDOW = 1000
+# Число итераций PBKDF2 хэша пароля: по умолчанию для новых пользователей
+# и хэшей прежних версий, и наибольшее, которое клиент примет от сервера
+PASSWORD_ITERATIONS = 10000
+PASSWORD_ITERATIONS_MAX = 10000000
 # Кодировка проекта
 ENCODING = 'utf-8'
 # Уровень логирования
 LOGGING_LEVEL = logging.DEBUG
+# Декоратор decos.log: наибольшая длина записываемого аргумента и
+# запись каждого LOG_MESSAGE_SAMPLE-го вызова функций приёма и отправки
+# сообщений. Записывать каждый вызов: Log_sample = 1 в настройках
+# сервера или ключ клиента --log-sample 1
+LOG_ARG_LENGTH = 200
+LOG_MESSAGE_SAMPLE = 100
 # База данных для хранения данных сервера:
 SERVER_CONFIG = 'server_dist.ini'
+# Движки сервера: select-цикл в потоке или asyncio
+SERVER_ENGINES = ('select', 'asyncio')
+DEFAULT_SERVER_ENGINE = 'select'
 
 # Протокол JIM основные ключи:
 ACTION = 'action'
@@ -36,26 +109,47 @@ RESPONSE = 'response'
 ERROR = 'error'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
-RESPONSE_200 = {RESPONSE: 200}
-RESPONSE_202 = {RESPONSE: 202,
-                LIST_INFO: None}
+# Шаблоны ответов сервера. Неизменяемые: ответы с параметрами
+# собираются из них в common.responses, а не правкой общего словаря
+RESPONSE_200 = MappingProxyType({RESPONSE: 200})
+RESPONSE_202 = MappingProxyType({RESPONSE: 202,
+                                 LIST_INFO: None})
 
-RESPONSE_400 = {
+RESPONSE_400 = MappingProxyType({
     RESPONSE: 400,
     ERROR: None
-}
+})
 
-RESPONSE_511 = {
+RESPONSE_511 = MappingProxyType({
     RESPONSE: 511,
     DATA: None
-}
+})
 
-RESPONSE_205 = {
+RESPONSE_205 = MappingProxyType({
     RESPONSE: 205
-}
+})
 
 # Прочие ключи, используемые в протоколе
 PRESENCE = 'presence'
 RESPONSE = 'response'
 ERROR = 'error'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+# Версия справочника пользователей и изменения после неё
+DIRECTORY_EPOCH = 'epoch'
+DIRECTORY_VERSION = 'version'
+USERS_ADDED = 'added'
+USERS_REMOVED = 'removed'
+# Номер запроса клиента, сервер повторяет его в ответе
+REQUEST_ID = 'id'
+# Номер сообщения, назначаемый отправителем
+MESSAGE_ID = 'message_id'
+# Число итераций хэша пароля пользователя и рекомендуемое сервером
+# при авторизации, замена хэша пароля на вычисленный с новым числом
+KDF_ITERATIONS = 'iterations'
+KDF_UPGRADE = 'iterations_upgrade'
+PASSWORD_UPGRADE = 'password_upgrade'
+# Запрос сообщений, накопленных пока пользователь был не в сети, и
+# подтверждение их получения клиентом: число принятых сообщений
+SPOOL_REQUEST = 'get_spooled'
+SPOOL_DELIVERED = 'spooled_delivered'
+SPOOL_COUNT = 'count'
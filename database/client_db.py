@@ -1,8 +1,90 @@
 import datetime
-from sqlalchemy import create_engine, Table, Column, Integer, String, Text, \
-    MetaData, DateTime
+import html
+import logging
+from sqlalchemy import Table, Column, Integer, String, Text, \
+    MetaData, DateTime, Float, Index, select, delete, tuple_, text
 from sqlalchemy.orm import mapper, sessionmaker
 
+from common.variables import HISTORY_PAGE_SIZE, SEARCH_LIMIT, \
+    SEARCH_WINDOW, HISTORY_FLUSH_INTERVAL, HISTORY_FLUSH_SIZE, \
+    ARCHIVE_INTERVAL, ARCHIVE_BATCH, ARCHIVE_BLOCK
+from database.history_archive import ARCHIVE_PREFIX, HistoryRetention, \
+    month_name, month_table, pack, unpack, blocks, match_words, mark
+from database.history_buffer import HistoryBuffer
+from database.sqlite_setup import create_sqlite_engine, create_indexes, \
+    chunks, SQL_CHUNK
+
+LOGGER = logging.getLogger('client')
+
+
+def unique_known_users(engine, metadata):
+    """Миграция: удаление повторов в known_users и уникальный индекс
+    по имени пользователя, если его ещё нет"""
+    table = metadata.tables['known_users']
+    with engine.begin() as connection:
+        indexes = {row[1] for row in connection.exec_driver_sql(
+            'PRAGMA index_list(known_users)')}
+        if {index.name for index in table.indexes} <= indexes:
+            return
+        connection.exec_driver_sql(
+            'DELETE FROM known_users WHERE id NOT IN '
+            '(SELECT MIN(id) FROM known_users GROUP BY username)')
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+# Полнотекстовый индекс истории сообщений. Таблица FTS5 хранит только
+# индекс (external content), тексты читаются из message_history, а
+# триггеры обновляют индекс при каждом изменении истории. Индексы
+# префиксов из 2 и 3 букв ускоряют поиск по началу слова, пока
+# пользователь набирает строку поиска
+SEARCH_TABLE = 'message_search'
+SEARCH_SCHEMA = (
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        message, content='message_history', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    f"""CREATE TRIGGER IF NOT EXISTS message_search_insert
+        AFTER INSERT ON message_history BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, message)
+        VALUES (new.id, new.message);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS message_search_delete
+        AFTER DELETE ON message_history BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, message)
+        VALUES ('delete', old.id, old.message);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS message_search_update
+        AFTER UPDATE OF message ON message_history BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, message)
+        VALUES ('delete', old.id, old.message);
+        INSERT INTO {SEARCH_TABLE}(rowid, message)
+        VALUES (new.id, new.message);
+        END""",
+)
+# Метки найденных слов во фрагменте: символы, которых нет в тексте
+# сообщений, заменяются на теги после экранирования текста
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+# Число слов во фрагменте с найденными словами
+SNIPPET_TOKENS = 12
+
+
+def search_query(phrase):
+    """Запрос FTS5 из строки поиска пользователя: все слова должны
+    встретиться в сообщении, последнее - как начало слова.
+    Слова берутся в кавычки, поэтому синтаксис FTS5 в тексте
+    не вызывает ошибок"""
+    words = [word.replace('"', '""') for word in phrase.split()]
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def highlight(snippet, start='<b>', end='</b>'):
+    """Фрагмент сообщения в виде HTML, найденные слова между
+    start и end"""
+    return html.escape(snippet).replace(MATCH_START, start).replace(
+        MATCH_END, end)
+
 
 class ClientDatabase:
     class KnownUsers:
@@ -23,29 +105,54 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
-    def __init__(self, name):
-        self.database_engine = create_engine(f'sqlite:///client_{name}.db3',
-                                             echo=False,
-                                             pool_recycle=7200,
-                                             connect_args={'check_same_thread': False})
+    def __init__(self, name, flush_interval=HISTORY_FLUSH_INTERVAL,
+                 flush_size=HISTORY_FLUSH_SIZE, hot_days=None,
+                 archive_interval=ARCHIVE_INTERVAL):
+        self.database_engine = create_sqlite_engine(f'client_{name}.db3')
         self.metadata = MetaData()
+        # Таблицы архива по месяцам создаются по мере переноса истории
+        self.archive_metadata = MetaData()
 
         users = Table('known_users', self.metadata,
                       Column('id', Integer, primary_key=True),
-                      Column('username', String))
+                      Column('username', String),
+                      Index('ux_known_users_username', 'username',
+                            unique=True))
 
         history = Table('message_history', self.metadata,
                         Column('id', Integer, primary_key=True),
                         Column('from_user', String),
                         Column('to_user', String),
                         Column('message', Text),
-                        Column('date', DateTime))
+                        Column('date', DateTime),
+                        # История переписки с собеседником по дате:
+                        # страница сообщений читается из индекса
+                        Index('ix_message_history_contact',
+                              'from_user', 'date', 'id'))
 
         contacts = Table('contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
                          Column('name', String, unique=True))
 
+        # Служебные значения клиента, например версия списка пользователей
+        self.state = Table('client_state', self.metadata,
+                           Column('name', String, primary_key=True),
+                           Column('value', String))
+
+        # Открытые ключи собеседников, полученные с сервера
+        self.pubkeys = Table('public_keys', self.metadata,
+                             Column('username', String, primary_key=True),
+                             Column('pubkey', Text),
+                             Column('fetched', Float))
+
         self.metadata.create_all(self.database_engine)
+        # Индексы, которых нет в БД, созданных прежними версиями
+        create_indexes(self.database_engine, self.metadata)
+        unique_known_users(self.database_engine, self.metadata)
+        self.create_search_index()
+        self.users_table = users
+        self.history_table = history
+        self.contacts_table = contacts
 
         mapper(self.KnownUsers, users)
         mapper(self.MessageHistory, history)
@@ -57,11 +164,53 @@ class ClientDatabase:
         self.session.query(self.Contacts).delete()
         self.session.commit()
 
+        # Сообщения записываются с задержкой до flush_interval секунд,
+        # если он задан, иначе сразу
+        self.history_buffer = None
+        if flush_interval:
+            self.history_buffer = HistoryBuffer(
+                self.database_engine, history, flush_interval, flush_size)
+
+        # Сообщения старше hot_days дней, если он задан, переносятся
+        # в архив при запуске и затем раз в archive_interval секунд
+        self.retention = None
+        if hot_days:
+            self.retention = HistoryRetention(self, hot_days,
+                                              archive_interval)
+
+    def flush(self):
+        """Запись сообщений из буфера истории"""
+        if self.history_buffer is not None:
+            self.history_buffer.flush()
+
+    def close(self):
+        """Завершение работы: остановка переноса в архив и запись
+        сообщений из буфера истории"""
+        if self.retention is not None:
+            self.retention.close()
+            self.retention = None
+        if self.history_buffer is not None:
+            self.history_buffer.close()
+            self.history_buffer = None
+
     def add_contact(self, contact):
-        if not self.session.query(self.Contacts).filter_by(name=contact).count():
-            contact_row = self.Contacts(contact)
-            self.session.add(contact_row)
-            self.session.commit()
+        self.session.execute(self.contacts_table.insert().prefix_with(
+            'OR IGNORE'), {'name': contact})
+        self.session.commit()
+
+    def replace_contacts(self, contacts):
+        """Замена списка контактов одной транзакцией: удаляются и
+        добавляются только отличающиеся записи"""
+        contacts = set(contacts)
+        known = set(self.get_contacts())
+        for part in chunks(list(known - contacts), SQL_CHUNK):
+            self.session.execute(delete(self.contacts_table).where(
+                self.contacts_table.c.name.in_(part)))
+        added = contacts - known
+        if added:
+            self.session.execute(self.contacts_table.insert(),
+                                 [{'name': contact} for contact in added])
+        self.session.commit()
 
     def contacts_clear(self):
         """очищаем таблицу со списком контактов"""
@@ -73,16 +222,89 @@ class ClientDatabase:
         self.session.commit()
 
     def add_users(self, users_list):
-        self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
+        """Замена списка известных пользователей: удаляются и добавляются
+        только отличающиеся записи"""
+        users_list = set(users_list)
+        known = set(self.get_users())
+        self.update_users(users_list - known, known - users_list)
+
+    def update_users(self, added, removed):
+        """Изменение списка известных пользователей одной транзакцией.
+        Удалённые пользователи убираются и из контактов"""
+        removed = list(removed)
+        if removed:
+            self.session.execute(delete(self.users_table).where(
+                self.users_table.c.username.in_(removed)))
+            self.session.execute(delete(self.contacts_table).where(
+                self.contacts_table.c.name.in_(removed)))
+        added = set(added)
+        if added:
+            self.session.execute(
+                self.users_table.insert().prefix_with('OR IGNORE'),
+                [{'username': user} for user in added])
+        self.session.commit()
+
+    def get_pubkey(self, username):
+        """Сохранённый ключ пользователя и время его получения или None"""
+        row = self.session.execute(
+            select(self.pubkeys.c.pubkey, self.pubkeys.c.fetched).where(
+                self.pubkeys.c.username == username)).first()
+        return tuple(row) if row else None
+
+    def save_pubkey(self, username, pubkey, fetched):
+        self.session.execute(delete(self.pubkeys).where(
+            self.pubkeys.c.username == username))
+        self.session.execute(self.pubkeys.insert(), {
+            'username': username, 'pubkey': pubkey, 'fetched': fetched})
+        self.session.commit()
+
+    def drop_pubkeys(self, usernames=None):
+        """Удаление сохранённых ключей пользователей, всех - если
+        usernames не задан"""
+        query = delete(self.pubkeys)
+        if usernames is not None:
+            query = query.where(self.pubkeys.c.username.in_(list(usernames)))
+        self.session.execute(query)
+        self.session.commit()
+
+    def get_state(self, name, default=None):
+        value = self.session.execute(select(self.state.c.value).where(
+            self.state.c.name == name)).scalar()
+        return default if value is None else value
+
+    def set_state(self, **values):
+        self.session.execute(delete(self.state).where(
+            self.state.c.name.in_(list(values))))
+        self.session.execute(self.state.insert(),
+                             [{'name': name, 'value': str(value)}
+                              for name, value in values.items()])
         self.session.commit()
 
-    def save_message(self, from_user, to_user, message):
+    def get_directory_version(self):
+        """Эпоха и версия списка пользователей, полученного с сервера"""
+        return self.get_state('directory_epoch'), \
+            int(self.get_state('directory_version', 0))
+
+    def set_directory_version(self, epoch, version):
+        self.set_state(directory_epoch=epoch, directory_version=version)
+
+    def save_message(self, from_user, to_user, message, date=None):
+        """Сохранение сообщения. from_user - собеседник, to_user -
+        направление ('in' или 'out'), date - время сообщения, по
+        умолчанию текущее. Возвращает запись в виде
+        (id, направление, текст, дата), как get_history_page"""
+        if date is None:
+            date = datetime.datetime.now()
+        if self.history_buffer is not None:
+            row_id = self.history_buffer.add(from_user, to_user, message,
+                                             date)
+            return row_id, to_user, message, date
         message_row = self.MessageHistory(from_user, to_user, message)
+        message_row.date = date
         self.session.add(message_row)
         self.session.commit()
+        return (message_row.id, message_row.to_user, message_row.message,
+                message_row.date)
 
     def get_contacts(self):
         return [contact[0] for contact in self.session.query(self.Contacts.name).all()]
@@ -102,13 +324,251 @@ class ClientDatabase:
         else:
             return False
 
+    def get_history_page(self, contact, before_date=None, before_id=None,
+                         limit=HISTORY_PAGE_SIZE):
+        """
+        Не более limit сообщений переписки с contact от новых к старым:
+        (id, направление, текст, дата). Сообщения берутся раньше
+        before_date, а если задан и before_id - раньше сообщения
+        (before_date, before_id), обычно первого из уже загруженных.
+        Постраничное чтение по ключу, а не по смещению, не перебирает
+        пропущенные строки
+        """
+        self.flush()
+        history = self.history_table.c
+        query = select(history.id, history.to_user, history.message,
+                       history.date).where(history.from_user == contact)
+        if before_date is not None and before_id is not None:
+            query = query.where(tuple_(history.date, history.id) <
+                                tuple_(before_date, before_id))
+        elif before_date is not None:
+            query = query.where(history.date < before_date)
+        query = query.order_by(history.date.desc(), history.id.desc())
+        page = [tuple(row) for row in self.session.execute(
+            query.limit(limit))]
+        if len(page) < limit:
+            # Более ранние сообщения могли быть перенесены в архив
+            if page:
+                before_id, _, _, before_date = page[-1]
+            page += self.get_archive_page(contact, before_date, before_id,
+                                          limit - len(page))
+        return page
+
+    def archive_months(self):
+        """Имена таблиц архива от новых месяцев к старым"""
+        with self.database_engine.connect() as connection:
+            return [row[0] for row in connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name GLOB ? ORDER BY name DESC",
+                (f'{ARCHIVE_PREFIX}[0-9]*',))]
+
+    def archive_blocks(self, connection, name, contact=None,
+                       before_date=None, before_id=None):
+        """Блоки таблицы архива name от новых к старым: переписки с
+        contact, если он задан, и начинающиеся раньше
+        (before_date, before_id)"""
+        table = month_table(self.archive_metadata, name)
+        query = select(table.c.contact, table.c.data)
+        if contact is not None:
+            query = query.where(table.c.contact == contact)
+        if before_date is not None and before_id is not None:
+            query = query.where(tuple_(table.c.first_date, table.c.first_id)
+                                < tuple_(before_date, before_id))
+        elif before_date is not None:
+            query = query.where(table.c.first_date < before_date)
+        return connection.execute(query.order_by(
+            table.c.last_date.desc(), table.c.last_id.desc()))
+
+    def get_archive_page(self, contact, before_date=None, before_id=None,
+                         limit=HISTORY_PAGE_SIZE):
+        """Страница архива переписки с contact, как get_history_page.
+        Блоки одного собеседника не пересекаются по датам, поэтому
+        читаются только блоки, нужные для страницы"""
+        def older(row):
+            if before_date is None:
+                return True
+            if before_id is None:
+                return row[3] < before_date
+            return (row[3], row[0]) < (before_date, before_id)
+
+        page = []
+        with self.database_engine.connect() as connection:
+            for name in self.archive_months():
+                if before_date is not None and \
+                        name > month_name(before_date):
+                    continue
+                for _, data in self.archive_blocks(
+                        connection, name, contact, before_date, before_id):
+                    page += [row for row in reversed(unpack(data))
+                             if older(row)]
+                    if len(page) >= limit:
+                        return page[:limit]
+        return page
+
+    def archive_history(self, hot_days, now=None, batch=ARCHIVE_BATCH):
+        """
+        Перенос сообщений старше hot_days дней в сжатые блоки архива по
+        месяцам. Сообщения переносятся частями по batch, каждая часть -
+        одна транзакция: блоки архива записываются, а сообщения и их
+        записи полнотекстового индекса удаляются вместе.
+        Освободившиеся страницы возвращаются файловой системе.
+        Возвращает число перенесённых сообщений
+        """
+        self.flush()
+        cutoff = (now or datetime.datetime.now()) - \
+            datetime.timedelta(days=hot_days)
+        history = self.history_table.c
+        query = select(history.from_user, history.id, history.to_user,
+                       history.message, history.date).where(
+            history.date < cutoff).order_by(
+            history.from_user, history.date, history.id).limit(batch)
+        moved = 0
+        while True:
+            with self.database_engine.begin() as connection:
+                rows = connection.execute(query).all()
+                if not rows:
+                    break
+                for name, contact, block in blocks(rows, ARCHIVE_BLOCK):
+                    table = month_table(self.archive_metadata, name)
+                    table.create(bind=connection, checkfirst=True)
+                    connection.execute(table.insert(), {
+                        'contact': contact,
+                        'first_date': block[0][3], 'first_id': block[0][0],
+                        'last_date': block[-1][3], 'last_id': block[-1][0],
+                        'count': len(block), 'data': pack(block)})
+                for part in chunks([row.id for row in rows], SQL_CHUNK):
+                    connection.execute(delete(self.history_table).where(
+                        history.id.in_(part)))
+            moved += len(rows)
+        if moved:
+            LOGGER.info(f'В архив перенесено сообщений: {moved}')
+            self.vacuum()
+        return moved
+
+    def vacuum(self):
+        """Слияние сегментов полнотекстового индекса, при котором из
+        него уходят удалённые сообщения, и возврат свободных страниц
+        файловой системе. БД прежних версий один раз переводится в
+        режим auto_vacuum=INCREMENTAL полным VACUUM"""
+        with self.database_engine.begin() as connection:
+            connection.exec_driver_sql(
+                f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) "
+                f"VALUES ('optimize')")
+        with self.database_engine.connect() as connection:
+            # 2 - INCREMENTAL
+            if connection.exec_driver_sql(
+                    'PRAGMA auto_vacuum').scalar() != 2:
+                connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+                connection.exec_driver_sql('VACUUM')
+            else:
+                connection.exec_driver_sql(
+                    'PRAGMA incremental_vacuum').fetchall()
+
+    def create_search_index(self):
+        """Создание полнотекстового индекса истории. В БД прежних
+        версий индекс заполняется уже сохранёнными сообщениями"""
+        with self.database_engine.begin() as connection:
+            exists = connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = ?",
+                (SEARCH_TABLE,)).scalar()
+            for statement in SEARCH_SCHEMA:
+                connection.exec_driver_sql(statement)
+            if not exists:
+                connection.exec_driver_sql(
+                    f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) "
+                    f"VALUES ('rebuild')")
+
+    def rebuild_search_index(self):
+        """Перестроение полнотекстового индекса по message_history
+        и слияние его сегментов для быстрого поиска"""
+        self.flush()
+        with self.database_engine.begin() as connection:
+            for command in ('rebuild', 'optimize'):
+                connection.exec_driver_sql(
+                    f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) "
+                    f"VALUES ('{command}')")
+
+    def search_messages(self, phrase, contact=None, limit=SEARCH_LIMIT,
+                        window=SEARCH_WINDOW, archive=False):
+        """
+        Поиск сообщений по словам из phrase, при заданном contact - только
+        в переписке с ним. Возвращает не более limit записей
+        (id, собеседник, направление, фрагмент, дата) от наиболее
+        подходящих по BM25. Фрагмент - экранированный HTML, найденные
+        слова выделены тегом <b>.
+        Ранжируются window последних найденных сообщений: индекс отдаёт
+        их по убыванию id без просмотра всех совпадений, поэтому поиск
+        частого слова в многолетней истории не вычисляет BM25 для сотен
+        тысяч сообщений
+        """
+        query_text = search_query(phrase)
+        if query_text is None:
+            return []
+        self.flush()
+        sql = (f"SELECT history.id AS id, history.from_user AS from_user, "
+               f"history.to_user AS to_user, history.date AS date, "
+               f"bm25({SEARCH_TABLE}) AS score, "
+               f"snippet({SEARCH_TABLE}, 0, :start, :end, '…', :tokens) "
+               f"AS snippet "
+               f"FROM {SEARCH_TABLE} JOIN message_history AS history "
+               f"ON history.id = {SEARCH_TABLE}.rowid "
+               f"WHERE {SEARCH_TABLE} MATCH :query")
+        if contact is not None:
+            sql += " AND history.from_user = :contact"
+        sql += f" ORDER BY {SEARCH_TABLE}.rowid DESC LIMIT :window"
+        # Типы столбцов нужны, чтобы дата пришла как datetime
+        query = text(f"SELECT id, from_user, to_user, snippet, date "
+                     f"FROM ({sql}) ORDER BY score, id DESC LIMIT :limit"
+                     ).columns(id=Integer, from_user=String,
+                               to_user=String, snippet=Text, date=DateTime)
+        rows = self.session.execute(query, {
+            'start': MATCH_START, 'end': MATCH_END,
+            'tokens': SNIPPET_TOKENS, 'query': query_text,
+            'contact': contact, 'window': window, 'limit': limit})
+        found = [(row.id, row.from_user, row.to_user,
+                  highlight(row.snippet), row.date) for row in rows]
+        if archive and len(found) < limit:
+            found += self.search_archive(phrase, contact, limit - len(found))
+        return found
+
+    def search_archive(self, phrase, contact=None, limit=SEARCH_LIMIT):
+        """Поиск в архиве истории, как search_messages: блоки архива
+        распаковываются от новых к старым, пока не найдено limit
+        сообщений. Результаты идут по убыванию даты"""
+        matcher = match_words(phrase)
+        if matcher is None:
+            return []
+        found = []
+        with self.database_engine.connect() as connection:
+            for name in self.archive_months():
+                for block_contact, data in self.archive_blocks(
+                        connection, name, contact):
+                    for row_id, direction, message, date in \
+                            reversed(unpack(data, matcher.words)):
+                        spans = matcher(message)
+                        if spans:
+                            found.append((row_id, block_contact, direction,
+                                          highlight(mark(
+                                              message, spans, MATCH_START,
+                                              MATCH_END, SNIPPET_TOKENS)),
+                                          date))
+                            if len(found) >= limit:
+                                return found
+        return found
+
     def get_history(self, from_who=None, to_who=None):
-        query = self.session.query(self.MessageHistory)
+        """Вся история, отфильтрованная по собеседнику и направлению,
+        по возрастанию даты: (собеседник, направление, текст, дата)"""
+        self.flush()
+        history = self.history_table.c
+        query = select(history.from_user, history.to_user, history.message,
+                       history.date)
         if from_who:
-            query = query.filter_by(from_user=from_who)
+            query = query.where(history.from_user == from_who)
         if to_who:
-            query = query.filter_by(to_user=to_who)
-        return [(history_row.from_user, history_row.to_user, history_row.message, history_row.date) for history_row in query.all()]
+            query = query.where(history.to_user == to_who)
+        return [tuple(row) for row in self.session.execute(
+            query.order_by(history.date, history.id))]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+import os
+import threading
+from collections import deque
+
+from common.variables import DIRECTORY_LOG_SIZE
+
+
+class DirectoryLog:
+    """
+    Журнал изменений справочника пользователей сервера.
+    Каждое добавление и удаление пользователя, а также смена его
+    открытого ключа (записывается как добавление) увеличивает версию, клиент
+    запрашивает изменения после известной ему версии. Журнал хранит
+    последние limit изменений: отставшему сильнее клиенту, как и клиенту
+    с версией от предыдущего запуска сервера (другая эпоха), нужен
+    полный список
+    """
+
+    def __init__(self, limit=DIRECTORY_LOG_SIZE):
+        # Эпоха меняется при каждом запуске, версии разных запусков
+        # не сравниваются
+        self.epoch = os.urandom(8).hex()
+        self.version = 0
+        # (версия, логин, True - добавлен / False - удалён)
+        self.entries = deque(maxlen=limit)
+        self.lock = threading.Lock()
+
+    def record(self, login, added):
+        with self.lock:
+            self.version += 1
+            self.entries.append((self.version, login, added))
+
+    def changes_since(self, epoch, version):
+        """
+        Текущая версия и изменения после версии version: словарь
+        логин -> добавлен ли. None вместо словаря, если изменения
+        неизвестны и нужен полный список
+        """
+        with self.lock:
+            if epoch != self.epoch or not isinstance(version, int) or \
+                    not 0 <= version <= self.version:
+                return self.version, None
+            oldest = self.entries[0][0] if self.entries else \
+                self.version + 1
+            if version + 1 < oldest:
+                return self.version, None
+            # Для каждого логина важно только последнее изменение
+            changes = {}
+            for entry_version, login, added in reversed(self.entries):
+                if entry_version <= version:
+                    break
+                changes.setdefault(login, added)
+            return self.version, changes
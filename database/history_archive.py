@@ -0,0 +1,164 @@
+"""Архив истории сообщений клиента.
+Сообщения старше срока хранения переносятся из message_history в
+таблицы архива по месяцам message_archive_ГГГГММ. Строка архива -
+блок сообщений переписки с одним собеседником за месяц, сжатый zlib,
+поэтому архив занимает в несколько раз меньше места и не входит в
+полнотекстовый индекс. Архив читается по требованию: при прокрутке
+истории за пределы хранимых сообщений и при поиске в архиве"""
+import json
+import logging
+import re
+import threading
+import zlib
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, \
+    LargeBinary, Index
+
+LOGGER = logging.getLogger('client')
+
+ARCHIVE_PREFIX = 'message_archive_'
+# Уровень сжатия zlib блоков архива
+ARCHIVE_COMPRESSION = 6
+WORD = re.compile(r'\w+')
+
+
+def month_name(date):
+    """Имя таблицы архива за месяц даты"""
+    return f'{ARCHIVE_PREFIX}{date:%Y%m}'
+
+
+def month_table(metadata, name):
+    """Таблица архива за месяц: блоки сообщений с собеседником contact
+    от (first_date, first_id) до (last_date, last_id) включительно"""
+    if name in metadata.tables:
+        return metadata.tables[name]
+    return Table(name, metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('contact', String),
+                 Column('first_date', DateTime),
+                 Column('first_id', Integer),
+                 Column('last_date', DateTime),
+                 Column('last_id', Integer),
+                 Column('count', Integer),
+                 Column('data', LargeBinary),
+                 Index(f'ix_{name}_contact', 'contact', 'last_date',
+                       'last_id'))
+
+
+def pack(rows):
+    """Сжатие блока записей (id, направление, текст, дата)"""
+    return zlib.compress(json.dumps(
+        [(row_id, direction, message, date.isoformat())
+         for row_id, direction, message, date in rows],
+        ensure_ascii=False).encode('utf-8'), ARCHIVE_COMPRESSION)
+
+
+def unpack(data, words=()):
+    """Записи блока (id, направление, текст, дата) по возрастанию даты.
+    Если в тексте блока нет какого-либо из слов words, записи не
+    разбираются и возвращается пустой список"""
+    text = zlib.decompress(data).decode('utf-8')
+    if words:
+        folded = text.casefold()
+        if not all(word in folded for word in words):
+            return []
+    return [(row_id, direction, message, datetime.fromisoformat(date))
+            for row_id, direction, message, date in json.loads(text)]
+
+
+def blocks(rows, size):
+    """Разбиение записей (собеседник, id, направление, текст, дата),
+    упорядоченных по собеседнику и дате, на блоки одного собеседника
+    за один месяц не длиннее size: (имя таблицы, собеседник, записи)"""
+    block = []
+    key = None
+    for contact, *row in rows:
+        row_key = (month_name(row[3]), contact)
+        if block and (row_key != key or len(block) >= size):
+            yield key + (block,)
+            block = []
+        key = row_key
+        block.append(tuple(row))
+    if block:
+        yield key + (block,)
+
+
+def match_words(phrase):
+    """Функция проверки текста сообщения на слова из строки поиска,
+    как в полнотекстовом поиске: все слова, последнее - как начало
+    слова. Возвращает позиции найденных слов или None.
+    Слова поиска доступны в атрибуте words функции"""
+    words = WORD.findall(phrase.casefold())
+    if not words:
+        return None
+
+    def matcher(message):
+        found = []
+        missing = set(words[:-1])
+        prefix_found = False
+        for token in WORD.finditer(message):
+            word = token.group().casefold()
+            if word in words[:-1]:
+                missing.discard(word)
+                found.append(token.span())
+            elif word.startswith(words[-1]):
+                prefix_found = True
+                found.append(token.span())
+        if missing or not prefix_found:
+            return None
+        return found
+    matcher.words = words
+    return matcher
+
+
+def mark(message, spans, start, end, tokens):
+    """Фрагмент сообщения из tokens слов вокруг первого найденного,
+    найденные слова между start и end"""
+    words = [token.span() for token in WORD.finditer(message)]
+    first = next(number for number, span in enumerate(words)
+                 if span == spans[0])
+    begin = max(0, min(first, len(words) - tokens))
+    last = min(len(words), begin + tokens)
+    text_start = words[begin][0] if begin else 0
+    text_end = words[last - 1][1] if last < len(words) else len(message)
+    parts = ['…' if begin else '']
+    position = text_start
+    for span_start, span_end in spans:
+        if span_start < text_start or span_end > text_end:
+            continue
+        parts += [message[position:span_start], start,
+                  message[span_start:span_end], end]
+        position = span_end
+    parts += [message[position:text_end], '…' if last < len(words) else '']
+    return ''.join(parts)
+
+
+class HistoryRetention:
+    """
+    Перенос в архив сообщений старше hot_days дней при запуске клиента
+    и затем раз в interval секунд отдельным потоком, чтобы рабочая
+    часть БД клиента оставалась небольшой
+    """
+
+    def __init__(self, database, hot_days, interval):
+        self.database = database
+        self.hot_days = hot_days
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='history-retention')
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.database.archive_history(self.hot_days)
+            except Exception as err:
+                LOGGER.error(f'Ошибка переноса истории в архив: {err}')
+            if self.stopping.wait(self.interval):
+                break
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
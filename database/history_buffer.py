@@ -0,0 +1,135 @@
+import logging
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from common.variables import HISTORY_FLUSH_RETRIES
+
+LOGGER = logging.getLogger('client')
+
+
+class HistoryBuffer:
+    """
+    Буфер записи истории сообщений в БД клиента.
+    Сообщения накапливаются в памяти и записываются одной транзакцией
+    раз в interval секунд или при накоплении max_messages сообщений,
+    поэтому поток входящих сообщений не вызывает запись на диск на
+    каждое сообщение. id сообщений назначаются при добавлении в буфер,
+    так что окно клиента получает запись сразу.
+    Перед чтением истории буфер записывается методом flush.
+    interval - окно, в пределах которого сообщения могут быть потеряны
+    при аварийной остановке клиента. Сообщение, которое не удалось
+    записать за retries попыток, отбрасывается
+    """
+
+    def __init__(self, engine, table, interval, max_messages,
+                 retries=HISTORY_FLUSH_RETRIES):
+        self.engine = engine
+        self.table = table
+        self.interval = interval
+        self.max_messages = max_messages
+        self.retries = retries
+        self.next_id = self.last_id() + 1
+
+        self.lock = threading.Lock()
+        # Запись выполняется по таймеру, перед чтением и при остановке,
+        # не одновременно
+        self.flush_lock = threading.Lock()
+        self.rows = []
+        # Число неудачных попыток записи по id сообщения
+        self.failures = {}
+
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='history-buffer')
+        self.thread.start()
+
+    def add(self, from_user, to_user, message, date):
+        """Добавление сообщения, возвращает назначенный ему id"""
+        with self.lock:
+            row_id = self.next_id
+            self.next_id += 1
+            self.rows.append({'id': row_id, 'from_user': from_user,
+                              'to_user': to_user, 'message': message,
+                              'date': date})
+            if len(self.rows) >= self.max_messages:
+                self.wakeup.set()
+        return row_id
+
+    def last_id(self):
+        with self.engine.connect() as connection:
+            return connection.exec_driver_sql(
+                f'SELECT max(id) FROM {self.table.name}').scalar() or 0
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Запись накопленных сообщений одной транзакцией"""
+        with self.flush_lock:
+            with self.lock:
+                rows, self.rows = self.rows, []
+            if not rows:
+                return
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(self.table.insert(), rows)
+            except Exception as err:
+                LOGGER.error(f'Ошибка записи истории сообщений: {err}')
+                # Сообщения записываются по одному, чтобы ошибка одного
+                # не задерживала остальные
+                self.retry([row for row in rows if not self.write(row)])
+            else:
+                self.failures.clear()
+
+    def write(self, row):
+        """Запись одного сообщения, возвращает True при успехе.
+        Если его id уже занят записью, сделанной в обход буфера, id
+        назначает SQLite, а следующие id назначаются после занятых"""
+        try:
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(self.table.insert(), row)
+            except IntegrityError:
+                with self.engine.begin() as connection:
+                    connection.execute(self.table.insert(), {
+                        key: value for key, value in row.items()
+                        if key != 'id'})
+                last_id = self.last_id()
+                with self.lock:
+                    self.next_id = max(self.next_id, last_id + 1)
+        except Exception as err:
+            LOGGER.debug(f'Сообщение {row["id"]} не записано: {err}')
+            return False
+        self.failures.pop(row['id'], None)
+        return True
+
+    def retry(self, rows):
+        """Возврат незаписанных сообщений в буфер до следующей попытки.
+        Сообщения, исчерпавшие попытки, отбрасываются"""
+        kept = []
+        for row in rows:
+            failures = self.failures.get(row['id'], 0) + 1
+            if failures >= self.retries:
+                del self.failures[row['id']]
+                LOGGER.error(f'Сообщение {row["id"]} не записано в историю '
+                             f'за {failures} попыток и отброшено')
+            else:
+                self.failures[row['id']] = failures
+                kept.append(row)
+        with self.lock:
+            self.rows[:0] = kept
+
+    def __len__(self):
+        return len(self.rows)
+
+    def close(self):
+        """Остановка потока и запись оставшихся сообщений"""
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
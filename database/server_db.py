@@ -1,9 +1,54 @@
 from datetime import datetime
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, \
-    create_engine, Text
+    Index, Text, select, delete, bindparam
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from common.variables import WRITE_BEHIND_SIZE, PASSWORD_ITERATIONS
+from database.write_behind import WriteBehind
+from database.directory_log import DirectoryLog
+from database.sqlite_setup import create_sqlite_engine, migrate, \
+    create_indexes, chunks, SQL_CHUNK
+
+
+def unique_contacts(engine, metadata):
+    """Миграция: удаление повторов в users_contacts и уникальный индекс
+    (пользователь, контакт) вместо обычного"""
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            'DELETE FROM users_contacts WHERE id NOT IN '
+            '(SELECT MIN(id) FROM users_contacts GROUP BY user, contact)')
+        connection.exec_driver_sql(
+            'DROP INDEX IF EXISTS ix_users_contacts_user')
+    for index in metadata.tables['users_contacts'].indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+def password_iterations(engine, metadata):
+    """Миграция: число итераций PBKDF2 хэша пароля. Хэши, созданные
+    до её появления, вычислены с PASSWORD_ITERATIONS итерациями"""
+    with engine.begin() as connection:
+        columns = {row[1] for row in connection.exec_driver_sql(
+            'PRAGMA table_info(all_users)')}
+        if 'kdf_iterations' not in columns:
+            connection.exec_driver_sql(
+                f'ALTER TABLE all_users ADD COLUMN kdf_iterations INTEGER '
+                f'NOT NULL DEFAULT {PASSWORD_ITERATIONS}')
+
+
+class UserRecord:
+    """Пользователь в справочнике сервера"""
+
+    def __init__(self, user_id, login, passwd_hash, pubkey=None,
+                 iterations=PASSWORD_ITERATIONS):
+        self.id = user_id
+        self.login = login
+        self.passwd_hash = passwd_hash
+        self.iterations = iterations
+        self.pubkey = pubkey
+        self.contacts = set()
+
 
 class ServerStorage:
     Base = declarative_base()
@@ -15,6 +60,8 @@ class ServerStorage:
         last_connect = Column(DateTime)
         passwd_hash = Column(String)
         pubkey = Column(Text)
+        kdf_iterations = Column(Integer, nullable=False,
+                                server_default=str(PASSWORD_ITERATIONS))
         
         def __init__(self, login, passwd_hash):
             self.login = login
@@ -38,6 +85,9 @@ class ServerStorage:
     
     class LoginHistory(Base):
         __tablename__ = 'login_history'
+        __table_args__ = (
+            Index('ix_login_history_user', 'user', 'last_connection'),
+        )
         id = Column(Integer, primary_key=True)
         user = Column(String, ForeignKey('all_users.id'))
         ip = Column(String)
@@ -52,6 +102,12 @@ class ServerStorage:
 
     class UsersContacts(Base):
         __tablename__ = 'users_contacts'
+        # Первый индекс покрывает выборку контактов пользователя и проверку
+        # наличия контакта, второй - удаление пользователя из чужих списков
+        __table_args__ = (
+            Index('ux_users_contacts', 'user', 'contact', unique=True),
+            Index('ix_users_contacts_contact', 'contact'),
+        )
         id = Column(Integer, primary_key=True)
         user = Column(String, ForeignKey('all_users.id'))
         contact = Column(String, ForeignKey('all_users.id'))
@@ -62,6 +118,9 @@ class ServerStorage:
 
     class UsersHistory(Base):
         __tablename__ = 'users_history'
+        __table_args__ = (
+            Index('ix_users_history_user', 'user'),
+        )
         id = Column(Integer, primary_key=True)
         user = Column(String, ForeignKey('all_users.id'))
         sent = Column(Integer)
@@ -72,127 +131,320 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
-        self.engine = create_engine('sqlite:///server_db.db3', echo=False,
-                                    pool_recycle=7200,
-                                    connect_args={'check_same_thread': False})
-        
-        self.Base.metadata.create_all(self.engine)
+    # Обновления схемы БД, созданных предыдущими версиями сервера
+    MIGRATIONS = [create_indexes, unique_contacts, password_iterations]
+
+    def __init__(self, path, flush_interval=None,
+                 flush_size=WRITE_BEHIND_SIZE):
+        self.engine = create_sqlite_engine(path)
+        migrate(self.engine, self.Base.metadata, self.MIGRATIONS)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
         
         self.session.query(self.ActiveUsers).delete()
         self.session.commit()
-        
+
+        # Справочник пользователей в памяти: обработка запросов клиентов
+        # не обращается к БД за id, хэшем, ключом и контактами
+        self.users = {}
+        self.load_users()
+        # Изменения справочника для синхронизации списков пользователей
+        # клиентов
+        self.directory_log = DirectoryLog()
+
+        # Статистика сообщений и история входов записываются с задержкой
+        # до flush_interval секунд, если он задан, иначе сразу
+        self.write_behind = None
+        if flush_interval:
+            self.write_behind = WriteBehind(self, flush_interval, flush_size)
+
+    def load_users(self):
+        """Загрузка справочника пользователей и их контактов"""
+        # Запросы Core без построения ORM-объектов: при сотнях тысяч строк
+        # это заметно быстрее
+        users = self.AllUsers.__table__.c
+        contacts = self.UsersContacts.__table__.c
+        self.users = {
+            login: UserRecord(user_id, login, passwd_hash, pubkey, iterations)
+            for user_id, login, passwd_hash, pubkey, iterations in
+            self.session.execute(select(
+                users.id, users.login, users.passwd_hash, users.pubkey,
+                users.kdf_iterations))}
+        by_id = {user.id: user for user in self.users.values()}
+        for user_id, contact_id in self.session.execute(
+                select(contacts.user, contacts.contact)):
+            user = by_id.get(int(user_id))
+            contact = by_id.get(int(contact_id))
+            if user and contact:
+                user.contacts.add(contact.login)
+
+    def flush(self):
+        """Запись отложенных изменений"""
+        if self.write_behind:
+            self.write_behind.flush()
+
+    def close(self):
+        """Завершение работы: запись отложенных изменений"""
+        if self.write_behind:
+            self.write_behind.close()
+            self.write_behind = None
+
     def user_login(self, username, ip_addr, port, key):
-        result = self.session.query(self.AllUsers).filter_by(login=username)
-        
-        if result.count():
-            user = result.first()
-            user.last_connect = datetime.now()
-            if user.pubkey != key:
-                user.pubkey = key
-        else:
+        """Отметка входа пользователя. Возвращает True, если изменился
+        открытый ключ: клиенты узнают об этом из журнала справочника"""
+        user = self.users.get(username)
+        if user is None:
             raise ValueError('Пользователь не зарегистрирован.')
-            # user = self.AllUsers(username)
-            # self.session.add(user)
-            # self.session.commit()
-            # user_in_history = self.UsersHistory(user.id)
-            # self.session.add(user_in_history)
-
-        new_active_user = self.ActiveUsers(user.id, ip_addr, port, 
-                                           datetime.now())
+        key_changed = self.set_pubkey(username, key)
+        if self.write_behind:
+            self.write_behind.record_login(username, ip_addr, port, key)
+            return key_changed
+
+        now = datetime.now()
+        self.session.query(self.AllUsers).filter_by(id=user.id).update(
+            {self.AllUsers.last_connect: now, self.AllUsers.pubkey: key},
+            synchronize_session=False)
+
+        new_active_user = self.ActiveUsers(user.id, ip_addr, port, now)
         self.session.add(new_active_user)
         
-        history = self.LoginHistory(user.id, ip_addr, port, datetime.now())
+        history = self.LoginHistory(user.id, ip_addr, port, now)
         self.session.add(history)
         
         self.session.commit()
+        return key_changed
 
-    def add_user(self, name, passwd_hash):
+    def add_user(self, name, passwd_hash, iterations=PASSWORD_ITERATIONS):
         """Регистрация нового пользователя"""
-        user_row = self.AllUsers(name, passwd_hash)
-        self.session.add(user_row)
-        self.session.commit()
-        history_row = self.UsersHistory(user_row.id)
-        self.session.add(history_row)
+        self.add_users([(name, passwd_hash)], iterations)
+
+    def add_users(self, users, iterations=PASSWORD_ITERATIONS):
+        """
+        Регистрация пользователей из списка пар (логин, хэш пароля)
+        одной транзакцией. Хэши вычислены с iterations итерациями.
+        Уже зарегистрированные пропускаются.
+        Возвращает число добавленных пользователей
+        """
+        now = datetime.now()
+        new_users = {name: passwd_hash for name, passwd_hash in users
+                     if name not in self.users}
+        if not new_users:
+            return 0
+        all_users = self.AllUsers.__table__
+        self.session.execute(
+            insert(all_users).on_conflict_do_nothing(
+                index_elements=['login']),
+            [{'login': name, 'passwd_hash': passwd_hash,
+              'last_connect': now, 'pubkey': None,
+              'kdf_iterations': iterations}
+             for name, passwd_hash in new_users.items()])
+        ids = {}
+        for names in chunks(list(new_users), SQL_CHUNK):
+            ids.update(self.session.execute(
+                select(all_users.c.login, all_users.c.id).where(
+                    all_users.c.login.in_(names))).all())
+        self.session.execute(
+            insert(self.UsersHistory.__table__),
+            [{'user': user_id, 'sent': 0, 'accepted': 0}
+             for user_id in ids.values()])
         self.session.commit()
+        for name, user_id in ids.items():
+            self.users[name] = UserRecord(user_id, name, new_users[name],
+                                          iterations=iterations)
+            self.directory_log.record(name, True)
+        return len(ids)
 
     def remove_user(self, name):
         """Удаления пользователя из БД"""
-        user = self.session.query(self.AllUsers).filter_by(login=name).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.query(self.LoginHistory).filter_by(user=user.id).delete()
-        self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
-        self.session.query(
-            self.UsersContacts).filter_by(contact=user.id).delete()
-        self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
-        self.session.query(self.AllUsers).filter_by(login=name).delete()
+        self.remove_users([name])
+
+    def remove_users(self, names):
+        """Удаление пользователей со всеми связанными записями одной
+        транзакцией"""
+        # Отложенные события пользователей записываются до удаления
+        self.flush()
+        removed = {name: self.users.pop(name) for name in names
+                   if name in self.users}
+        if not removed:
+            return
+        for other in self.users.values():
+            other.contacts.difference_update(removed)
+        for name in removed:
+            self.directory_log.record(name, False)
+        ids = [user.id for user in removed.values()]
+        for part in chunks(ids, SQL_CHUNK):
+            for table, column in (
+                    (self.ActiveUsers, 'user'),
+                    (self.LoginHistory, 'user'),
+                    (self.UsersContacts, 'user'),
+                    (self.UsersContacts, 'contact'),
+                    (self.UsersHistory, 'user'),
+                    (self.AllUsers, 'id')):
+                table = table.__table__
+                self.session.execute(
+                    delete(table).where(table.c[column].in_(part)))
         self.session.commit()
 
+    def user_logins(self):
+        """Логины всех зарегистрированных пользователей"""
+        return list(self.users)
+
+    def users_changes(self, epoch, version):
+        """
+        Изменения справочника пользователей после версии клиента.
+        Возвращает эпоху, текущую версию и словарь логин -> добавлен ли,
+        или None вместо словаря, если клиенту нужен полный список
+        """
+        version, changes = self.directory_log.changes_since(epoch, version)
+        return self.directory_log.epoch, version, changes
+
     def get_hash(self, name):
         """Получение хэша пароля"""
-        user = self.session.query(self.AllUsers).filter_by(login=name).first()
-        return user.passwd_hash
+        return self.users[name].passwd_hash
+
+    def get_iterations(self, name):
+        """Число итераций PBKDF2, с которым вычислен хэш пароля"""
+        return self.users[name].iterations
+
+    def set_password(self, name, passwd_hash, iterations):
+        """Замена хэша пароля, например вычисленным с большим числом
+        итераций"""
+        user = self.users[name]
+        self.session.query(self.AllUsers).filter_by(id=user.id).update(
+            {self.AllUsers.passwd_hash: passwd_hash,
+             self.AllUsers.kdf_iterations: iterations},
+            synchronize_session=False)
+        self.session.commit()
+        user.passwd_hash = passwd_hash
+        user.iterations = iterations
+
+    def reload_password(self, name):
+        """Чтение хэша пароля, заменённого другим процессом сервера"""
+        user = self.users.get(name)
+        if user is None:
+            return
+        users = self.AllUsers.__table__.c
+        row = self.session.execute(
+            select(users.passwd_hash, users.kdf_iterations).where(
+                users.id == user.id)).first()
+        # Чтение не должно держать транзакцию, мешающую записи
+        self.session.commit()
+        if row:
+            user.passwd_hash, user.iterations = row
+
+    def set_pubkey(self, name, key):
+        """Замена открытого ключа в справочнике, в том числе ключа,
+        полученного при входе через другой процесс сервера. Возвращает
+        True, если ключ изменился"""
+        user = self.users.get(name)
+        if user is None:
+            return False
+        key_changed = user.pubkey is not None and user.pubkey != key
+        user.pubkey = key
+        if key_changed:
+            self.directory_log.record(name, True)
+        return key_changed
+
+    def reload_contacts(self, name):
+        """Чтение контактов пользователя, изменённых другим процессом
+        сервера"""
+        user = self.users.get(name)
+        if user is None:
+            return
+        contacts = self.UsersContacts.__table__.c
+        users = self.AllUsers.__table__.c
+        rows = self.session.execute(
+            select(users.login).join_from(
+                self.UsersContacts.__table__, self.AllUsers.__table__,
+                contacts.contact == users.id).where(
+                contacts.user == user.id)).all()
+        # Чтение не должно держать транзакцию, мешающую записи
+        self.session.commit()
+        user.contacts = {login for login, in rows
+                         if login in self.users}
 
     def get_pubkey(self, name):
         """Получение публичного ключа"""
-        user = self.session.query(self.AllUsers).filter_by(login=name).first()
-        return user.pubkey
+        user = self.users.get(name)
+        return user.pubkey if user else None
 
     def check_user(self, name):
         """Проверка существования пользователя в БД"""
-        if self.session.query(self.AllUsers).filter_by(login=name).count():
-            return True
-        else:
-            return False
+        return name in self.users
     
     def user_logout(self, username):
-        user = self.session.query(self.AllUsers).\
-            filter_by(login=username).first()
-        
+        if self.write_behind:
+            self.write_behind.record_logout(username)
+            return
+        user = self.users.get(username)
+        if user is None:
+            return
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.commit()
 
     def process_message(self, sender, recipient):
-        sender = self.session.query(self.AllUsers).\
-            filter_by(login=sender).first().id
-        reciv = self.session.query(self.AllUsers).\
-            filter_by(login=recipient).first().id
-
-        sender_row = self.session.query(self.UsersHistory).\
-            filter_by(user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UsersHistory).\
-            filter_by(user=reciv).first()
-        recipient_row.accepted += 1
-
+        if self.write_behind:
+            self.write_behind.record_message(sender, recipient)
+            return
+        if sender not in self.users or recipient not in self.users:
+            return
+        self.session.query(self.UsersHistory).\
+            filter_by(user=self.users[sender].id).update(
+                {self.UsersHistory.sent: self.UsersHistory.sent + 1},
+                synchronize_session=False)
+        self.session.query(self.UsersHistory).\
+            filter_by(user=self.users[recipient].id).update(
+                {self.UsersHistory.accepted: self.UsersHistory.accepted + 1},
+                synchronize_session=False)
         self.session.commit()
 
     def add_contact(self, user, contact):
-        user = self.session.query(self.AllUsers).filter_by(login=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(login=contact).\
-            first()
+        self.add_contacts([(user, contact)])
 
-        if not contact or self.session.query(self.UsersContacts).\
-                filter_by(user=user.id, contact=contact.id).count():
+    def add_contacts(self, pairs):
+        """Добавление контактов из списка пар (пользователь, контакт)
+        одной транзакцией. Неизвестные пользователи пропускаются"""
+        added = []
+        for user, contact in pairs:
+            user = self.users.get(user)
+            contact = self.users.get(contact)
+            if user and contact and contact.login not in user.contacts:
+                added.append((user, contact))
+        if not added:
             return
-
-        contact_row = self.UsersContacts(user.id, contact.id)
-        self.session.add(contact_row)
+        self.session.execute(
+            insert(self.UsersContacts.__table__).on_conflict_do_nothing(
+                index_elements=['user', 'contact']),
+            [{'user': user.id, 'contact': contact.id}
+             for user, contact in added])
         self.session.commit()
+        for user, contact in added:
+            user.contacts.add(contact.login)
 
     def remove_contact(self, user, contact):
-        user = self.session.query(self.AllUsers).filter_by(login=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(login=contact).\
-            first()
-        if not contact:
-            return
+        self.remove_contacts([(user, contact)])
 
-        self.session.query(self.UsersContacts).filter(
-            self.UsersContacts.user == user.id,
-            self.UsersContacts.contact == contact.id).delete()
+    def remove_contacts(self, pairs):
+        """Удаление контактов из списка пар (пользователь, контакт)
+        одной транзакцией"""
+        removed = []
+        for user, contact in pairs:
+            user = self.users.get(user)
+            contact = self.users.get(contact)
+            if user and contact:
+                removed.append((user, contact))
+        if not removed:
+            return
+        contacts = self.UsersContacts.__table__
+        self.session.execute(
+            delete(contacts).where(contacts.c.user == bindparam('user_id'),
+                                   contacts.c.contact ==
+                                   bindparam('contact_id')),
+            [{'user_id': user.id, 'contact_id': contact.id}
+             for user, contact in removed])
         self.session.commit()
+        for user, contact in removed:
+            user.contacts.discard(contact.login)
 
     def users_list(self):
         query = self.session.query(
@@ -222,12 +474,7 @@ class ServerStorage:
         return query.all()
 
     def get_contacts(self, username):
-        user = self.session.query(self.AllUsers).filter_by(login=username).one()
-
-        query = self.session.query(self.UsersContacts, self.AllUsers.login).\
-            filter_by(user=user.id).\
-            join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
-        return [contact[1] for contact in query.all()]
+        return sorted(self.users[username].contacts)
 
     def message_history(self):
         query = self.session.query(
@@ -0,0 +1,71 @@
+"""Создание подключения к SQLite и обновление схемы существующих БД"""
+from sqlalchemy import create_engine, event
+
+# Настройки подключения: WAL позволяет читать во время записи,
+# synchronous=NORMAL в режиме WAL не синхронизирует диск на каждой
+# транзакции, размер кэша задан в КиБ (отрицательное значение)
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+
+# Число значений в одном условии IN, чтобы не превысить
+# ограничение SQLite на число параметров запроса
+SQL_CHUNK = 500
+
+
+def chunks(values, size):
+    """Разбиение списка на части не длиннее size"""
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def create_sqlite_engine(path, pragmas=SQLITE_PRAGMAS, **kwargs):
+    """Движок SQLAlchemy для файла path с настройками pragmas,
+    применяемыми к каждому новому соединению"""
+    engine = create_engine(f'sqlite:///{path}', echo=False,
+                           pool_recycle=7200,
+                           connect_args={'check_same_thread': False},
+                           **kwargs)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return engine
+
+
+def schema_version(engine):
+    with engine.connect() as connection:
+        return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def migrate(engine, metadata, migrations):
+    """
+    Создание таблиц и обновление схемы существующей БД.
+    migrations - список функций migration(engine, metadata), версия схемы
+    равна числу применённых функций и хранится в PRAGMA user_version
+    """
+    metadata.create_all(engine)
+    version = schema_version(engine)
+    for number, migration in enumerate(migrations[version:], version + 1):
+        migration(engine, metadata)
+        with engine.connect() as connection:
+            connection.exec_driver_sql(f'PRAGMA user_version={number}')
+
+
+def create_indexes(engine, metadata):
+    """Миграция: индексы, которых нет в БД, созданной до их описания.
+    Уникальные индексы создаются миграциями, очищающими дубликаты"""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if not index.unique:
+                index.create(bind=engine, checkfirst=True)
+
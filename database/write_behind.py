@@ -0,0 +1,135 @@
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+LOGGER = logging.getLogger('server')
+
+# Типы отложенных событий
+LOGIN = 'login'
+LOGOUT = 'logout'
+
+
+class WriteBehind:
+    """
+    Отложенная запись статистики и истории входов в БД сервера.
+    Счётчики отправленных/принятых сообщений и события входа/выхода
+    накапливаются в памяти и записываются одной транзакцией раз в
+    interval секунд или при накоплении max_events событий.
+    Запись выполняется отдельным потоком со своей сессией БД, поэтому
+    обработка сообщений не ждёт SQLite. interval - окно, в пределах
+    которого данные могут быть потеряны при аварийной остановке
+    """
+
+    def __init__(self, storage, interval, max_events):
+        self.storage = storage
+        self.interval = interval
+        self.max_events = max_events
+        self.Session = sessionmaker(bind=storage.engine)
+
+        self.lock = threading.Lock()
+        # Запись выполняется по таймеру и при остановке, не одновременно
+        self.flush_lock = threading.Lock()
+        # имя -> [отправлено, принято]
+        self.counters = {}
+        self.events = []
+        self.size = 0
+
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='write-behind')
+        self.thread.start()
+
+    def record_message(self, sender, recipient):
+        with self.lock:
+            self.counters.setdefault(sender, [0, 0])[0] += 1
+            self.counters.setdefault(recipient, [0, 0])[1] += 1
+            self.added()
+
+    def record_login(self, username, ip_addr, port, key):
+        with self.lock:
+            self.events.append((LOGIN, username, ip_addr, port, key,
+                                datetime.now()))
+            self.added()
+
+    def record_logout(self, username):
+        with self.lock:
+            self.events.append((LOGOUT, username))
+            self.added()
+
+    def added(self):
+        self.size += 1
+        if self.size >= self.max_events:
+            self.wakeup.set()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Запись накопленного одной транзакцией"""
+        with self.flush_lock:
+            with self.lock:
+                counters, self.counters = self.counters, {}
+                events, self.events = self.events, []
+                self.size = 0
+            if not counters and not events:
+                return
+            session = self.Session()
+            try:
+                self.apply(session, counters, events)
+                session.commit()
+            except Exception as err:
+                session.rollback()
+                LOGGER.error(f'Ошибка отложенной записи в БД: {err}')
+            finally:
+                session.close()
+
+    def apply(self, session, counters, events):
+        storage = self.storage
+        # id берутся из справочника пользователей,
+        # удалённые до записи пользователи пропускаются
+        ids = {name: user.id for name, user in
+               ((name, storage.users.get(name)) for name in
+                set(counters) | {event[1] for event in events})
+               if user is not None}
+
+        for name, (sent, accepted) in counters.items():
+            if name not in ids:
+                continue
+            session.query(storage.UsersHistory).\
+                filter_by(user=ids[name]).update({
+                    storage.UsersHistory.sent:
+                        storage.UsersHistory.sent + sent,
+                    storage.UsersHistory.accepted:
+                        storage.UsersHistory.accepted + accepted,
+                }, synchronize_session=False)
+
+        for event in events:
+            user_id = ids.get(event[1])
+            if user_id is None:
+                continue
+            if event[0] == LOGIN:
+                _, _, ip_addr, port, key, when = event
+                session.query(storage.AllUsers).filter_by(id=user_id).\
+                    update({storage.AllUsers.last_connect: when,
+                            storage.AllUsers.pubkey: key},
+                           synchronize_session=False)
+                session.add(storage.ActiveUsers(user_id, ip_addr, port,
+                                                when))
+                session.add(storage.LoginHistory(user_id, ip_addr, port,
+                                                 when))
+            else:
+                session.query(storage.ActiveUsers).\
+                    filter_by(user=user_id).delete()
+
+    def close(self):
+        """Остановка потока и запись оставшихся данных"""
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
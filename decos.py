@@ -1,8 +1,10 @@
 import sys
+import functools
+import itertools
 import logging
-import socket
 import logs.server_log_config
 import logs.client_log_config
+from common.variables import LOG_ARG_LENGTH, LOG_MESSAGE_SAMPLE
 
 # метод определения модуля, источника запуска.
 # Метод find () возвращает индекс первого вхождения искомой подстроки,
@@ -14,14 +16,68 @@ if sys.argv[0].find('client') == -1:
 else:
     LOGGER = logging.getLogger('client')
 
-def log(func_to_log):
-    """Функция-декоратор"""
+# Функции с @log(sample=None) записывают каждый _message_sample-й
+# вызов. По умолчанию LOG_MESSAGE_SAMPLE, значение 1 в настройке
+# Log_sample сервера или ключе --log-sample клиента записывает каждый
+_message_sample = LOG_MESSAGE_SAMPLE
+
+
+def set_message_sample(value):
+    """Запись в лог каждого value-го вызова функций с @log(sample=None)"""
+    global _message_sample
+    _message_sample = max(int(value), 1)
+
+
+class _Arguments:
+    """
+    Аргументы вызова для записи в лог. Строка строится только при
+    форматировании записи обработчиком лога, представление каждого
+    аргумента укорачивается до max_length символов
+    """
+    __slots__ = ('args', 'kwargs', 'max_length')
+
+    def __init__(self, args, kwargs, max_length):
+        self.args = args
+        self.kwargs = kwargs
+        self.max_length = max_length
+
+    def shorten(self, value):
+        text = repr(value)
+        if self.max_length and len(text) > self.max_length:
+            return f'{text[:self.max_length]}...'
+        return text
+
+    def __str__(self):
+        return ', '.join(
+            [self.shorten(arg) for arg in self.args] +
+            [f'{name}={self.shorten(value)}'
+             for name, value in self.kwargs.items()])
+
+
+def log(func_to_log=None, *, sample=1, max_length=LOG_ARG_LENGTH):
+    """
+    Функция-декоратор: запись вызова функции в лог на уровне DEBUG.
+    Если уровень DEBUG отключён, аргументы не форматируются.
+    sample - записывается каждый sample-й вызов функции, None - каждый
+    заданный set_message_sample() (по умолчанию LOG_MESSAGE_SAMPLE),
+    max_length - наибольшая длина представления аргумента.
+    Применяется как @log или @log(sample=..., max_length=...)
+    """
+    if func_to_log is None:
+        return functools.partial(log, sample=sample, max_length=max_length)
+    name = func_to_log.__name__
+    module = func_to_log.__module__
+    calls = itertools.count()
+
+    @functools.wraps(func_to_log)
     def log_saver(*args, **kwargs):
-        LOGGER.debug(
-            f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. '
-            f'Вызов из модуля {func_to_log.__module__}')
-        ret = func_to_log(*args, **kwargs)
-        return ret
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            rate = sample or _message_sample
+            if rate == 1 or next(calls) % rate == 0:
+                LOGGER.debug('Была вызвана функция %s c параметрами %s. '
+                             'Вызов из модуля %s', name,
+                             _Arguments(args, kwargs, max_length), module)
+        return func_to_log(*args, **kwargs)
 
     return log_saver
 
@@ -39,12 +95,12 @@ def login_required(func):
 
         if isinstance(args[0], MessageProcessor):
             found = False
-            for arg in args:
-                if isinstance(arg, socket.socket):
-                    for client in args[0].names:
-                        print(client)
-                        if args[0].names[client] == arg:
-                            found = True
+            # Клиентом считается любой аргумент кроме самого сообщения:
+            # сокет у select-движка или поток у asyncio-движка
+            for arg in args[1:]:
+                if not isinstance(arg, dict) and \
+                        args[0].sessions.get_by_sock(arg) is not None:
+                    found = True
 
             for arg in args:
                 if isinstance(arg, dict):
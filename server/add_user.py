@@ -1,9 +1,9 @@
-import hashlib
-import binascii
 from PyQt5.QtWidgets import QDialog, QPushButton, QLineEdit, QApplication, \
     QLabel, QMessageBox
 from PyQt5.QtCore import Qt
 
+from common.credentials import password_hash
+
 
 class RegisterUser(QDialog):
     """Регистрация пользователей"""
@@ -72,13 +72,13 @@ class RegisterUser(QDialog):
                                                    'именем уже существует')
             return
         else:
-            # Генерируем хэш пароля. соль - имя пользователя в нижнем регистре
-            passwd_bytes = self.client_passwd.text().encode('utf-8')
-            salt = self.client_name.text().lower().encode('utf-8')
-            passwd_hash = hashlib.pbkdf2_hmac('sha512', passwd_bytes,
-                                              salt, 10000)
-            self.database.add_user(self.client_name.text(),
-                                   binascii.hexlify(passwd_hash))
+            # Генерируем хэш пароля с числом итераций, заданным серверу
+            iterations = self.server.password_iterations
+            self.database.add_user(
+                self.client_name.text(),
+                password_hash(self.client_name.text(),
+                              self.client_passwd.text(), iterations),
+                iterations)
             self.messages.information(self, 'Успешно',
                                       'Пользователь зарегистрирован')
             self.server.service_update_lists()
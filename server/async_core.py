@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import threading
+
+from common.variables import *
+from common.utils import FrameDecoder
+from server.core import MessageProcessor
+from server.outbox import StreamOutbox
+
+LOGGER = logging.getLogger('server')
+
+
+class StreamClient:
+    """Клиентское соединение asyncio-движка.
+    Повторяет нужную часть интерфейса сокета (send, getpeername, close),
+    поэтому обработчики протокола MessageProcessor работают с ним
+    без изменений"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.peername = writer.get_extra_info('peername')
+        self.closed = False
+        self.decoder = FrameDecoder()
+
+    def send(self, data):
+        # Запись буферизуется транспортом и не блокирует цикл событий
+        self.writer.write(data)
+        return len(data)
+
+    sendall = send
+
+    def getpeername(self):
+        return self.peername[0], self.peername[1]
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """Серверный движок на asyncio: одна сопрограмма на соединение.
+    Цикл событий работает в отдельном потоке, поэтому для GUI движок
+    выглядит так же, как MessageProcessor"""
+
+    def __init__(self, listen_address, listen_port, database, **kwargs):
+        super().__init__(listen_address, listen_port, database, **kwargs)
+        self.loop = None
+        self.stop_event = None
+        # Сопрограммы обслуживания подключенных клиентов
+        self.tasks = set()
+
+    def stop(self):
+        """Остановка сервера, можно вызывать из любого потока"""
+        self.running = False
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Запуск слушающего сокета и ожидание команды остановки"""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if not self.running:
+            return
+        server = await self.start_server()
+        async with server:
+            await self.stop_event.wait()
+        # Закрываем соединения и дожидаемся завершения их сопрограмм
+        for client in list(self.clients):
+            client.close()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.shutdown()
+
+    async def start_server(self, **kwargs):
+        """Создание слушающего сокета"""
+        LOGGER.info(f'Запущен asyncio-сервер, порт для подключений: '
+                    f'{self.port}, адрес с которого принимается '
+                    f'подключения: {self.addr}')
+        return await asyncio.start_server(
+            self.handle_connection, self.addr or None, self.port,
+            backlog=LISTEN_BACKLOG, reuse_address=True, **kwargs)
+
+    async def handle_connection(self, reader, writer):
+        """Сопрограмма обслуживания одного клиента"""
+        client = StreamClient(reader, writer)
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        LOGGER.info(f'Установлено соединение с ПК {client.getpeername()}')
+        self.clients.add(client)
+        self.outboxes[client] = StreamOutbox(
+            writer, self.outbox_high, self.outbox_low, self.outbox_policy)
+        try:
+            while self.running and not client.closed:
+                data = await reader.read(MAX_PACKAGE_LENGTH)
+                if not data:
+                    break
+                for message in client.decoder.feed(data):
+                    self.dispatch(message, client)
+                    if client.closed:
+                        break
+                await writer.drain()
+        except OSError as err:
+            LOGGER.debug(f'Ошибка обработки клиента '
+                         f'{client.getpeername()}: {err}')
+        except Exception as err:
+            # Некорректные данные, запрос без авторизации или сообщение
+            # без обязательных полей
+            LOGGER.error(f'Некорректный запрос клиента, '
+                         f'соединение закрыто: {err!r}')
+        finally:
+            # Соединение освобождается при любом завершении сопрограммы,
+            # в том числе при её отмене
+            if client in self.clients:
+                self.remove_client(client)
+
+    def schedule_update_lists(self):
+        if self.update_deadline is None:
+            self.update_deadline = self.loop.time() + self.update_window
+            self.loop.call_later(self.update_window,
+                                 self.broadcast_update_lists)
+
+    def autorize_user(self, message, sock):
+        """Авторизация с таймером ожидания ответа клиента"""
+        super().autorize_user(message, sock)
+        pending = self.pending_auth.get(sock)
+        if pending is not None:
+            self.loop.call_later(AUTH_TIMEOUT, self.expire_auth, sock,
+                                 pending)
+
+    def post(self, func, *args):
+        """Передача вызова в цикл событий из любого потока"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def send_to(self, client, frame):
+        """Запись кадра в буфер транспорта клиента с учётом
+        ограничений очереди"""
+        outbox = self.outboxes.get(client)
+        if outbox is not None and not outbox.put(frame):
+            LOGGER.warning(f'Клиент {client.getpeername()} не успевает '
+                           f'принимать сообщения, соединение закрыто')
+            self.remove_client(client)
+
+    def remove_client(self, client):
+        if self.call_in_loop(self.remove_client, client):
+            return
+        super().remove_client(client)
+
+    def call_in_loop(self, func, *args):
+        """Если метод вызван не из потока сервера (например из GUI),
+        переносит вызов в цикл событий и возвращает True"""
+        if self.loop and threading.current_thread() is not self:
+            self.loop.call_soon_threadsafe(func, *args)
+            return True
+        return False
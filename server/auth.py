@@ -0,0 +1,35 @@
+import binascii
+import hmac
+import time
+
+from common.variables import RESPONSE, DATA
+
+
+class PendingAuth:
+    """Состояние авторизации клиента, которому отправлена случайная
+    строка и от которого ожидается ответ"""
+
+    def __init__(self, presence, passwd_hash, challenge, timeout):
+        self.presence = presence
+        self.passwd_hash = passwd_hash
+        self.challenge = challenge
+        self.deadline = time.monotonic() + timeout
+
+    def expired(self, now):
+        return now >= self.deadline
+
+
+def verify_answer(passwd_hash, challenge, answer):
+    """
+    Проверка ответа клиента на случайную строку.
+    Выполняется в пуле потоков, чтобы хэширование при массовых
+    подключениях не задерживало обработку сообщений
+    """
+    if RESPONSE not in answer or answer[RESPONSE] != 511:
+        return False
+    try:
+        client_digest = binascii.a2b_base64(answer[DATA])
+    except (KeyError, TypeError, binascii.Error):
+        return False
+    digest = hmac.new(passwd_hash, challenge, 'MD5').digest()
+    return hmac.compare_digest(digest, client_digest)
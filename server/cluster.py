@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+
+from common.variables import *
+from common.utils import FrameDecoder, encode_message
+from database.server_db import ServerStorage
+from server.async_core import AsyncMessageProcessor
+from server.spool import Spool
+
+LOGGER = logging.getLogger('server')
+
+# Служебные сообщения между процессами-обработчиками
+CLUSTER_HELLO = 'cluster_hello'
+CLUSTER_LOGIN = 'cluster_login'
+CLUSTER_LOGOUT = 'cluster_logout'
+CLUSTER_DELIVER = 'cluster_deliver'
+CLUSTER_SPOOL = 'cluster_spool'
+CLUSTER_SPOOLED = 'cluster_spooled'
+CLUSTER_UPDATE = 'cluster_update'
+CLUSTER_PASSWORD = 'cluster_password'
+CLUSTER_CONTACTS = 'cluster_contacts'
+WORKER = 'worker'
+
+# Попытки подключения к соседнему процессу при запуске, с паузой 0.1 с
+PEER_CONNECT_ATTEMPTS = 50
+
+
+class ClusterMessageProcessor(AsyncMessageProcessor):
+    """
+    Обработчик одного процесса многопроцессного сервера.
+    Все процессы слушают один порт (SO_REUSEPORT), ядро распределяет
+    между ними подключения. Процессы связаны Unix-сокетами: через них
+    рассылаются входы и выходы пользователей (каждый процесс хранит
+    справочник "пользователь -> процесс"), изменения ключей, паролей и
+    контактов в справочниках пользователей процессов и пересылаются
+    сообщения пользователям, подключенным к другому процессу
+    """
+
+    def __init__(self, listen_address, listen_port, database, worker_id,
+                 workers, ipc_dir, **kwargs):
+        super().__init__(listen_address, listen_port, database, **kwargs)
+        self.worker_id = worker_id
+        self.workers = workers
+        self.ipc_dir = ipc_dir
+        self.ipc_server = None
+        # Пользователи других процессов: имя -> номер процесса
+        self.directory = {}
+        # Исходящие соединения с другими процессами
+        self.peers = {}
+        # Входящие соединения от других процессов и их сопрограммы
+        self.peer_links = set()
+        self.peer_tasks = set()
+        # Сообщения из журнала, пересланные другому процессу и ещё не
+        # подтверждённые им: имя получателя -> (номер процесса, число)
+        self.forwarding = {}
+
+    def ipc_path(self, worker_id):
+        return os.path.join(self.ipc_dir, f'worker-{worker_id}.sock')
+
+    async def serve(self):
+        try:
+            await super().serve()
+        finally:
+            for writer in list(self.peers.values()) + list(self.peer_links):
+                writer.close()
+            if self.ipc_server:
+                self.ipc_server.close()
+            if self.peer_tasks:
+                await asyncio.gather(*self.peer_tasks,
+                                     return_exceptions=True)
+
+    async def start_server(self, **kwargs):
+        """Сначала связываемся с остальными процессами, затем начинаем
+        принимать клиентов на общем порту"""
+        self.ipc_server = await asyncio.start_unix_server(
+            self.handle_peer, self.ipc_path(self.worker_id))
+        await self.connect_peers()
+        return await super().start_server(reuse_port=True, **kwargs)
+
+    async def connect_peers(self):
+        for worker_id in range(self.workers):
+            if worker_id == self.worker_id:
+                continue
+            for _ in range(PEER_CONNECT_ATTEMPTS):
+                try:
+                    _, writer = await asyncio.open_unix_connection(
+                        self.ipc_path(worker_id))
+                except OSError:
+                    await asyncio.sleep(0.1)
+                else:
+                    self.peers[worker_id] = writer
+                    writer.write(encode_message(
+                        {ACTION: CLUSTER_HELLO, WORKER: self.worker_id}))
+                    break
+            else:
+                LOGGER.error(f'Процесс {self.worker_id}: не удалось '
+                             f'связаться с процессом {worker_id}')
+
+    async def handle_peer(self, reader, writer):
+        """Приём служебных сообщений от другого процесса"""
+        task = asyncio.current_task()
+        self.peer_tasks.add(task)
+        task.add_done_callback(self.peer_tasks.discard)
+        self.peer_links.add(writer)
+        decoder = FrameDecoder()
+        peer_id = None
+        try:
+            while True:
+                data = await reader.read(MAX_PACKAGE_LENGTH)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    if message[ACTION] == CLUSTER_HELLO:
+                        peer_id = message[WORKER]
+                    else:
+                        self.process_peer_message(message)
+        except (OSError, ValueError) as err:
+            LOGGER.error(f'Ошибка связи с процессом {peer_id}: {err}')
+        self.peer_links.discard(writer)
+        # Пользователи отключившегося процесса больше не в сети, а
+        # неподтверждённые им сообщения остаются в журнале до их входа
+        for name, worker_id in list(self.directory.items()):
+            if worker_id == peer_id:
+                del self.directory[name]
+        for name, (worker_id, _) in list(self.forwarding.items()):
+            if worker_id == peer_id:
+                del self.forwarding[name]
+
+    def process_peer_message(self, message):
+        if message[ACTION] == CLUSTER_LOGIN:
+            self.directory[message[USER]] = message[WORKER]
+            # Клиенты этого процесса тоже должны сбросить сменившийся ключ
+            if PUBLIC_KEY in message and self.database.set_pubkey(
+                    message[USER], message[PUBLIC_KEY]):
+                super().service_update_lists()
+            self.forward_spooled(message[USER], message[WORKER])
+        elif message[ACTION] == CLUSTER_LOGOUT:
+            if self.directory.get(message[USER]) == message[WORKER]:
+                del self.directory[message[USER]]
+        elif message[ACTION] == CLUSTER_DELIVER:
+            self.deliver_forwarded(message[MESSAGE])
+        elif message[ACTION] == CLUSTER_SPOOL:
+            for forwarded in message[MESSAGE]:
+                self.deliver_forwarded(forwarded)
+            self.send_peers({ACTION: CLUSTER_SPOOLED, USER: message[USER],
+                             SPOOL_COUNT: len(message[MESSAGE])},
+                            message[WORKER])
+        elif message[ACTION] == CLUSTER_SPOOLED:
+            self.forwarded_spooled(message[USER], message[SPOOL_COUNT])
+        elif message[ACTION] == CLUSTER_UPDATE:
+            super().service_update_lists()
+        elif message[ACTION] == CLUSTER_PASSWORD:
+            self.database.reload_password(message[USER])
+        elif message[ACTION] == CLUSTER_CONTACTS:
+            self.database.reload_contacts(message[USER])
+
+    def deliver_forwarded(self, message):
+        """
+        Сообщение, пересланное другим процессом. Справочник процессов
+        обновляется с задержкой, и получатель мог уже отключиться: тогда
+        сообщение сохраняется в журнал и будет доставлено при его входе
+        """
+        name = message[DESTINATION]
+        if name in self.sessions or self.spool is None:
+            super().process_message(message)
+            return
+        self.spool.put(message)
+        LOGGER.info(f'Пользователь {name} отключился, сообщение от '
+                    f'{message[SENDER]} сохранено в журнал')
+        if name in self.directory:
+            self.forward_spooled(name, self.directory[name])
+
+    def forward_spooled(self, name, worker_id):
+        """
+        Пользователь вошёл через другой процесс: накопленные здесь для
+        него сообщения пересылаются туда частями не больше outbox_low
+        байт. Сообщения остаются в журнале, пока тот процесс не
+        подтвердит, что доставил или сохранил их
+        """
+        if self.spool is None or name not in self.spool or \
+                name in self.forwarding or worker_id not in self.peers:
+            return
+        messages = FrameDecoder().feed(
+            b''.join(self.spool.peek(name, self.outbox_low)))
+        self.forwarding[name] = (worker_id, len(messages))
+        self.send_peers({ACTION: CLUSTER_SPOOL, USER: name,
+                         WORKER: self.worker_id, MESSAGE: messages},
+                        worker_id)
+
+    def forwarded_spooled(self, name, count):
+        """Другой процесс принял пересланные сообщения из журнала:
+        они удаляются из журнала, и пересылается следующая часть"""
+        worker_id, forwarded = self.forwarding.pop(name, (None, 0))
+        if worker_id is None:
+            return
+        self.spool.ack(name, min(count, forwarded))
+        if name in self.directory:
+            self.forward_spooled(name, self.directory[name])
+
+    def send_peers(self, message, worker_id=None):
+        """Отправка служебного сообщения одному или всем процессам"""
+        frame = encode_message(message)
+        if worker_id is not None:
+            writers = [self.peers[worker_id]] if worker_id in self.peers \
+                else []
+        else:
+            writers = self.peers.values()
+        for writer in writers:
+            writer.write(frame)
+
+    def is_online(self, name):
+        return name in self.sessions or name in self.directory
+
+    def process_message(self, message):
+        """Сообщение пользователю другого процесса пересылается туда"""
+        worker_id = self.directory.get(message[DESTINATION])
+        if worker_id is not None and message[DESTINATION] not in \
+                self.sessions:
+            self.send_peers({ACTION: CLUSTER_DELIVER, MESSAGE: message},
+                            worker_id)
+        else:
+            super().process_message(message)
+
+    def auth_complete(self, pending, sock, future):
+        super().auth_complete(pending, sock, future)
+        session = self.sessions.get_by_sock(sock)
+        if session is not None:
+            self.send_peers({ACTION: CLUSTER_LOGIN, USER: session.name,
+                             WORKER: self.worker_id,
+                             PUBLIC_KEY: pending.presence[USER][PUBLIC_KEY]})
+
+    def remove_client(self, client):
+        if self.call_in_loop(self.remove_client, client):
+            return
+        session = self.sessions.get_by_sock(client)
+        super().remove_client(client)
+        if session is not None:
+            self.send_peers({ACTION: CLUSTER_LOGOUT, USER: session.name,
+                             WORKER: self.worker_id})
+
+    def password_changed(self, name):
+        """Справочники пользователей других процессов перечитывают
+        новый хэш из БД"""
+        self.send_peers({ACTION: CLUSTER_PASSWORD, USER: name})
+
+    def contacts_changed(self, name):
+        """Справочники других процессов перечитывают контакты из БД"""
+        self.send_peers({ACTION: CLUSTER_CONTACTS, USER: name})
+
+    def service_update_lists(self):
+        if self.call_in_loop(self.service_update_lists):
+            return
+        self.send_peers({ACTION: CLUSTER_UPDATE})
+        super().service_update_lists()
+
+
+def run_worker(worker_id, workers, ipc_dir, listen_address, listen_port,
+               database_path, spool_dir, flush_interval, options):
+    """Точка входа процесса-обработчика"""
+    # Ctrl+C обрабатывает управляющий процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    database = ServerStorage(database_path, flush_interval=flush_interval)
+    if spool_dir:
+        # У каждого процесса свой журнал, номера процессов постоянны
+        options = dict(options, spool=Spool(
+            os.path.join(spool_dir, f'worker-{worker_id}')))
+    server = ClusterMessageProcessor(listen_address, listen_port, database,
+                                     worker_id, workers, ipc_dir, **options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.start()
+    server.join()
+    database.close()
+
+
+class ClusterSupervisor:
+    """
+    Управляющий процесс многопроцессного сервера: запускает
+    workers процессов-обработчиков на одном порту и останавливает их
+    """
+
+    def __init__(self, listen_address, listen_port, database_path, workers,
+                 spool_dir=None, flush_interval=None, **options):
+        self.listen_address = listen_address
+        self.listen_port = listen_port
+        self.database_path = database_path
+        self.workers = workers
+        self.spool_dir = spool_dir
+        self.flush_interval = flush_interval
+        self.options = options
+        self.ipc_dir = None
+        self.processes = []
+
+    def start(self):
+        self.ipc_dir = tempfile.mkdtemp(prefix='messenger-')
+        LOGGER.info(f'Запуск {self.workers} процессов-обработчиков, '
+                    f'порт {self.listen_port}')
+        for worker_id in range(self.workers):
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(worker_id, self.workers, self.ipc_dir,
+                      self.listen_address, self.listen_port,
+                      self.database_path, self.spool_dir,
+                      self.flush_interval, self.options),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        shutil.rmtree(self.ipc_dir, ignore_errors=True)
@@ -3,85 +3,290 @@ import os
 import select
 import socket
 import threading
-import hmac
 import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from descriptors import VerifyPort
 from common.variables import *
-from common.utils import get_message, send_message
+from common.utils import get_messages, send_frame, encode_message, \
+    FrameDecoder
+from common.responses import FRAME_200, FRAME_205, frame_202, frame_400, \
+    frame_511, response_511, with_request_id
+from common.credentials import upgrade_key, open_hash
 from decos import login_required
+from server.sessions import SessionRegistry
+from server.outbox import Outbox
+from server.auth import PendingAuth, verify_answer
 
 LOGGER = logging.getLogger('server')
 
 
+def peer_name(sock):
+    """Адрес клиента для журнала. У разорванного соединения адреса
+    может уже не быть"""
+    try:
+        return sock.getpeername()
+    except OSError:
+        return '(соединение разорвано)'
+
+
 class MessageProcessor(threading.Thread):
     port = VerifyPort()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database,
+                 outbox_high=OUTBOX_HIGH_WATERMARK,
+                 outbox_low=OUTBOX_LOW_WATERMARK,
+                 outbox_policy=OUTBOX_POLICY, spool=None,
+                 update_window=UPDATE_BROADCAST_WINDOW,
+                 password_iterations=PASSWORD_ITERATIONS):
         self.addr = listen_address
         self.port = listen_port
         self.database = database
+        # Журнал сообщений для пользователей не в сети, если не задан,
+        # такие сообщения отклоняются
+        self.spool = spool
 
         self.sock = None
 
-        self.clients = []
+        self.clients = set()
 
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Очереди исходящих кадров по сокетам и сокеты, у которых
+        # в очереди есть данные
+        self.outboxes = {}
+        self.pending_output = set()
+        self.outbox_high = outbox_high
+        self.outbox_low = outbox_low
+        self.outbox_policy = outbox_policy
 
         self.running = True
 
-        self.names = {}
+        # Авторизованные пользователи: индексы по имени и по сокету
+        self.sessions = SessionRegistry()
+
+        # Уведомления 205 об изменении списка пользователей собираются в
+        # одно за update_window секунд
+        self.update_window = update_window
+        self.update_deadline = None
+
+        # Число итераций хэша пароля для новых пользователей. Клиентам с
+        # меньшим числом при входе предлагается заменить хэш
+        self.password_iterations = password_iterations
+
+        # Клиенты, которым отправлен запрос авторизации, и пул потоков
+        # для проверки их ответов
+        self.pending_auth = {}
+        self.auth_executor = ThreadPoolExecutor(
+            max_workers=AUTH_WORKERS, thread_name_prefix='auth')
+
+        # Задачи, переданные в поток сервера из других потоков, и пара
+        # сокетов, пробуждающая select при их появлении
+        self.callbacks = deque()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_send.setblocking(False)
 
         super().__init__()
 
+    def stop(self):
+        """Остановка сервера"""
+        self.running = False
+
     def run(self):
 
         self.init_socket()
+        auth_check_time = time.monotonic()
 
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
+            # Ждём входящие данные, новые подключения и готовность к записи
+            # сокетов с непустой очередью. Таймаут нужен только для проверки
+            # флага остановки
             try:
-                client, client_address = self.sock.accept()
+                recv_data_lst, send_data_lst, _ = select.select(
+                    [self.sock, self.wakeup_recv, *self.clients],
+                    self.pending_output, [], self.select_timeout())
             except OSError as err:
-                pass
-            else:
-                LOGGER.info(f'Установлено соединение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
+                LOGGER.error(f'Ошибка работы с сокетами: {err.errno}')
+                continue
+
+            for client_with_message in recv_data_lst:
+                if client_with_message is self.sock:
+                    self.accept_client()
+                    continue
+                if client_with_message is self.wakeup_recv:
+                    self.run_callbacks()
+                    continue
+                try:
+                    # За один приём может прийти несколько сообщений
+                    # или только часть одного
+                    for message in get_messages(client_with_message):
+                        self.dispatch(message, client_with_message)
+                        # Клиент отключен во время обработки
+                        if client_with_message.fileno() == -1:
+                            break
+                except BlockingIOError:
+                    # Данные ещё не пришли, хотя select сообщил о них
+                    pass
+                except OSError:
+                    LOGGER.info(
+                        f'Клиент {peer_name(client_with_message)} '
+                        f'отключился от сервера.')
+                    self.remove_client(client_with_message)
+                except Exception as err:
+                    # Некорректные данные, запрос без авторизации или
+                    # сообщение без обязательных полей
+                    LOGGER.error(f'Некорректный запрос клиента, '
+                                 f'соединение закрыто: {err!r}')
+                    self.remove_client(client_with_message)
+
+            for client in send_data_lst:
+                self.flush_client(client)
+
+            if self.update_deadline is not None and \
+                    time.monotonic() >= self.update_deadline:
+                self.broadcast_update_lists()
+
+            if time.monotonic() - auth_check_time >= SELECT_TIMEOUT:
+                auth_check_time = time.monotonic()
+                self.expire_pending_auth()
+
+        self.shutdown()
 
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
+    def shutdown(self):
+        """Освобождение ресурсов после остановки сервера"""
+        self.auth_executor.shutdown(wait=False)
+        if self.spool:
+            self.spool.close()
 
+    def select_timeout(self):
+        """Ожидание select: до запланированной рассылки 205, но не
+        дольше SELECT_TIMEOUT"""
+        if self.update_deadline is None:
+            return SELECT_TIMEOUT
+        return min(SELECT_TIMEOUT,
+                   max(0, self.update_deadline - time.monotonic()))
+
+    def dispatch(self, message, client):
+        """Передача сообщения обработчику. Если клиенту отправлен запрос
+        авторизации, сообщение считается ответом на него"""
+        pending = self.pending_auth.pop(client, None)
+        if pending is not None:
+            self.auth_verify(pending, client, message)
+        else:
+            self.process_client_message(message, client)
+
+    def post(self, func, *args):
+        """Передача вызова в поток сервера из любого потока"""
+        self.callbacks.append((func, args))
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # Буфер полон, значит поток сервера и так будет разбужен
+            pass
+
+    def run_callbacks(self):
+        try:
+            self.wakeup_recv.recv(MAX_PACKAGE_LENGTH)
+        except BlockingIOError:
+            pass
+        while self.callbacks:
+            func, args = self.callbacks.popleft()
+            # Ошибка одного вызова не должна останавливать поток сервера
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(self.clients, self.clients, [], 0)
-            except OSError as err:
-                LOGGER.error(f'Ошибка работы с сокетами: {err.errno}')
+                func(*args)
+            except Exception as err:
+                LOGGER.error(f'Ошибка при выполнении {func.__name__}: '
+                             f'{err!r}')
 
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except OSError:
-                        LOGGER.info(
-                            f'Клиент {client_with_message.getpeername()} '
-                            f'отключился от сервера.')
-                        self.remove_client(client_with_message)
+    def accept_client(self):
+        """Приём нового подключения"""
+        try:
+            client, client_address = self.sock.accept()
+        except OSError:
+            return
+        LOGGER.info(f'Установлено соединение с ПК {client_address}')
+        # Сокет клиента неблокирующий: отправка медленному получателю
+        # останавливается, когда заполнен буфер ядра, а остаток ждёт
+        # в очереди готовности сокета к записи
+        client.setblocking(False)
+        self.clients.add(client)
+        self.outboxes[client] = Outbox(self.outbox_high, self.outbox_low,
+                                       self.outbox_policy)
+
+    def send_to(self, client, frame):
+        """Постановка кадра в очередь отправки клиента"""
+        outbox = self.outboxes.get(client)
+        if outbox is None:
+            return
+        if not outbox.put(frame):
+            LOGGER.warning(f'Клиент {peer_name(client)} не успевает '
+                           f'принимать сообщения, соединение закрыто')
+            self.remove_client(client)
+        elif outbox:
+            self.pending_output.add(client)
+
+    def flush_client(self, client):
+        """Отправка очереди клиента, готового к записи"""
+        outbox = self.outboxes.get(client)
+        if outbox is None:
+            return
+        try:
+            if outbox.flush(client):
+                self.pending_output.discard(client)
+        except OSError:
+            self.remove_client(client)
+
+    def queue_depths(self):
+        """Глубина очередей отправки авторизованных пользователей, байт"""
+        depths = {}
+        for session in self.sessions:
+            outbox = self.outboxes.get(session.sock)
+            depths[session.name] = outbox.pending_size() if outbox else 0
+        return depths
 
     def remove_client(self, client):
         """обработка клиента с которым утеряна связь.
         ищет клиента и удаляет его из списка и БД"""
-        LOGGER.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+        LOGGER.info(f'Клиент {peer_name(client)} отключился от сервера.')
+        session = self.sessions.remove(client)
+        if session is not None:
+            self.database.user_logout(session.name)
+            self.spool_unsent(session)
+        self.drop_connection(client)
+
+    def spool_unsent(self, session):
+        """Сообщения, оставшиеся в очереди отключившегося клиента,
+        сохраняются в журнал и будут доставлены при следующем входе.
+        Неподтверждённые кадры из журнала и так остались в нём"""
+        outbox = self.outboxes.get(session.sock)
+        if self.spool is None or outbox is None:
+            return
+        spooled = set(session.spooled)
+        for frame in outbox.unsent_frames():
+            if frame in spooled:
+                continue
+            for message in FrameDecoder().feed(frame):
+                if message.get(ACTION) == MESSAGE and \
+                        message.get(DESTINATION) == session.name:
+                    self.spool.put(message)
+
+    def drop_connection(self, client):
+        """Закрытие соединения и удаление его очереди"""
+        self.pending_auth.pop(client, None)
+        self.clients.discard(client)
+        self.outboxes.pop(client, None)
+        self.pending_output.discard(client)
         client.close()
 
+    def reject_client(self, sock, frame):
+        """Отказ в авторизации: ответ отправляется сразу, минуя очередь,
+        после чего соединение закрывается"""
+        try:
+            send_frame(sock, frame)
+        except OSError:
+            pass
+        self.drop_connection(sock)
+
     def init_socket(self):
         LOGGER.info(f'Запущен сервер, порт для подключений: {self.port},'
                     f'адрес с которого принимается подключения: {self.addr}'
@@ -95,24 +300,18 @@ class MessageProcessor(threading.Thread):
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
 
+    def is_online(self, name):
+        """Подключен ли пользователь к серверу"""
+        return name in self.sessions
+
     def process_message(self, message):
         """Отправка сообщения клиенту"""
-        if message[DESTINATION] in self.names and \
-                self.names[message[DESTINATION]] in \
-                self.listen_sockets:
-            try:
-                send_message(self.names[message[DESTINATION]], message)
-                LOGGER.info(f'Отправлено сообщение пользователю '
-                            f'{message[DESTINATION]} от пользователя '
-                            f'{message[SENDER]}')
-            except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and \
-                self.names[message[DESTINATION]] not in \
-                self.listen_sockets:
-            LOGGER.error(f'Связь с клиентом {message[DESTINATION]} была '
-                         f'потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
+        session = self.sessions.get(message[DESTINATION])
+        if session is not None:
+            self.send_to(session.sock, encode_message(message))
+            LOGGER.info(f'Отправлено сообщение пользователю '
+                        f'{message[DESTINATION]} от пользователя '
+                        f'{message[SENDER]}')
         else:
             LOGGER.error(
                 f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере,'
@@ -134,170 +333,311 @@ class MessageProcessor(threading.Thread):
         elif ACTION in message and message[ACTION] == MESSAGE and \
                 DESTINATION in message and TIME in message \
                 and SENDER in message and MESSAGE_TEXT in message and \
-                self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
+                self.sessions.is_owner(message[SENDER], client):
+            if self.is_online(message[DESTINATION]):
                 self.database.process_message(message[SENDER],
                                               message[DESTINATION])
                 self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
+                self.reply(client, message, FRAME_200)
+            elif self.spool is not None and \
+                    self.database.check_user(message[DESTINATION]):
+                # Получатель не в сети: сообщение будет доставлено при входе
+                self.database.process_message(message[SENDER],
+                                              message[DESTINATION])
+                self.spool.put(message)
+                self.reply(client, message, FRAME_200)
             else:
-                response = RESPONSE_400
-                response[ERROR] = 'Пользователь не в сети'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
+                response = frame_400('Пользователь не в сети')
+                self.reply(client, message, response)
             return
         # Запрос о выходе
         elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in \
-                message and self.names[message[ACCOUNT_NAME]] == client:
+                message and self.sessions.is_owner(message[ACCOUNT_NAME], client):
             self.remove_client(client)
 
         # запрос контактов
         elif ACTION in message and message[ACTION] == GET_CONTACTS and \
-                USER in message and self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+                USER in message and self.sessions.is_owner(message[USER], client):
+            response = frame_202(self.database.get_contacts(message[USER]))
+            self.reply(client, message, response)
 
         # добавление контактов
         elif ACTION in message and message[ACTION] == ADD_CONTACT and \
                 ACCOUNT_NAME in message and USER in message and \
-                self.names[message[USER]] == client:
+                self.sessions.is_owner(message[USER], client):
             self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+            self.contacts_changed(message[USER])
+            self.reply(client, message, FRAME_200)
 
         # удаление контакта
         elif ACTION in message and message[ACTION] == REMOVE_CONTACT and \
                 ACCOUNT_NAME in message and USER in message and \
-                self.names[message[USER]] == client:
+                self.sessions.is_owner(message[USER], client):
             self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+            self.contacts_changed(message[USER])
+            self.reply(client, message, FRAME_200)
 
         # известные контакты
         elif ACTION in message and message[ACTION] == USERS_REQUEST and \
                 ACCOUNT_NAME in message and \
-                self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user
-                                   in self.database.users_list()]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+                self.sessions.is_owner(message[ACCOUNT_NAME], client):
+            if DIRECTORY_VERSION in message:
+                response = encode_message(self.users_update(
+                    message.get(DIRECTORY_EPOCH), message[DIRECTORY_VERSION]))
+            else:
+                response = frame_202(self.database.user_logins())
+            self.reply(client, message, response)
+
+        # Замена хэша пароля на вычисленный с большим числом итераций
+        elif ACTION in message and message[ACTION] == PASSWORD_UPGRADE and \
+                ACCOUNT_NAME in message and DATA in message and \
+                KDF_ITERATIONS in message and \
+                self.sessions.is_owner(message[ACCOUNT_NAME], client):
+            self.upgrade_password(message, client)
+
+        # Сообщения, накопленные пока пользователь был не в сети
+        elif ACTION in message and message[ACTION] == SPOOL_REQUEST and \
+                ACCOUNT_NAME in message and \
+                self.sessions.is_owner(message[ACCOUNT_NAME], client):
+            self.deliver_spooled(message, client)
+
+        elif ACTION in message and message[ACTION] == SPOOL_DELIVERED and \
+                ACCOUNT_NAME in message and SPOOL_COUNT in message and \
+                self.sessions.is_owner(message[ACCOUNT_NAME], client):
+            self.spooled_delivered(message, client)
 
         # Запрос публичного ключа пользователя
         elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and \
                 ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+            pubkey = self.database.get_pubkey(message[ACCOUNT_NAME])
+            if pubkey:
+                response = frame_511(pubkey)
+                self.reply(client, message, response)
             else:
-                response = RESPONSE_400
-                response[ERROR] = 'Нет публичного ключа для данного ' \
-                                  'пользователя'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+                response = frame_400('Нет публичного ключа для данного '
+                                     'пользователя')
+                self.reply(client, message, response)
         else:
-            response = RESPONSE_400
-            response[ERROR] = 'Запрос некорректен.'
+            response = frame_400('Запрос некорректен.')
+            self.reply(client, message, response)
+
+    def upgrade_password(self, message, client):
+        """Замена хэша пароля авторизованного пользователя. Новый хэш
+        зашифрован ключом из прежнего хэша и случайной строки авторизации
+        этого соединения. Число итераций может только расти и не больше
+        заданного серверу"""
+        name = message[ACCOUNT_NAME]
+        iterations = message[KDF_ITERATIONS]
+        session = self.sessions.get_by_sock(client)
+        passwd_hash = None
+        if self.database.check_user(name) and \
+                isinstance(iterations, int) and \
+                self.database.get_iterations(name) < iterations <= \
+                self.password_iterations and \
+                isinstance(message[DATA], str) and \
+                session is not None and session.challenge is not None:
             try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+                passwd_hash = open_hash(
+                    upgrade_key(self.database.get_hash(name),
+                                session.challenge),
+                    name, iterations, message[DATA])
+            except ValueError:
+                pass
+        # Хэш - 64 байта SHA-512 в hex, как его вычисляет клиент
+        if passwd_hash is None or len(passwd_hash) != 128 or \
+                passwd_hash.strip(b'0123456789abcdef'):
+            self.reply(client, message, frame_400('Запрос некорректен.'))
+            return
+        self.database.set_password(name, passwd_hash, iterations)
+        self.password_changed(name)
+        LOGGER.info(f'Хэш пароля пользователя {name} пересчитан с '
+                    f'{iterations} итерациями')
+        self.reply(client, message, FRAME_200)
+
+    def password_changed(self, name):
+        """Хэш пароля пользователя заменён"""
+
+    def contacts_changed(self, name):
+        """Изменён список контактов пользователя"""
+
+    def reply(self, client, request, frame):
+        """Отправка ответа на запрос с номером запроса, если клиент
+        его указал: клиент может не дожидаться ответа на предыдущий
+        запрос и сопоставляет ответы по номерам"""
+        self.send_to(client, with_request_id(frame, request.get(REQUEST_ID)))
 
     def autorize_user(self, message, sock):
-        """реализация авторизации пользователей"""
+        """реализация авторизации пользователей.
+        Ответ клиента не ожидается здесь: он придёт следующим сообщением
+        и будет передан в auth_verify"""
+        pending = self.auth_challenge(message, sock)
+        if pending is not None:
+            self.pending_auth[sock] = pending
+
+    def auth_challenge(self, message, sock):
+        """Первый шаг авторизации: проверка имени и отправка клиенту
+        случайной строки. Возвращает состояние ожидания ответа или None,
+        если клиенту отказано"""
         LOGGER.debug(f'Начало авторизации {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
-            response[ERROR] = 'Имя пользователя уже занято'
-            try:
-                LOGGER.debug(f'Имя пользователя занято, сообщение{response}')
-                send_message(sock, response)
-            except OSError:
-                LOGGER.debug('OS Error')
-                pass
-            self.clients.remove(sock)
-            sock.close()
+        if self.is_online(message[USER][ACCOUNT_NAME]):
+            response = frame_400('Имя пользователя уже занято')
+            LOGGER.debug(f'Имя пользователя занято, сообщение{response}')
+            self.reject_client(sock, response)
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = 'Пользователь не зарегистрирован'
-            try:
-                LOGGER.debug(f'Пользователя нет в бд, {response}')
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
+            response = frame_400('Пользователь не зарегистрирован')
+            LOGGER.debug(f'Пользователя нет в бд, {response}')
+            self.reject_client(sock, response)
         else:
             LOGGER.debug('Проверка пароля')
-            # Словарь для ключа
-            message_auth = RESPONSE_511
             # набор байтов в представлении hex
             random_str = binascii.hexlify(os.urandom(64))
-            # декодируем, создаём хэш пороля и сохраняем в БД
-            message_auth[DATA] = random_str.decode('ascii')
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]),
-                             random_str, 'MD5')
-            digest = hash.digest()
+            # Словарь для ключа, строку декодируем. Клиенту сообщается
+            # число итераций хэша пароля и, если оно меньше заданного
+            # серверу, предлагается его увеличить
+            name = message[USER][ACCOUNT_NAME]
+            message_auth = response_511(random_str.decode('ascii'))
+            message_auth[KDF_ITERATIONS] = self.database.get_iterations(name)
+            if message_auth[KDF_ITERATIONS] < self.password_iterations:
+                message_auth[KDF_UPGRADE] = self.password_iterations
+            message_auth = encode_message(message_auth)
             LOGGER.debug(f'Сообщения авторизации, {message_auth}')
+            self.send_to(sock, message_auth)
+            return PendingAuth(
+                message,
+                self.database.get_hash(message[USER][ACCOUNT_NAME]),
+                random_str, AUTH_TIMEOUT)
+        return None
+
+    def auth_verify(self, pending, sock, ans):
+        """Второй шаг авторизации: проверка ответа клиента на
+        случайную строку в пуле потоков. Результат обрабатывается в
+        потоке сервера методом auth_complete"""
+        future = self.auth_executor.submit(
+            verify_answer, pending.passwd_hash, pending.challenge, ans)
+        future.add_done_callback(
+            lambda done: self.post(self.auth_complete, pending, sock, done))
+
+    def auth_complete(self, pending, sock, future):
+        """Завершение авторизации по результату проверки ответа"""
+        if sock not in self.clients:
+            return
+        try:
+            verified = future.result()
+        except Exception as err:
+            LOGGER.error(f'Ошибка проверки ответа клиента: {err}')
+            verified = False
+        message = pending.presence
+        # если ответ корректный, то сохраняем его в список пользователей
+        if not verified:
+            self.reject_client(sock, frame_400('Неверный пароль'))
+        elif self.is_online(message[USER][ACCOUNT_NAME]):
+            # Пока шла проверка, пользователь вошёл с другого соединения
+            self.reject_client(sock, frame_400('Имя пользователя уже занято'))
+        else:
+            name = message[USER][ACCOUNT_NAME]
+            # Добавляем пользователя в список активных пользователей и
+            # если поменялся ключ то обновляем в БД. Пока шла проверка,
+            # пользователь мог быть удалён, а соединение - разорвано:
+            # тогда отключается только этот клиент
             try:
-                send_message(sock, message_auth)
-                ans = get_message(sock)
-            except OSError as err:
-                LOGGER.debug('Ошибка авторизации: ', exc_info=err)
-                sock.close()
-                return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # если ответ корректный, то сохраняем его в список пользователей
-            if RESPONSE in ans and ans[RESPONSE] == 511 and \
-                    hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
                 client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # Добавляем пользователя в список активных пользователей и
-                # если поменялся ключ то обновляем в БД
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY])
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+                key_changed = self.database.user_login(
+                    name, client_ip, client_port, message[USER][PUBLIC_KEY])
+            except Exception as err:
+                LOGGER.error(f'Ошибка входа пользователя {name}: {err!r}')
+                self.reject_client(sock, frame_400('Ошибка авторизации'))
+                return
+            session = self.sessions.add(name, sock)
+            session.challenge = pending.challenge
+            self.send_to(sock, FRAME_200)
+            # Клиенты оповещаются о смене ключа, чтобы они сбросили
+            # сохранённый ключ
+            if key_changed:
+                self.service_update_lists()
+
+    def deliver_spooled(self, request, client):
+        """Отправка сообщений, накопленных пока пользователь был не в
+        сети. Клиент запрашивает их, когда готов принимать сообщения.
+        Кадры отправляются частями не больше нижней границы очереди, в
+        ответе - их число. Из журнала они удаляются только после
+        подтверждения клиентом"""
+        session = self.sessions.get_by_sock(client)
+        session.spooled = [] if self.spool is None else \
+            self.spool.peek(session.name, self.outbox_low)
+        for frame in session.spooled:
+            self.send_to(client, frame)
+        if session.spooled:
+            LOGGER.info(f'Пользователю {session.name} отправлено '
+                        f'сообщений из журнала: {len(session.spooled)}')
+        self.reply(client, request, encode_message(
+            {RESPONSE: 200, SPOOL_COUNT: len(session.spooled)}))
+
+    def spooled_delivered(self, request, client):
+        """Подтверждение клиентом приёма сообщений из журнала"""
+        session = self.sessions.get_by_sock(client)
+        count = request[SPOOL_COUNT]
+        if not isinstance(count, int) or \
+                not 0 <= count <= len(session.spooled):
+            self.reply(client, request, frame_400('Запрос некорректен.'))
+            return
+        if count:
+            self.spool.ack(session.name, count)
+        session.spooled = []
+        self.reply(client, request, FRAME_200)
+
+    def expire_auth(self, sock, pending):
+        """Отключение клиента, не ответившего на запрос авторизации"""
+        if self.pending_auth.get(sock) is pending:
+            del self.pending_auth[sock]
+            self.reject_client(sock, frame_400('Время авторизации истекло'))
+
+    def expire_pending_auth(self):
+        now = time.monotonic()
+        for sock, pending in list(self.pending_auth.items()):
+            if pending.expired(now):
+                self.expire_auth(sock, pending)
+
+    def users_update(self, epoch, version):
+        """Ответ на запрос списка пользователей с версией: изменения после
+        версии клиента или полный список, если клиент сильно отстал"""
+        epoch, version, changes = self.database.users_changes(epoch, version)
+        response = {RESPONSE: 202, DIRECTORY_EPOCH: epoch,
+                    DIRECTORY_VERSION: version}
+        if changes is None:
+            response[LIST_INFO] = self.database.user_logins()
+        else:
+            response[USERS_ADDED] = [login for login, added
+                                     in changes.items() if added]
+            response[USERS_REMOVED] = [login for login, added
+                                       in changes.items() if not added]
+        return response
+
+    def disconnect_user(self, name):
+        """Отключение пользователя, удалённого из БД.
+        Можно вызывать из любого потока"""
+        self.post(self.drop_user, name)
+
+    def drop_user(self, name):
+        session = self.sessions.get(name)
+        if session is not None:
+            # Пользователь уже удалён из БД, поэтому сессия убирается до
+            # отключения клиента, чтобы не отмечать его выход в БД
+            self.sessions.remove(session.sock)
+            self.remove_client(session.sock)
 
     def service_update_lists(self):
-        """отправка сервисных сообщений 205"""
-        for client in self.names:
-            try:
-                send_message(self.names[client], RESPONSE_205)
-            except OSError:
-                self.remove_client(self.names[client])
+        """Уведомление клиентов об изменении списка пользователей.
+        Можно вызывать из любого потока: рассылка выполняется потоком
+        сервера, изменения за update_window секунд объединяются"""
+        self.post(self.schedule_update_lists)
+
+    def schedule_update_lists(self):
+        if self.update_deadline is None:
+            self.update_deadline = time.monotonic() + self.update_window
+
+    def broadcast_update_lists(self):
+        """отправка сервисных сообщений 205 всем клиентам за один проход.
+        Кадр ставится в очереди, отправка - при готовности сокетов"""
+        self.update_deadline = None
+        for session in self.sessions:
+            self.send_to(session.sock, FRAME_205)
@@ -67,9 +67,12 @@ class MainWindow(QMainWindow):
     def create_users_model(self):
         """Заполняем таблицу активных пользователей"""
         list_users = self.database.active_users_list()
+        # Глубина очередей отправки для контроля медленных клиентов
+        queue_depths = self.server_thread.queue_depths()
         list = QStandardItemModel()
         list.setHorizontalHeaderLabels(
-            ['Имя Клиента', 'IP Адрес', 'Порт', 'Время-подключения'])
+            ['Имя Клиента', 'IP Адрес', 'Порт', 'Время-подключения',
+             'Очередь, байт'])
         for row in list_users:
             user, ip, port, time = row
             user = QStandardItem(user)
@@ -81,7 +84,9 @@ class MainWindow(QMainWindow):
 
             time = QStandardItem(str(time.replace(microsecond=0)))
             time.setEditable(False)
-            list.appendRow([user, ip, port, time])
+            queue = QStandardItem(str(queue_depths.get(user.text(), 0)))
+            queue.setEditable(False)
+            list.appendRow([user, ip, port, time, queue])
         self.active_clients_table.setModel(list)
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
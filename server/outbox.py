@@ -0,0 +1,136 @@
+import logging
+from collections import deque
+
+LOGGER = logging.getLogger('server')
+
+# Политики для клиентов, не успевающих принимать данные:
+# отключить клиента или отбрасывать новые сообщения до разгрузки очереди
+POLICY_DISCONNECT = 'disconnect'
+POLICY_DROP = 'drop'
+
+
+class Outbox:
+    """
+    Ограниченная очередь исходящих кадров одного соединения.
+    Кадры отправляются, когда сокет готов к записи, поэтому медленный
+    получатель не задерживает остальных клиентов.
+    Если в очереди больше high_watermark байт, срабатывает политика:
+    disconnect - клиент отключается, drop - новые кадры отбрасываются,
+    пока очередь не разгрузится до low_watermark
+    """
+
+    def __init__(self, high_watermark, low_watermark, policy):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.frames = deque()
+        # Байт в очереди с учётом частично отправленного первого кадра
+        self.size = 0
+        self.dropping = False
+        self.dropped = 0
+
+    def pending_size(self):
+        """Глубина очереди в байтах"""
+        return self.size
+
+    def put(self, frame):
+        """
+        Постановка кадра в очередь. Возвращает False, если клиент не
+        успевает принимать данные и его нужно отключить
+        """
+        size = self.pending_size()
+        if self.dropping and size <= self.low_watermark:
+            LOGGER.info(f'Очередь разгружена, пропущено кадров: '
+                        f'{self.dropped}')
+            self.dropping = False
+            self.dropped = 0
+        if not self.dropping and size + len(frame) > self.high_watermark:
+            if self.policy == POLICY_DISCONNECT:
+                return False
+            self.dropping = True
+        if self.dropping:
+            self.dropped += 1
+            return True
+        self.append(frame)
+        return True
+
+    def append(self, frame):
+        self.frames.append(memoryview(frame))
+        self.size += len(frame)
+
+    def flush(self, sock):
+        """
+        Отправка из очереди столько, сколько примет неблокирующий
+        сокет. Когда буфер ядра заполнен, отправка прекращается, а
+        неотправленный остаток кадра остаётся в очереди.
+        Возвращает True, если очередь опустела
+        """
+        while self.frames:
+            frame = self.frames[0]
+            try:
+                sent = sock.send(frame)
+            except (BlockingIOError, InterruptedError, TimeoutError):
+                return False
+            self.size -= sent
+            if sent < len(frame):
+                self.frames[0] = frame[sent:]
+                return False
+            self.frames.popleft()
+        return True
+
+    def unsent_frames(self):
+        """Кадры, не отправленные полностью. Начало первого кадра могло
+        уйти в сокет, но неполный кадр получатель отбросит, поэтому он
+        возвращается целиком"""
+        return [bytes(frame.obj) for frame in self.frames]
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class StreamOutbox(Outbox):
+    """
+    Очередь соединения asyncio-движка. Хранилищем служит буфер
+    транспорта, поэтому глубина очереди - размер этого буфера.
+    Транспорт отправляет данные по порядку, значит в буфере - последние
+    pending_size() записанных байт. Поэтому очередь помнит записанные
+    кадры, пока они не ушли из буфера целиком, чтобы вернуть
+    неотправленные при отключении клиента
+    """
+
+    def __init__(self, writer, high_watermark, low_watermark, policy):
+        super().__init__(high_watermark, low_watermark, policy)
+        self.writer = writer
+        writer.transport.set_write_buffer_limits(high_watermark,
+                                                  low_watermark)
+
+    def pending_size(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def append(self, frame):
+        self.writer.write(frame)
+        self.frames.append(frame)
+        self.size += len(frame)
+        self.trim()
+
+    def trim(self):
+        """Забыть кадры, полностью переданные транспортом в сокет.
+        Закрытый транспорт очищает буфер, и тогда неизвестно, что из
+        него было отправлено: кадры сохраняются"""
+        if self.writer.transport.is_closing():
+            return
+        sent = self.size - self.pending_size()
+        while self.frames and len(self.frames[0]) <= sent:
+            frame = self.frames.popleft()
+            sent -= len(frame)
+            self.size -= len(frame)
+
+    def flush(self, sock):
+        return True
+
+    def unsent_frames(self):
+        self.trim()
+        return list(self.frames)
+
+    def __len__(self):
+        return 1 if self.pending_size() else 0
@@ -39,16 +39,13 @@ class DelUserDialog(QDialog):
 
     def all_users_fill(self):
         """Метод заполняющий список пользователей"""
-        self.selector.addItems(
-            [item[0] for item in self.database.users_list()])
+        self.selector.addItems(self.database.user_logins())
 
     def remove_user(self):
         """Метод удаляющий пользователя"""
         self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
+        # Отключение выполняет поток сервера
+        self.server.disconnect_user(self.selector.currentText())
         # Рассылка клиентам о необходимости обновить справочник
         self.server.service_update_lists()
         self.close()
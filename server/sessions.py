@@ -0,0 +1,60 @@
+class Session:
+    """Авторизованный на сервере пользователь и его соединение"""
+
+    def __init__(self, name, sock):
+        self.name = name
+        self.sock = sock
+        # Кадры из журнала, отправленные клиенту, но ещё не
+        # подтверждённые им
+        self.spooled = []
+        # Случайная строка авторизации: из неё и хэша пароля выводится
+        # ключ, которым клиент шифрует новый хэш при его замене
+        self.challenge = None
+
+
+class SessionRegistry:
+    """
+    Реестр авторизованных пользователей с двумя индексами:
+    имя -> сессия и сокет -> сессия. Проверка авторизации, поиск и
+    удаление выполняются за O(1) независимо от числа пользователей
+    """
+
+    def __init__(self):
+        self.by_name = {}
+        self.by_sock = {}
+
+    def add(self, name, sock):
+        """Регистрация пользователя после успешной авторизации"""
+        session = Session(name, sock)
+        self.by_name[name] = session
+        self.by_sock[sock] = session
+        return session
+
+    def remove(self, sock):
+        """Удаление сессии по сокету, возвращает сессию или None"""
+        session = self.by_sock.pop(sock, None)
+        if session is not None:
+            del self.by_name[session.name]
+        return session
+
+    def get(self, name):
+        """Сессия пользователя по имени или None"""
+        return self.by_name.get(name)
+
+    def get_by_sock(self, sock):
+        """Сессия по сокету или None, если клиент не авторизован"""
+        return self.by_sock.get(sock)
+
+    def is_owner(self, name, sock):
+        """Принадлежит ли сокет пользователю name"""
+        session = self.by_sock.get(sock)
+        return session is not None and session.name == name
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(list(self.by_name.values()))
+
+    def __len__(self):
+        return len(self.by_name)
@@ -0,0 +1,205 @@
+import bisect
+import json
+import logging
+import os
+from collections import defaultdict
+
+from common.variables import ACTION, ACCOUNT_NAME, DESTINATION, ENCODING, \
+    SPOOL_SEGMENT_SIZE
+from common.utils import FRAME_HEADER, encode_message
+
+LOGGER = logging.getLogger('server')
+
+# Запись журнала о том, что сообщения пользователя доставлены, и
+# положение (номер сегмента, смещение) последнего доставленного кадра
+SPOOL_ACK = 'spool_ack'
+SPOOL_POSITION = 'position'
+SEGMENT_NAME = 'segment-{:08d}.log'
+
+
+class Spool:
+    """
+    Хранилище сообщений для пользователей не в сети.
+    Сообщения дописываются в журнал из сегментов - файлов с кадрами
+    протокола, тех же, что передаются по сети. Для каждого получателя в
+    памяти хранится список положений его сообщений в журнале, поэтому
+    сохранение сообщения - одна последовательная запись, а выдача
+    накопленного при входе - одно чтение диапазона каждого сегмента.
+    После подтверждения клиентом в журнал пишется отметка с положением
+    последнего доставленного сообщения получателя, а сегменты без
+    недоставленных сообщений удаляются. Отметка хранит положение, а не
+    число сообщений: после удаления сегментов с первыми сообщениями
+    число относилось бы к оставшимся
+    """
+
+    def __init__(self, directory, segment_size=SPOOL_SEGMENT_SIZE,
+                 sync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        # fsync после каждой записи: надёжнее при сбое питания, но медленнее
+        self.sync = sync
+        # получатель -> [(номер сегмента, смещение, длина кадра), ...]
+        self.index = defaultdict(list)
+        self.segments = []
+        self.active = None
+        self.active_size = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, SEGMENT_NAME.format(number))
+
+    def load(self):
+        """Восстановление индекса по журналу при запуске"""
+        self.segments = sorted(
+            int(name[8:16]) for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.log'))
+        for number in self.segments:
+            with open(self.segment_path(number), 'rb') as file:
+                data = file.read()
+            end = self.scan(number, data)
+            if end < len(data):
+                # Хвост недописанного кадра после аварийной остановки
+                LOGGER.warning(f'Журнал {number}: отброшено '
+                               f'{len(data) - end} байт')
+                with open(self.segment_path(number), 'r+b') as file:
+                    file.truncate(end)
+        if self.segments:
+            number = self.segments[-1]
+        else:
+            number = 1
+            self.segments.append(number)
+        self.open_segment(number)
+        self.compact()
+
+    def scan(self, number, data):
+        """Разбор сегмента, возвращает конец последнего целого кадра"""
+        offset = 0
+        while len(data) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(data, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(data):
+                break
+            try:
+                record = json.loads(
+                    data[offset + FRAME_HEADER.size:end].decode(ENCODING))
+            except ValueError:
+                break
+            if record.get(ACTION) == SPOOL_ACK:
+                position = record.get(SPOOL_POSITION)
+                self.remove(record[ACCOUNT_NAME],
+                            tuple(position) if position else None)
+            else:
+                self.index[record[DESTINATION]].append(
+                    (number, offset, end - offset))
+            offset = end
+        return offset
+
+    def open_segment(self, number):
+        if self.active:
+            self.active.close()
+        self.active = open(self.segment_path(number), 'ab')
+        self.active_size = self.active.tell()
+
+    def write(self, frame):
+        """Дозапись кадра в журнал, возвращает его положение"""
+        if self.active_size and \
+                self.active_size + len(frame) > self.segment_size:
+            self.segments.append(self.segments[-1] + 1)
+            self.open_segment(self.segments[-1])
+        position = (self.segments[-1], self.active_size, len(frame))
+        self.active.write(frame)
+        self.active.flush()
+        if self.sync:
+            os.fsync(self.active.fileno())
+        self.active_size += len(frame)
+        return position
+
+    def put(self, message):
+        """Сохранение сообщения для получателя не в сети"""
+        self.index[message[DESTINATION]].append(
+            self.write(encode_message(message)))
+
+    def pending(self, name):
+        """Число недоставленных сообщений пользователя"""
+        return len(self.index.get(name, ()))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def remove(self, name, position=None):
+        """Удаление из индекса сообщений получателя до положения
+        position (номер сегмента, смещение) включительно, всех - если
+        position не задано"""
+        entries = self.index.get(name)
+        if entries is None:
+            return
+        count = len(entries) if position is None else \
+            bisect.bisect_right(entries, position + (float('inf'),))
+        if count >= len(entries):
+            del self.index[name]
+        else:
+            del entries[:count]
+
+    def peek(self, name, limit=None):
+        """
+        Сообщения пользователя в виде готовых кадров в порядке
+        поступления, не больше limit байт, но не меньше одного.
+        Сообщения остаются в журнале до вызова ack
+        """
+        entries = self.index.get(name)
+        if not entries:
+            return []
+        if limit is not None:
+            size = 0
+            for count, (_, _, length) in enumerate(entries):
+                size += length
+                if count and size > limit:
+                    entries = entries[:count]
+                    break
+        by_segment = defaultdict(list)
+        for number, offset, length in entries:
+            by_segment[number].append((offset, length))
+        frames = []
+        for number in sorted(by_segment):
+            positions = by_segment[number]
+            start = positions[0][0]
+            end = positions[-1][0] + positions[-1][1]
+            with open(self.segment_path(number), 'rb') as file:
+                file.seek(start)
+                data = file.read(end - start)
+            for offset, length in positions:
+                frames.append(data[offset - start:offset - start + length])
+        return frames
+
+    def ack(self, name, count):
+        """Отметка о доставке первых count сообщений пользователя"""
+        entries = self.index.get(name)
+        if not count or not entries:
+            return
+        number, offset, _ = entries[min(count, len(entries)) - 1]
+        self.remove(name, (number, offset))
+        self.write(encode_message({ACTION: SPOOL_ACK, ACCOUNT_NAME: name,
+                                   SPOOL_POSITION: [number, offset]}))
+        self.compact()
+
+    def drain(self, name):
+        """
+        Выдача всех сообщений пользователя в виде готовых кадров
+        в порядке поступления. Сообщения считаются доставленными
+        """
+        frames = self.peek(name)
+        self.ack(name, len(frames))
+        return frames
+
+    def compact(self):
+        """Удаление начальных сегментов без недоставленных сообщений"""
+        oldest = min((entries[0][0] for entries in self.index.values()),
+                     default=self.segments[-1])
+        while self.segments[0] < oldest:
+            os.remove(self.segment_path(self.segments.pop(0)))
+
+    def close(self):
+        if self.active:
+            self.active.close()
+            self.active = None
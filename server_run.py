@@ -8,27 +8,42 @@ from PyQt5.QtCore import Qt
 
 from common.variables import *
 import logs.server_log_config
-from decos import log
+from decos import log, set_message_sample
 from database.server_db import ServerStorage
 from server.core import MessageProcessor
+from server.async_core import AsyncMessageProcessor
+from server.cluster import ClusterSupervisor
+from server.spool import Spool
 from server.main_window import MainWindow
 
 LOGGER = logging.getLogger('server')
 
+# Классы серверных движков по имени из настроек
+ENGINES = {
+    'select': MessageProcessor,
+    'asyncio': AsyncMessageProcessor,
+}
+
 
 @log
-def arg_parser(default_port, default_address):
+def arg_parser(default_port, default_address, default_engine,
+               default_workers):
     """Парсер аргументов коммандной строки"""
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-a', default=DEFAULT_IP_ADDRESS, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--engine', default=default_engine,
+                        choices=SERVER_ENGINES)
+    parser.add_argument('--workers', default=default_workers, type=int)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    engine = namespace.engine
+    workers = namespace.workers
     LOGGER.debug('Аргумнты успешно загружены')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, engine, workers
 
 
 @log
@@ -47,9 +62,40 @@ def config_load():
         config.set('SETTINGS', 'Listen_Address', '')
         config.set('SETTINGS', 'Database_path', '')
         config.set('SETTINGS', 'Database_file', 'server_db.db3')
+        config.set('SETTINGS', 'Engine', DEFAULT_SERVER_ENGINE)
+        config.set('SETTINGS', 'Outbox_high_watermark',
+                   str(OUTBOX_HIGH_WATERMARK))
+        config.set('SETTINGS', 'Outbox_low_watermark',
+                   str(OUTBOX_LOW_WATERMARK))
+        config.set('SETTINGS', 'Outbox_policy', OUTBOX_POLICY)
+        config.set('SETTINGS', 'Update_window', str(UPDATE_BROADCAST_WINDOW))
+        config.set('SETTINGS', 'Password_iterations',
+                   str(PASSWORD_ITERATIONS))
+        config.set('SETTINGS', 'Workers', '1')
+        config.set('SETTINGS', 'Spool_dir', 'spool')
+        config.set('SETTINGS', 'Flush_interval', str(WRITE_BEHIND_INTERVAL))
+        config.set('SETTINGS', 'Log_sample', str(LOG_MESSAGE_SAMPLE))
         return config
 
 
+def run_cluster(listen_address, listen_port, database_path, spool_dir,
+                flush_interval, workers, options, gui_flag):
+    """Многопроцессный режим: workers процессов на одном порту.
+    Работает только в консоли, окно сервера не поддерживается"""
+    if not gui_flag:
+        LOGGER.warning('Многопроцессный режим работает без GUI')
+    supervisor = ClusterSupervisor(listen_address, listen_port,
+                                   database_path, workers,
+                                   spool_dir=spool_dir,
+                                   flush_interval=flush_interval, **options)
+    supervisor.start()
+    try:
+        while input('Введите exit для завершения работы сервера.') != 'exit':
+            pass
+    finally:
+        supervisor.stop()
+
+
 @log
 def main():
     """Основная функция"""
@@ -57,15 +103,44 @@ def main():
 
     # Загрузка параметров из командной строки, если нет параметров, запуск со
     # значениями по умолчанию
-    listen_address, listen_port, gui_flag = arg_parser(
-        config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
-
-    database = ServerStorage(
-        os.path.join(
-            config['SETTINGS']['Database_path'],
-            config['SETTINGS']['Database_file']))
-
-    server = MessageProcessor(listen_address, listen_port, database)
+    settings = config['SETTINGS']
+    # Прореживание записей о приёме и отправке сообщений, 1 - без него
+    set_message_sample(settings.getint('Log_sample', LOG_MESSAGE_SAMPLE))
+    listen_address, listen_port, gui_flag, engine, workers = arg_parser(
+        settings['Default_port'],
+        settings['Listen_Address'],
+        settings.get('Engine', DEFAULT_SERVER_ENGINE),
+        settings.getint('Workers', 1))
+
+    database_path = os.path.join(settings['Database_path'],
+                                 settings['Database_file'])
+    # Журнал сообщений для пользователей не в сети хранится рядом с БД
+    spool_dir = os.path.join(settings['Database_path'],
+                             settings.get('Spool_dir', 'spool'))
+    # Окно отложенной записи статистики в БД, 0 - запись сразу
+    flush_interval = settings.getfloat('Flush_interval',
+                                       WRITE_BEHIND_INTERVAL)
+    server_options = {
+        'outbox_high': settings.getint('Outbox_high_watermark',
+                                       OUTBOX_HIGH_WATERMARK),
+        'outbox_low': settings.getint('Outbox_low_watermark',
+                                      OUTBOX_LOW_WATERMARK),
+        'outbox_policy': settings.get('Outbox_policy', OUTBOX_POLICY),
+        'update_window': settings.getfloat('Update_window',
+                                           UPDATE_BROADCAST_WINDOW),
+        'password_iterations': settings.getint('Password_iterations',
+                                               PASSWORD_ITERATIONS),
+    }
+
+    if workers > 1:
+        run_cluster(listen_address, listen_port, database_path, spool_dir,
+                    flush_interval, workers, server_options, gui_flag)
+        return
+
+    database = ServerStorage(database_path, flush_interval=flush_interval)
+
+    server = ENGINES[engine](listen_address, listen_port, database,
+                             spool=Spool(spool_dir), **server_options)
     server.daemon = True
     server.start()
 
@@ -73,7 +148,7 @@ def main():
         while True:
             command = input('Введите exit для завершения работы сервера.')
             if command == 'exit':
-                server.running = False
+                server.stop()
                 server.join()
                 break
     else:
@@ -83,7 +158,11 @@ def main():
 
         server_app.exec_()
 
-        server.running = False
+        server.stop()
+        server.join()
+
+    # Запись отложенной статистики перед выходом
+    database.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+import sys
+import os
+import binascii
+import hmac
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, \
+    PUBLIC_KEY, RESPONSE, DATA
+from common.utils import get_message, send_message, FrameDecoder
+from common.credentials import password_hash
+from database.server_db import ServerStorage
+from server.async_core import AsyncMessageProcessor
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=3):
+    """Ожидание условия, выполняемого потоком сервера"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestAsyncServer(unittest.TestCase):
+    """Тесты asyncio-движка сервера"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = ServerStorage(os.path.join(self.directory,
+                                                   'server.db3'))
+        for name in ('alice', 'bob'):
+            self.database.add_user(name, password_hash(name, '123'))
+        self.port = free_port()
+        self.server = AsyncMessageProcessor('127.0.0.1', self.port,
+                                            self.database, update_window=0.2)
+        self.server.daemon = True
+        self.server.start()
+        self.assertTrue(wait_for(lambda: self.server.loop is not None))
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.stop()
+        self.server.join(3)
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        expected = len(self.server.clients) + 1
+        for _ in range(50):
+            try:
+                sock = socket.create_connection(('127.0.0.1', self.port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.02)
+        sock.settimeout(3)
+        self.sockets.append(sock)
+        self.assertTrue(wait_for(
+            lambda: len(self.server.clients) == expected))
+        return sock
+
+    def login(self, name):
+        """Вход пользователя, возвращает сокет"""
+        sock = self.connect()
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(),
+                            USER: {ACCOUNT_NAME: name,
+                                   PUBLIC_KEY: f'key-{name}'}})
+        challenge = get_message(sock)
+        digest = hmac.new(password_hash(name, '123'),
+                          challenge[DATA].encode(), 'MD5').digest()
+        send_message(sock, {RESPONSE: 511,
+                            DATA: binascii.b2a_base64(digest).decode()})
+        self.assertEqual(get_message(sock)[RESPONSE], 200)
+        return sock
+
+    def assertReleased(self):
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.assertEqual(self.server.outboxes, {})
+        self.assertEqual(self.server.pending_auth, {})
+
+    def test_challenge(self):
+        sock = self.connect()
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(),
+                            USER: {ACCOUNT_NAME: 'alice',
+                                   PUBLIC_KEY: 'key'}})
+        self.assertEqual(get_message(sock)[RESPONSE], 511)
+        self.assertTrue(wait_for(lambda: len(self.server.pending_auth) == 1))
+        sock.close()
+        self.assertReleased()
+
+    def test_malformed_message(self):
+        """Сообщение без обязательных полей закрывает соединение и
+        освобождает всё, что сервер хранил для него"""
+        sock = self.connect()
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(), USER: {}})
+        self.assertEqual(sock.recv(1024), b'')
+        self.assertReleased()
+        # Сервер продолжает принимать подключения
+        self.connect()
+
+    def test_unauthorized(self):
+        sock = self.connect()
+        send_message(sock, {ACTION: 'unknown', TIME: time.time()})
+        self.assertEqual(sock.recv(1024), b'')
+        self.assertReleased()
+
+
+    def test_coalesced_updates(self):
+        """Изменения списка пользователей за одно окно рассылки
+        объединяются в одно уведомление 205 каждому клиенту"""
+        clients = [self.login(name) for name in ('alice', 'bob')]
+        for _ in range(5):
+            self.server.service_update_lists()
+        time.sleep(0.6)
+        for sock in clients:
+            self.assertEqual(FrameDecoder().feed(sock.recv(65536)),
+                             [{RESPONSE: 205}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import sys
+import os
+import unittest
+import binascii
+import hmac
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.variables import RESPONSE, DATA
+from server.auth import PendingAuth, verify_answer
+
+
+class TestVerifyAnswer(unittest.TestCase):
+    """Тесты проверки ответа клиента на запрос авторизации"""
+
+    passwd_hash = b'0123456789abcdef'
+    challenge = b'deadbeef'
+
+    def answer(self, passwd_hash):
+        digest = hmac.new(passwd_hash, self.challenge, 'MD5').digest()
+        return {RESPONSE: 511,
+                DATA: binascii.b2a_base64(digest).decode('ascii')}
+
+    def test_correct(self):
+        self.assertTrue(verify_answer(self.passwd_hash, self.challenge,
+                                      self.answer(self.passwd_hash)))
+
+    def test_wrong_password(self):
+        self.assertFalse(verify_answer(self.passwd_hash, self.challenge,
+                                       self.answer(b'other')))
+
+    def test_malformed(self):
+        """Некорректный ответ не вызывает исключений"""
+        self.assertFalse(verify_answer(self.passwd_hash, self.challenge,
+                                       {RESPONSE: 511}))
+        self.assertFalse(verify_answer(self.passwd_hash, self.challenge,
+                                       {RESPONSE: 200, DATA: ''}))
+
+    def test_expired(self):
+        pending = PendingAuth({}, self.passwd_hash, self.challenge, 5)
+        self.assertFalse(pending.expired(pending.deadline - 1))
+        self.assertTrue(pending.expired(pending.deadline))
+
+
+if __name__ == '__main__':
+    unittest.main()
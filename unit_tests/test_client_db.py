@@ -0,0 +1,177 @@
+import sys
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from database.client_db import ClientDatabase, unique_known_users
+from database.sqlite_setup import create_sqlite_engine
+
+# Классы записей ClientDatabase отображаются на таблицы один раз за
+# процесс, поэтому все тесты используют одну БД
+DATABASE = None
+
+
+def setUpModule():
+    global DATABASE
+    os.chdir(tempfile.mkdtemp())
+    DATABASE = ClientDatabase('test')
+
+
+class TestHistory(unittest.TestCase):
+    """Тесты постраничного чтения истории сообщений"""
+
+    @classmethod
+    def setUpClass(cls):
+        start = datetime(2020, 1, 1)
+        for number in range(10):
+            # по две записи с одной датой
+            DATABASE.save_message('bob', 'in', f'm{number}',
+                                  start + timedelta(seconds=number // 2))
+
+    def test_last_page(self):
+        page = DATABASE.get_history_page('bob', limit=3)
+        self.assertEqual([row[2] for row in page], ['m9', 'm8', 'm7'])
+
+    def test_keyset(self):
+        """Страницы по ключу (дата, id) без пропусков и повторов"""
+        messages = []
+        before_date = before_id = None
+        while True:
+            page = DATABASE.get_history_page('bob', before_date, before_id,
+                                             limit=3)
+            if not page:
+                break
+            messages += [row[2] for row in page]
+            before_id, _, _, before_date = page[-1]
+        self.assertEqual(messages, [f'm{number}' for number in
+                                    range(9, -1, -1)])
+
+    def test_before_date(self):
+        page = DATABASE.get_history_page('bob', datetime(2020, 1, 1, 0, 0, 2))
+        self.assertEqual([row[2] for row in page], ['m3', 'm2', 'm1', 'm0'])
+
+    def test_history(self):
+        history = DATABASE.get_history('bob')
+        self.assertEqual([row[2] for row in history],
+                         [f'm{number}' for number in range(10)])
+        self.assertEqual(DATABASE.get_history('alice'), [])
+
+
+class TestSearch(unittest.TestCase):
+    """Тесты полнотекстового поиска по истории"""
+
+    @classmethod
+    def setUpClass(cls):
+        DATABASE.save_message('carol', 'in', 'Встречаемся <завтра> в парке')
+        DATABASE.save_message('carol', 'out', 'Парк закрыт, встречаемся дома')
+        DATABASE.save_message('dave', 'in', 'Парковка платная')
+
+    def test_ranked_snippet(self):
+        found = DATABASE.search_messages('встречаемся парке', 'carol')
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0][1:3], ('carol', 'in'))
+        self.assertEqual(found[0][3], '<b>Встречаемся</b> &lt;завтра&gt; '
+                                      'в <b>парке</b>')
+
+    def test_prefix(self):
+        found = DATABASE.search_messages('парк')
+        self.assertEqual({row[1] for row in found}, {'carol', 'dave'})
+        self.assertEqual(len(DATABASE.search_messages('парк', 'dave')), 1)
+
+    def test_query_syntax(self):
+        """Операторы FTS5 в строке поиска - обычные слова"""
+        self.assertEqual(DATABASE.search_messages('парк OR "'), [])
+        self.assertEqual(DATABASE.search_messages('  '), [])
+
+    def test_rebuild(self):
+        row = DATABASE.save_message('erin', 'in', 'Уникальноеслово')
+        DATABASE.rebuild_search_index()
+        self.assertEqual(
+            [found[0] for found in
+             DATABASE.search_messages('уникальноеслово')], [row[0]])
+
+
+class TestWrites(unittest.TestCase):
+    """Тесты буфера истории и синхронизации контактов"""
+
+    def test_buffered_message(self):
+        """Запись из буфера видна чтению истории и получает тот же id"""
+        row = DATABASE.save_message('frank', 'out', 'buffered')
+        self.assertEqual(DATABASE.get_history_page('frank'), [row])
+        self.assertEqual(len(DATABASE.history_buffer), 0)
+
+    def test_replace_contacts(self):
+        DATABASE.replace_contacts(['a', 'b', 'c'])
+        DATABASE.add_contact('b')
+        DATABASE.replace_contacts(['b', 'c', 'd'])
+        self.assertEqual(sorted(DATABASE.get_contacts()), ['b', 'c', 'd'])
+        DATABASE.replace_contacts([])
+        self.assertEqual(DATABASE.get_contacts(), [])
+
+    def test_update_users(self):
+        """Уже известные пользователи из дельты не дублируются"""
+        DATABASE.add_users(['ann', 'ben'])
+        DATABASE.update_users(['ben', 'cid'], ['ann'])
+        self.assertEqual(sorted(DATABASE.get_users()), ['ben', 'cid'])
+
+    def test_unique_known_users(self):
+        """Миграция удаляет повторы из БД прежней версии"""
+        engine = create_sqlite_engine('legacy.db3')
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                'CREATE TABLE known_users (id INTEGER PRIMARY KEY, '
+                'username VARCHAR)')
+            connection.exec_driver_sql(
+                "INSERT INTO known_users (username) "
+                "VALUES ('ann'), ('ann'), ('ben')")
+        unique_known_users(engine, DATABASE.metadata)
+        with engine.connect() as connection:
+            users = [row[0] for row in connection.exec_driver_sql(
+                'SELECT username FROM known_users ORDER BY username')]
+        self.assertEqual(users, ['ann', 'ben'])
+
+
+class TestArchive(unittest.TestCase):
+    """Тесты переноса истории в архив"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Сообщения раньше остальных тестов: архивируются только они
+        start = datetime(2010, 1, 1)
+        for number in range(20):
+            DATABASE.save_message('grace', 'in', f'archive word{number}',
+                                  start + timedelta(days=10 * number))
+        cls.moved = DATABASE.archive_history(30, now=datetime(2010, 6, 1))
+
+    def test_moved(self):
+        # Старше 2 мая 2010 - сообщения до 120-го дня включительно
+        self.assertEqual(self.moved, 13)
+        self.assertEqual(len(DATABASE.get_history('grace')), 7)
+        self.assertEqual(DATABASE.archive_months()[-1],
+                         'message_archive_201001')
+
+    def test_pages(self):
+        """Прокрутка истории продолжается в архиве"""
+        messages = []
+        before_date = before_id = None
+        while True:
+            page = DATABASE.get_history_page('grace', before_date,
+                                             before_id, limit=4)
+            if not page:
+                break
+            messages += [row[2] for row in page]
+            before_id, _, _, before_date = page[-1]
+        self.assertEqual(messages, [f'archive word{number}' for number in
+                                    range(19, -1, -1)])
+
+    def test_search(self):
+        self.assertEqual(DATABASE.search_messages('word3'), [])
+        found = DATABASE.search_messages('word3', archive=True)
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0][1:4],
+                         ('grace', 'in', 'archive <b>word3</b>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import sys
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.variables import ACTION, USER, PUBLIC_KEY, MESSAGE, SENDER, \
+    DESTINATION, MESSAGE_TEXT, SPOOL_COUNT
+from common.utils import FrameDecoder
+from database.server_db import ServerStorage
+from server.async_core import AsyncMessageProcessor
+from server.cluster import ClusterMessageProcessor, CLUSTER_LOGIN, \
+    CLUSTER_CONTACTS, CLUSTER_DELIVER, CLUSTER_SPOOL, CLUSTER_SPOOLED, \
+    WORKER
+from server.spool import Spool
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestClusterSync(unittest.TestCase):
+    """Синхронизация справочников пользователей процессов сервера:
+    worker - процесс 0, изменения которого получает процесс 1"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'server.db3')
+        self.worker = ServerStorage(path)
+        self.worker.add_users([('alice', b'hash'), ('bob', b'hash')])
+        self.database = ServerStorage(path)
+        self.processor = ClusterMessageProcessor(
+            '127.0.0.1', free_port(), self.database, 1, 2, self.directory)
+
+    def tearDown(self):
+        self.processor.shutdown()
+        shutil.rmtree(self.directory)
+
+    def login(self, key):
+        self.worker.user_login('alice', '127.0.0.1', 7777, key)
+        self.worker.user_logout('alice')
+        self.processor.process_peer_message(
+            {ACTION: CLUSTER_LOGIN, USER: 'alice', WORKER: 0,
+             PUBLIC_KEY: key})
+
+    def test_pubkey(self):
+        """Ключ, переданный при входе через другой процесс, выдаётся
+        клиентам этого процесса, а об его смене они уведомляются"""
+        with mock.patch.object(AsyncMessageProcessor,
+                               'service_update_lists') as update:
+            self.login('key-1')
+            self.assertEqual(self.database.get_pubkey('alice'), 'key-1')
+            update.assert_not_called()
+            self.login('key-2')
+            self.assertEqual(self.database.get_pubkey('alice'), 'key-2')
+            update.assert_called_once_with()
+        self.assertEqual(self.processor.directory, {'alice': 0})
+
+    def test_contacts(self):
+        """Контакты, изменённые другим процессом, перечитываются из БД"""
+        self.worker.add_contact('alice', 'bob')
+        self.assertEqual(self.database.get_contacts('alice'), [])
+        self.processor.process_peer_message(
+            {ACTION: CLUSTER_CONTACTS, USER: 'alice'})
+        self.assertEqual(self.database.get_contacts('alice'), ['bob'])
+
+        self.worker.remove_contact('alice', 'bob')
+        self.processor.process_peer_message(
+            {ACTION: CLUSTER_CONTACTS, USER: 'alice'})
+        self.assertEqual(self.database.get_contacts('alice'), [])
+
+    def test_contacts_changed(self):
+        """Изменение контактов рассылается другим процессам"""
+        with mock.patch.object(self.processor, 'send_peers') as send_peers:
+            self.processor.contacts_changed('alice')
+        send_peers.assert_called_once_with(
+            {ACTION: CLUSTER_CONTACTS, USER: 'alice'})
+
+
+def message(text):
+    return {ACTION: MESSAGE, SENDER: 'alice', DESTINATION: 'bob',
+            MESSAGE_TEXT: text}
+
+
+class TestClusterDelivery(unittest.TestCase):
+    """Пересылка сообщений между процессами сервера: процесс 1 получает
+    сообщения от процесса 0 и пересылает ему накопленные в журнале"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = ServerStorage(
+            os.path.join(self.directory, 'server.db3'))
+        self.spool = Spool(os.path.join(self.directory, 'spool'))
+        self.processor = ClusterMessageProcessor(
+            '127.0.0.1', free_port(), self.database, 1, 2, self.directory,
+            spool=self.spool)
+        self.peer = mock.Mock()
+        self.processor.peers = {0: self.peer}
+
+    def tearDown(self):
+        self.processor.shutdown()
+        shutil.rmtree(self.directory)
+
+    def sent(self):
+        return FrameDecoder().feed(b''.join(
+            call.args[0] for call in self.peer.write.call_args_list))
+
+    def test_deliver_offline(self):
+        """Сообщение для уже отключившегося пользователя сохраняется
+        в журнал, а не теряется"""
+        self.processor.process_peer_message(
+            {ACTION: CLUSTER_DELIVER, MESSAGE: message('late')})
+        self.assertEqual(self.spool.pending('bob'), 1)
+
+    def test_forward_spooled(self):
+        """Сообщения из журнала удаляются только после подтверждения
+        процессом, через который вошёл получатель"""
+        self.spool.put(message('1'))
+        self.spool.put(message('2'))
+        self.processor.process_peer_message(
+            {ACTION: CLUSTER_LOGIN, USER: 'bob', WORKER: 0})
+        forwarded, = self.sent()
+        self.assertEqual(forwarded[ACTION], CLUSTER_SPOOL)
+        self.assertEqual([item[MESSAGE_TEXT] for item in forwarded[MESSAGE]],
+                         ['1', '2'])
+        self.assertEqual(self.spool.pending('bob'), 2)
+        self.processor.process_peer_message(
+            {ACTION: CLUSTER_SPOOLED, USER: 'bob', SPOOL_COUNT: 2})
+        self.assertNotIn('bob', self.spool)
+
+    def test_spool_received(self):
+        """Принятые из журнала другого процесса сообщения
+        подтверждаются"""
+        self.processor.process_peer_message(
+            {ACTION: CLUSTER_SPOOL, USER: 'bob', WORKER: 0,
+             MESSAGE: [message('1'), message('2')]})
+        self.assertEqual(self.spool.pending('bob'), 2)
+        self.assertEqual(self.sent(), [
+            {ACTION: CLUSTER_SPOOLED, USER: 'bob', SPOOL_COUNT: 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
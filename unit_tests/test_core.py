@@ -0,0 +1,218 @@
+import sys
+import os
+import binascii
+import hmac
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, \
+    PUBLIC_KEY, RESPONSE, DATA, ERROR, MESSAGE, SENDER, DESTINATION, \
+    MESSAGE_TEXT, SPOOL_REQUEST, SPOOL_DELIVERED, SPOOL_COUNT, \
+    PASSWORD_UPGRADE, KDF_ITERATIONS, KDF_UPGRADE
+from common.utils import get_message, send_message, FrameDecoder
+from common.credentials import password_hash, upgrade_key, seal_hash
+from database.server_db import ServerStorage
+from server import auth
+from server.core import MessageProcessor
+from server.spool import Spool
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=3):
+    """Ожидание условия, выполняемого потоком сервера"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestServer(unittest.TestCase):
+    """Тесты select-движка сервера"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = ServerStorage(os.path.join(self.directory,
+                                                   'server.db3'))
+        for name in ('alice', 'bob'):
+            self.database.add_user(name, password_hash(name, '123'))
+        self.port = free_port()
+        self.spool = Spool(os.path.join(self.directory, 'spool'))
+        self.server = MessageProcessor('127.0.0.1', self.port,
+                                       self.database, spool=self.spool,
+                                       update_window=0.2)
+        self.server.daemon = True
+        self.server.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.stop()
+        self.server.join(3)
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        for _ in range(50):
+            try:
+                sock = socket.create_connection(('127.0.0.1', self.port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.02)
+        sock.settimeout(3)
+        self.sockets.append(sock)
+        return sock
+
+    def login(self, name):
+        """Вход пользователя, возвращает сокет и ответ сервера"""
+        sock = self.connect()
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(),
+                            USER: {ACCOUNT_NAME: name,
+                                   PUBLIC_KEY: f'key-{name}'}})
+        challenge = self.challenge = get_message(sock)
+        self.assertEqual(challenge[RESPONSE], 511)
+        digest = hmac.new(password_hash(name, '123'),
+                          challenge[DATA].encode(), 'MD5').digest()
+        send_message(sock, {RESPONSE: 511,
+                            DATA: binascii.b2a_base64(digest).decode()})
+        return sock, get_message(sock)
+
+    def test_login(self):
+        sock, answer = self.login('alice')
+        self.assertEqual(answer[RESPONSE], 200)
+        self.assertTrue(self.server.is_online('alice'))
+
+    def test_password_upgrade(self):
+        """Новый хэш принимается только зашифрованным ключом из
+        прежнего хэша и случайной строки авторизации"""
+        self.server.password_iterations = 20000
+        sock, answer = self.login('alice')
+        self.assertEqual(self.challenge[KDF_UPGRADE], 20000)
+        new_hash = password_hash('alice', '123', 20000)
+        request = {ACTION: PASSWORD_UPGRADE, TIME: time.time(),
+                   ACCOUNT_NAME: 'alice', KDF_ITERATIONS: 20000}
+        send_message(sock, {**request, DATA: new_hash.decode()})
+        self.assertEqual(get_message(sock)[RESPONSE], 400)
+        key = upgrade_key(password_hash('alice', '123'),
+                          self.challenge[DATA].encode())
+        send_message(sock, {**request, DATA: seal_hash(
+            key, 'alice', 10000, new_hash)})
+        self.assertEqual(get_message(sock)[RESPONSE], 400)
+        send_message(sock, {**request, DATA: seal_hash(
+            key, 'alice', 20000, new_hash)})
+        self.assertEqual(get_message(sock)[RESPONSE], 200)
+        self.assertEqual(self.database.get_iterations('alice'), 20000)
+        self.assertEqual(self.database.get_hash('alice'), new_hash)
+
+    def test_user_removed_during_verification(self):
+        """Пользователь удалён, пока проверялся его ответ: отключается
+        только этот клиент, сервер продолжает работу"""
+        verifying = threading.Event()
+        removed = threading.Event()
+
+        def verify(*args):
+            verifying.set()
+            removed.wait(3)
+            return auth.verify_answer(*args)
+
+        with mock.patch('server.core.verify_answer', verify):
+            thread = threading.Thread(
+                target=lambda: setattr(self, 'result', self.login('alice')))
+            thread.start()
+            self.assertTrue(verifying.wait(3))
+            self.server.post(self.database.remove_user, 'alice')
+            self.server.post(removed.set)
+            thread.join(3)
+        sock, answer = self.result
+        self.assertEqual(answer[RESPONSE], 400)
+        self.assertIn(ERROR, answer)
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.assertFalse(self.server.is_online('alice'))
+
+        self.assertTrue(self.server.is_alive())
+        sock, answer = self.login('bob')
+        self.assertEqual(answer[RESPONSE], 200)
+
+    def test_failing_callback(self):
+        """Исключение в вызове, переданном в поток сервера, не
+        останавливает сервер"""
+        def reset():
+            raise ConnectionResetError
+
+        self.server.post(reset)
+        sock, answer = self.login('alice')
+        self.assertEqual(answer[RESPONSE], 200)
+        self.assertTrue(self.server.is_alive())
+
+
+    def spooled(self, sock):
+        """Запрос накопленных сообщений: тексты и ответ сервера"""
+        send_message(sock, {ACTION: SPOOL_REQUEST, TIME: time.time(),
+                            ACCOUNT_NAME: 'bob'})
+        texts = []
+        answer = get_message(sock)
+        while RESPONSE not in answer:
+            texts.append(answer[MESSAGE_TEXT])
+            answer = get_message(sock)
+        return texts, answer
+
+    def test_spool_delivery(self):
+        """Накопленные сообщения отправляются по запросу клиента и
+        удаляются из журнала только после его подтверждения"""
+        alice, _ = self.login('alice')
+        for text in ('a', 'b'):
+            send_message(alice, {ACTION: MESSAGE, SENDER: 'alice',
+                                 DESTINATION: 'bob', TIME: time.time(),
+                                 MESSAGE_TEXT: text})
+            self.assertEqual(get_message(alice)[RESPONSE], 200)
+
+        bob, _ = self.login('bob')
+        # До запроса сообщения не отправляются
+        bob.settimeout(0.3)
+        self.assertRaises(socket.timeout, bob.recv, 1024)
+        bob.settimeout(3)
+        texts, answer = self.spooled(bob)
+        self.assertEqual(texts, ['a', 'b'])
+        self.assertEqual(answer[SPOOL_COUNT], 2)
+        # Соединение разорвано до подтверждения: сообщения остаются
+        bob.close()
+        self.assertTrue(wait_for(lambda: not self.server.is_online('bob')))
+        self.assertEqual(self.spool.pending('bob'), 2)
+
+        bob, _ = self.login('bob')
+        texts, answer = self.spooled(bob)
+        self.assertEqual(texts, ['a', 'b'])
+        send_message(bob, {ACTION: SPOOL_DELIVERED, TIME: time.time(),
+                           ACCOUNT_NAME: 'bob', SPOOL_COUNT: 2})
+        self.assertEqual(get_message(bob)[RESPONSE], 200)
+        self.assertNotIn('bob', self.spool)
+        self.assertEqual(self.spooled(bob), ([], {RESPONSE: 200,
+                                                  SPOOL_COUNT: 0}))
+
+
+    def test_coalesced_updates(self):
+        """Изменения списка пользователей за одно окно рассылки
+        объединяются в одно уведомление 205 каждому клиенту"""
+        clients = [self.login(name)[0] for name in ('alice', 'bob')]
+        for _ in range(5):
+            self.server.service_update_lists()
+        time.sleep(0.6)
+        for sock in clients:
+            self.assertEqual(FrameDecoder().feed(sock.recv(65536)),
+                             [{RESPONSE: 205}])
+
+
+if __name__ == '__main__':
+    unittest.main()
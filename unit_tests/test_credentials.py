@@ -0,0 +1,54 @@
+import sys
+import os
+import unittest
+import binascii
+import hashlib
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.credentials import Credentials, password_hash, upgrade_key, \
+    seal_hash, open_hash
+
+
+class TestCredentials(unittest.TestCase):
+    """Тесты хэша пароля клиента"""
+
+    def test_compatible_hash(self):
+        """Хэш совпадает с вычисляемым прежними версиями"""
+        expected = binascii.hexlify(hashlib.pbkdf2_hmac(
+            'sha512', b'123', b'test1', 10000))
+        self.assertEqual(password_hash('Test1', '123'), expected)
+        self.assertEqual(Credentials('Test1', '123').passwd_hash(), expected)
+
+    def test_cached(self):
+        """Хэш вычисляется один раз для каждого числа итераций"""
+        credentials = Credentials('test1', '123')
+        first = credentials.passwd_hash(1000)
+        self.assertIs(credentials.passwd_hash(1000), first)
+        self.assertNotEqual(credentials.passwd_hash(2000), first)
+
+    def test_clear(self):
+        """Пароль и хэши затираются"""
+        credentials = Credentials('test1', '123')
+        passwd_hash = credentials.passwd_hash(1000)
+        credentials.clear()
+        self.assertEqual(set(passwd_hash), {0})
+        self.assertEqual(set(credentials.password), {0})
+        self.assertEqual(credentials.hashes, {})
+
+
+    def test_sealed_hash(self):
+        """Новый хэш расшифровывается только тем же ключом, для того же
+        имени и числа итераций"""
+        new_hash = password_hash('test1', '123', 20000)
+        key = upgrade_key(password_hash('test1', '123'), b'challenge')
+        sealed = seal_hash(key, 'test1', 20000, new_hash)
+        self.assertNotIn(new_hash.decode(), sealed)
+        self.assertEqual(open_hash(key, 'test1', 20000, sealed), new_hash)
+        other = upgrade_key(password_hash('test1', '123'), b'other')
+        for args in ((other, 'test1', 20000), (key, 'test2', 20000),
+                     (key, 'test1', 30000)):
+            with self.assertRaises(ValueError):
+                open_hash(*args, sealed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import sys
+import os
+import base64
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from client.crypto import MessageCipher
+
+
+class TestMessageCipher(unittest.TestCase):
+    """Тесты гибридного шифрования сообщений"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.alice_keys = RSA.generate(2048)
+        cls.bob_keys = RSA.generate(2048)
+        cls.bob_pubkey = cls.bob_keys.publickey().export_key().decode('ascii')
+
+    def setUp(self):
+        self.alice = MessageCipher(self.alice_keys, 'alice')
+        self.bob = MessageCipher(self.bob_keys, 'bob')
+
+    def test_round_trip(self):
+        """Сообщения любой длины, один сеансовый ключ на собеседника"""
+        for text in ('привет', 'x' * 100000):
+            encrypted = self.alice.encrypt('bob', self.bob_pubkey, text)
+            self.assertEqual(self.bob.decrypt('alice', encrypted), text)
+        self.assertEqual(len(self.alice.sessions), 1)
+        self.assertEqual(len(self.bob.incoming), 1)
+
+    def test_wrong_sender(self):
+        """Сообщение, выданное за сообщение другого отправителя,
+        не расшифровывается"""
+        encrypted = self.alice.encrypt('bob', self.bob_pubkey, 'test')
+        with self.assertRaises(ValueError):
+            self.bob.decrypt('carol', encrypted)
+
+    def test_legacy(self):
+        """Сообщения прежнего формата (RSA-OAEP) расшифровываются"""
+        encrypted = base64.b64encode(PKCS1_OAEP.new(
+            self.bob_keys.publickey()).encrypt('test'.encode('utf-8')))
+        self.assertEqual(
+            self.bob.decrypt('alice', encrypted.decode('ascii')), 'test')
+
+    def test_rotation(self):
+        """Новый ключ собеседника - новый сеансовый ключ"""
+        self.alice.encrypt('bob', self.bob_pubkey, 'test')
+        key_id = self.alice.sessions['bob'].key_id
+        other = RSA.generate(2048).publickey().export_key().decode('ascii')
+        self.alice.encrypt('bob', other, 'test')
+        self.assertNotEqual(self.alice.sessions['bob'].key_id, key_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import sys
+import os
+import logging
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+import decos
+from decos import log, LOGGER, set_message_sample
+
+
+class Argument:
+    """Аргумент, считающий построения своего представления"""
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __repr__(self):
+        self.formatted += 1
+        return 'x' * 1000
+
+
+class TestLog(unittest.TestCase):
+    """Тесты декоратора log"""
+
+    def setUp(self):
+        self.level = LOGGER.level
+
+    def tearDown(self):
+        LOGGER.setLevel(self.level)
+        set_message_sample(decos.LOG_MESSAGE_SAMPLE)
+
+    def test_disabled(self):
+        """При отключённом DEBUG аргументы не форматируются"""
+        LOGGER.setLevel(logging.INFO)
+        argument = Argument()
+        function = log(lambda value: value)
+        self.assertIs(function(argument), argument)
+        self.assertEqual(argument.formatted, 0)
+
+    def test_sample_and_truncate(self):
+        LOGGER.setLevel(logging.DEBUG)
+
+        @log(sample=5, max_length=10)
+        def function(value, key=None):
+            return value
+
+        self.assertEqual(function.__name__, 'function')
+        with self.assertLogs(LOGGER, logging.DEBUG) as logs:
+            for _ in range(10):
+                function(Argument(), key='k')
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("xxxxxxxxxx..., key='k'", logs.output[0])
+
+    def test_message_sample(self):
+        """sample=None по умолчанию записывает каждый
+        LOG_MESSAGE_SAMPLE-й вызов, set_message_sample(1) - каждый"""
+        LOGGER.setLevel(logging.DEBUG)
+        function = log(sample=None)(lambda value: value)
+        with self.assertLogs(LOGGER, logging.DEBUG) as logs:
+            for number in range(decos.LOG_MESSAGE_SAMPLE * 2):
+                function(number)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('параметрами 0.', logs.output[0])
+        set_message_sample(1)
+        with self.assertLogs(LOGGER, logging.DEBUG) as logs:
+            for number in range(10):
+                function(number)
+        self.assertEqual(len(logs.records), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
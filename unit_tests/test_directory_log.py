@@ -0,0 +1,38 @@
+import sys
+import os
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from database.directory_log import DirectoryLog
+
+
+class TestDirectoryLog(unittest.TestCase):
+    """Тесты журнала изменений справочника пользователей"""
+
+    def setUp(self):
+        self.log = DirectoryLog(limit=3)
+
+    def test_changes(self):
+        """Для каждого логина возвращается последнее изменение"""
+        self.log.record('alice', True)
+        self.log.record('bob', True)
+        self.log.record('alice', False)
+        version, changes = self.log.changes_since(self.log.epoch, 1)
+        self.assertEqual(version, 3)
+        self.assertEqual(changes, {'alice': False, 'bob': True})
+        self.assertEqual(self.log.changes_since(self.log.epoch, 3), (3, {}))
+
+    def test_snapshot_required(self):
+        """Полный список нужен клиенту из другой эпохи, отставшему
+        сильнее журнала или с некорректной версией"""
+        for name in ('a', 'b', 'c', 'd'):
+            self.log.record(name, True)
+        self.assertIsNone(self.log.changes_since('other', 4)[1])
+        self.assertIsNone(self.log.changes_since(self.log.epoch, 0)[1])
+        self.assertIsNone(self.log.changes_since(self.log.epoch, 5)[1])
+        self.assertIsNone(self.log.changes_since(self.log.epoch, 'x')[1])
+        self.assertEqual(self.log.changes_since(self.log.epoch, 1)[1],
+                         {'b': True, 'c': True, 'd': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
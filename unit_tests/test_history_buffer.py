@@ -0,0 +1,88 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, \
+    CheckConstraint, select
+from database.history_buffer import HistoryBuffer
+from database.sqlite_setup import create_sqlite_engine
+
+
+class TestHistoryBuffer(unittest.TestCase):
+    """Тесты буфера записи истории сообщений"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_sqlite_engine(
+            os.path.join(self.directory, 'client.db3'))
+        self.table = Table(
+            'message_history', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('from_user', String),
+            Column('to_user', String),
+            # Сообщение 'bad' не может быть записано
+            Column('message', String, CheckConstraint("message != 'bad'")),
+            Column('date', DateTime))
+        self.table.create(self.engine)
+        self.buffer = HistoryBuffer(self.engine, self.table, 60, 1000,
+                                    retries=3)
+
+    def tearDown(self):
+        self.buffer.close()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def add(self, message):
+        return self.buffer.add('alice', 'in', message, datetime.now())
+
+    def stored(self):
+        with self.engine.connect() as connection:
+            return connection.execute(select(
+                self.table.c.id, self.table.c.message).order_by(
+                self.table.c.id)).all()
+
+    def test_flush(self):
+        ids = [self.add(text) for text in ('a', 'b')]
+        self.assertEqual(self.stored(), [])
+        self.buffer.flush()
+        self.assertEqual(self.stored(), list(zip(ids, ('a', 'b'))))
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_id_collision(self):
+        """id, занятый записью в обход буфера, не мешает записи: такое
+        сообщение получает id от SQLite, следующие - после занятых"""
+        taken = self.add('a')
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(), {
+                'id': taken, 'message': 'direct'})
+        self.add('b')
+        self.buffer.flush()
+        self.assertEqual([text for _, text in self.stored()],
+                         ['direct', 'a', 'b'])
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(self.add('c'), max(row[0] for row in
+                                            self.stored()) + 1)
+
+    def test_failing_message_dropped(self):
+        """Сообщение, которое не удаётся записать, не задерживает
+        остальные и отбрасывается после исчерпания попыток"""
+        for text in ('a', 'bad', 'b'):
+            self.add(text)
+        self.buffer.flush()
+        self.assertEqual([text for _, text in self.stored()], ['a', 'b'])
+        self.assertEqual(len(self.buffer), 1)
+        self.add('c')
+        self.buffer.flush()
+        self.assertEqual(len(self.buffer), 1)
+        self.buffer.flush()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(self.buffer.failures, {})
+        self.assertEqual([text for _, text in self.stored()],
+                         ['a', 'b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
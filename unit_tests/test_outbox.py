@@ -0,0 +1,123 @@
+import sys
+import os
+import asyncio
+import socket
+import time
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from server.outbox import Outbox, StreamOutbox, POLICY_DISCONNECT, \
+    POLICY_DROP
+
+# Больше, чем вмещают буферы ядра пары сокетов
+FRAME = 1024 * 1024
+
+
+class TestOutbox(unittest.TestCase):
+    """Тесты очереди отправки соединения на настоящей паре сокетов:
+    получатель не читает данные, пока этого не делает тест"""
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.sender.setblocking(False)
+        self.receiver.settimeout(3)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def receive(self, size):
+        data = b''
+        while len(data) < size:
+            data += self.receiver.recv(size - len(data))
+        return data
+
+    def test_partial_flush(self):
+        """Заполненный буфер сокета не блокирует отправку: остаток кадра
+        и следующие кадры остаются в очереди в прежнем порядке"""
+        outbox = Outbox(8 * FRAME, FRAME, POLICY_DISCONNECT)
+        frames = [bytes([number]) * FRAME for number in range(4)]
+        for frame in frames:
+            outbox.put(frame)
+        start = time.monotonic()
+        self.assertFalse(outbox.flush(self.sender))
+        self.assertLess(time.monotonic() - start, 0.5)
+        sent = 4 * FRAME - outbox.pending_size()
+        self.assertTrue(0 < sent < 4 * FRAME)
+
+        data = b''
+        while not outbox.flush(self.sender):
+            data += self.receiver.recv(FRAME)
+        data += self.receive(4 * FRAME - len(data))
+        self.assertEqual(data, b''.join(frames))
+        self.assertEqual(outbox.pending_size(), 0)
+
+    def test_would_block(self):
+        """Буфер сокета полон - данные остаются в очереди"""
+        outbox = Outbox(8 * FRAME, FRAME, POLICY_DISCONNECT)
+        outbox.put(b'x' * 4 * FRAME)
+        outbox.flush(self.sender)
+        outbox.put(b'abc')
+        size = outbox.pending_size()
+        self.assertFalse(outbox.flush(self.sender))
+        self.assertEqual(outbox.pending_size(), size)
+        self.assertEqual(len(outbox), 2)
+
+    def test_unsent_frames(self):
+        """Частично отправленный кадр возвращается целиком"""
+        outbox = Outbox(8 * FRAME, FRAME, POLICY_DISCONNECT)
+        frames = [b'a' * 4 * FRAME, b'ghij', b'kl']
+        for frame in frames:
+            outbox.put(frame)
+        outbox.flush(self.sender)
+        self.assertLess(outbox.pending_size(), 4 * FRAME + 6)
+        self.assertEqual(outbox.unsent_frames(), frames)
+
+    def test_disconnect_policy(self):
+        """Переполнение при политике disconnect"""
+        outbox = Outbox(10, 5, POLICY_DISCONNECT)
+        self.assertTrue(outbox.put(b'x' * 8))
+        self.assertFalse(outbox.put(b'x' * 8))
+
+    def test_drop_policy(self):
+        """При политике drop кадры отбрасываются до разгрузки очереди"""
+        outbox = Outbox(10, 5, POLICY_DROP)
+        self.assertTrue(outbox.put(b'x' * 8))
+        self.assertTrue(outbox.put(b'y' * 8))
+        self.assertEqual(outbox.pending_size(), 8)
+        self.assertTrue(outbox.flush(self.sender))
+        # очередь разгружена - приём возобновлён
+        self.assertTrue(outbox.put(b'z'))
+        self.assertEqual(outbox.pending_size(), 1)
+        outbox.flush(self.sender)
+        self.assertEqual(self.receive(9), b'x' * 8 + b'z')
+
+
+    def test_stream_unsent_frames(self):
+        """Очередь asyncio-движка возвращает кадры, оставшиеся в буфере
+        транспорта, и забывает отправленные"""
+        async def scenario():
+            loop = asyncio.get_running_loop()
+            self.receiver.setblocking(False)
+            _, writer = await asyncio.open_connection(sock=self.sender)
+            outbox = StreamOutbox(writer, 8 * FRAME, FRAME,
+                                  POLICY_DISCONNECT)
+            frames = [bytes([number]) * FRAME for number in range(4)]
+            for frame in frames:
+                outbox.put(frame)
+            unsent = outbox.unsent_frames()
+            self.assertTrue(0 < len(unsent) <= 4)
+            self.assertEqual(unsent, frames[-len(unsent):])
+
+            data = b''
+            while len(data) < 4 * FRAME:
+                data += await loop.sock_recv(self.receiver, FRAME)
+            self.assertEqual(data, b''.join(frames))
+            self.assertEqual(outbox.unsent_frames(), [])
+            writer.close()
+            await writer.wait_closed()
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
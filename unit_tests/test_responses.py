@@ -0,0 +1,49 @@
+import sys
+import os
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.variables import RESPONSE, ERROR, LIST_INFO, DATA, \
+    RESPONSE_400, REQUEST_ID
+from common.utils import FrameDecoder
+from common.responses import FRAME_200, FRAME_205, frame_202, frame_400, \
+    frame_511, response_400, with_request_id
+
+
+class TestResponses(unittest.TestCase):
+    """Тесты шаблонов ответов сервера"""
+
+    def decode(self, frame):
+        return FrameDecoder().feed(frame)
+
+    def test_constant_frames(self):
+        """Готовые кадры постоянных ответов"""
+        self.assertEqual(self.decode(FRAME_200), [{RESPONSE: 200}])
+        self.assertEqual(self.decode(FRAME_205), [{RESPONSE: 205}])
+
+    def test_parametrized_frames(self):
+        """Кадры ответов с параметром"""
+        self.assertEqual(self.decode(frame_400('Ошибка')),
+                         [{RESPONSE: 400, ERROR: 'Ошибка'}])
+        self.assertEqual(self.decode(frame_202(['a', 'b'])),
+                         [{RESPONSE: 202, LIST_INFO: ['a', 'b']}])
+        self.assertEqual(self.decode(frame_511('key')),
+                         [{RESPONSE: 511, DATA: 'key'}])
+
+    def test_request_id(self):
+        """Номер запроса добавляется в готовый кадр"""
+        self.assertEqual(self.decode(with_request_id(FRAME_200, 7)),
+                         [{RESPONSE: 200, REQUEST_ID: 7}])
+        self.assertEqual(self.decode(with_request_id(frame_202(['a']), 'x')),
+                         [{RESPONSE: 202, LIST_INFO: ['a'], REQUEST_ID: 'x'}])
+        self.assertIs(with_request_id(FRAME_205, None), FRAME_205)
+
+    def test_templates_immutable(self):
+        """Шаблоны нельзя изменить, сборка ответа их не трогает"""
+        with self.assertRaises(TypeError):
+            RESPONSE_400[ERROR] = 'Ошибка'
+        response_400('Ошибка')
+        self.assertIsNone(RESPONSE_400[ERROR])
+
+
+if __name__ == '__main__':
+    unittest.main()
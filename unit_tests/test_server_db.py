@@ -0,0 +1,165 @@
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.variables import PASSWORD_ITERATIONS
+from database.server_db import ServerStorage
+
+# Схема БД сервера до миграций: без индексов, уникальности контактов и
+# числа итераций хэша пароля
+BASELINE_SCHEMA = '''
+CREATE TABLE all_users (id INTEGER PRIMARY KEY, login VARCHAR UNIQUE,
+    last_connect DATETIME, passwd_hash VARCHAR, pubkey TEXT);
+CREATE TABLE active_users (id INTEGER PRIMARY KEY,
+    user VARCHAR UNIQUE REFERENCES all_users (id), ip VARCHAR,
+    port INTEGER, time_connect DATETIME);
+CREATE TABLE login_history (id INTEGER PRIMARY KEY,
+    user VARCHAR REFERENCES all_users (id), ip VARCHAR, port INTEGER,
+    last_connection DATETIME);
+CREATE TABLE users_contacts (id INTEGER PRIMARY KEY,
+    user VARCHAR REFERENCES all_users (id),
+    contact VARCHAR REFERENCES all_users (id));
+CREATE TABLE users_history (id INTEGER PRIMARY KEY,
+    user VARCHAR REFERENCES all_users (id), sent INTEGER,
+    accepted INTEGER);
+CREATE INDEX ix_users_contacts_user ON users_contacts (user);
+INSERT INTO all_users (id, login, passwd_hash) VALUES
+    (1, 'alice', 'hash-a'), (2, 'bob', 'hash-b'), (3, 'carol', 'hash-c');
+INSERT INTO users_history (user, sent, accepted) VALUES
+    (1, 0, 0), (2, 0, 0), (3, 0, 0);
+INSERT INTO users_contacts (user, contact) VALUES
+    (1, 2), (1, 2), (1, 3), (2, 1), (2, 1);
+'''
+
+
+class TestServerStorage(unittest.TestCase):
+    """Тесты групповых операций со справочником пользователей"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'server.db3')
+        self.storage = ServerStorage(self.path)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        """Справочник, заново прочитанный из БД"""
+        self.storage.close()
+        self.storage = ServerStorage(self.path)
+        return self.storage
+
+    def test_add_users(self):
+        """Добавление одной транзакцией, повторы пропускаются"""
+        users = [(f'user{number}', b'hash') for number in range(1200)]
+        self.assertEqual(self.storage.add_users(users, iterations=20000),
+                         1200)
+        self.assertEqual(self.storage.add_users(
+            users[:10] + [('extra', b'hash')]), 1)
+        storage = self.reopen()
+        self.assertEqual(len(storage.user_logins()), 1201)
+        self.assertEqual(storage.get_iterations('user1199'), 20000)
+        self.assertEqual(storage.get_iterations('extra'),
+                         PASSWORD_ITERATIONS)
+        self.assertEqual(len(storage.message_history()), 1201)
+
+    def test_add_contacts(self):
+        """Неизвестные пользователи и повторы пропускаются"""
+        self.storage.add_users([('alice', b'a'), ('bob', b'b'),
+                                ('carol', b'c')])
+        self.storage.add_contacts([('alice', 'bob'), ('alice', 'bob'),
+                                   ('alice', 'carol'), ('alice', 'nobody'),
+                                   ('nobody', 'bob'), ('bob', 'alice')])
+        self.storage.add_contact('alice', 'bob')
+        self.assertEqual(self.storage.get_contacts('alice'),
+                         ['bob', 'carol'])
+        storage = self.reopen()
+        self.assertEqual(storage.get_contacts('alice'), ['bob', 'carol'])
+        self.assertEqual(storage.get_contacts('bob'), ['alice'])
+        storage.remove_contacts([('alice', 'bob'), ('alice', 'nobody')])
+        self.assertEqual(self.reopen().get_contacts('alice'), ['carol'])
+
+    def test_remove_users(self):
+        """Удаление пользователей со связанными записями"""
+        self.storage.add_users([('alice', b'a'), ('bob', b'b'),
+                                ('carol', b'c')])
+        self.storage.add_contacts([('alice', 'bob'), ('bob', 'alice'),
+                                   ('carol', 'bob')])
+        self.storage.user_login('bob', '127.0.0.1', 7777, 'key')
+        self.storage.remove_users(['bob', 'carol', 'nobody'])
+        self.assertEqual(self.storage.user_logins(), ['alice'])
+        self.assertEqual(self.storage.get_contacts('alice'), [])
+        self.assertEqual(self.storage.active_users_list(), [])
+        self.assertEqual(self.storage.login_history(), [])
+        storage = self.reopen()
+        self.assertEqual(storage.user_logins(), ['alice'])
+        self.assertEqual(storage.get_contacts('alice'), [])
+        self.assertEqual([row[0] for row in storage.message_history()],
+                         ['alice'])
+        # Имя удалённого пользователя можно зарегистрировать снова
+        self.assertEqual(storage.add_users([('bob', b'b')]), 1)
+
+
+class TestMigrations(unittest.TestCase):
+    """Обновление схемы БД, созданной первой версией сервера"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'server.db3')
+        with sqlite3.connect(self.path) as connection:
+            connection.executescript(BASELINE_SCHEMA)
+        connection.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def query(self, sql):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_upgrade(self):
+        storage = ServerStorage(self.path)
+        storage.close()
+        self.assertEqual(self.query('PRAGMA user_version'),
+                         [(len(ServerStorage.MIGRATIONS),)])
+        # unique_contacts: повторы удалены, индекс уникальный
+        self.assertEqual(self.query(
+            'SELECT user, contact FROM users_contacts ORDER BY id'),
+            [('1', '2'), ('1', '3'), ('2', '1')])
+        indexes = {name: unique for _, name, unique, *_ in
+                   self.query('PRAGMA index_list(users_contacts)')}
+        self.assertEqual(indexes.get('ux_users_contacts'), 1)
+        self.assertNotIn('ix_users_contacts_user', indexes)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.query('INSERT INTO users_contacts (user, contact) '
+                       'VALUES (1, 2)')
+        # password_iterations: прежние хэши вычислены с числом итераций
+        # по умолчанию
+        self.assertEqual(storage.get_iterations('alice'),
+                         PASSWORD_ITERATIONS)
+        self.assertEqual(storage.get_hash('alice'), 'hash-a')
+        self.assertEqual(storage.get_contacts('alice'), ['bob', 'carol'])
+
+    def test_upgrade_once(self):
+        """Повторный запуск не применяет миграции заново"""
+        ServerStorage(self.path).close()
+        storage = ServerStorage(self.path)
+        storage.add_contact('bob', 'carol')
+        storage.close()
+        self.assertEqual(self.query('PRAGMA user_version'),
+                         [(len(ServerStorage.MIGRATIONS),)])
+        self.assertEqual(len(self.query('SELECT * FROM users_contacts')), 4)
+        storage = ServerStorage(self.path)
+        self.assertEqual(storage.get_contacts('bob'), ['alice', 'carol'])
+        storage.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import sys
+import os
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from server.sessions import SessionRegistry
+
+
+class TestSessionRegistry(unittest.TestCase):
+    """Тесты реестра сессий сервера"""
+
+    def setUp(self):
+        self.registry = SessionRegistry()
+        self.sock = object()
+        self.registry.add('test', self.sock)
+
+    def test_lookup(self):
+        """Поиск сессии по имени и по сокету"""
+        self.assertIn('test', self.registry)
+        self.assertIs(self.registry.get('test').sock, self.sock)
+        self.assertEqual(self.registry.get_by_sock(self.sock).name, 'test')
+        self.assertTrue(self.registry.is_owner('test', self.sock))
+        self.assertFalse(self.registry.is_owner('other', self.sock))
+
+    def test_remove(self):
+        """Удаление сессии убирает оба индекса"""
+        self.assertEqual(self.registry.remove(self.sock).name, 'test')
+        self.assertNotIn('test', self.registry)
+        self.assertIsNone(self.registry.get_by_sock(self.sock))
+        self.assertIsNone(self.registry.remove(self.sock))
+        self.assertEqual(len(self.registry), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
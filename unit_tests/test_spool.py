@@ -0,0 +1,108 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from common.variables import ACTION, MESSAGE, SENDER, DESTINATION, \
+    MESSAGE_TEXT
+from common.utils import FrameDecoder
+from server.spool import Spool
+
+
+def message(destination, text):
+    return {ACTION: MESSAGE, SENDER: 'test', DESTINATION: destination,
+            MESSAGE_TEXT: text}
+
+
+class TestSpool(unittest.TestCase):
+    """Тесты журнала сообщений для пользователей не в сети"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory, segment_size=256)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def drain(self, spool, name):
+        return [msg[MESSAGE_TEXT] for msg in
+                FrameDecoder().feed(b''.join(spool.drain(name)))]
+
+    def test_drain_in_order(self):
+        """Сообщения выдаются по получателю в порядке поступления"""
+        for i in range(10):
+            self.spool.put(message('alice' if i % 2 else 'bob', str(i)))
+        self.assertEqual(self.spool.pending('alice'), 5)
+        self.assertEqual(self.drain(self.spool, 'alice'),
+                         ['1', '3', '5', '7', '9'])
+        self.assertNotIn('alice', self.spool)
+        self.assertEqual(self.drain(self.spool, 'alice'), [])
+        self.assertEqual(self.spool.pending('bob'), 5)
+
+    def test_reload(self):
+        """После перезапуска доставленные сообщения не выдаются повторно"""
+        self.spool.put(message('alice', 'a'))
+        self.spool.put(message('bob', 'b'))
+        self.drain(self.spool, 'alice')
+        self.spool.close()
+        self.spool = Spool(self.directory, segment_size=256)
+        self.assertNotIn('alice', self.spool)
+        self.assertEqual(self.drain(self.spool, 'bob'), ['b'])
+
+    def test_truncated_tail(self):
+        """Недописанный кадр в конце журнала отбрасывается"""
+        self.spool.put(message('alice', 'a'))
+        self.spool.active.write(b'\x00\x00\x01\x00{"act')
+        self.spool.close()
+        self.spool = Spool(self.directory, segment_size=256)
+        self.assertEqual(self.drain(self.spool, 'alice'), ['a'])
+
+    def test_compact(self):
+        """Сегменты без недоставленных сообщений удаляются"""
+        for i in range(20):
+            self.spool.put(message('alice', str(i)))
+        self.assertGreater(len(self.spool.segments), 1)
+        self.drain(self.spool, 'alice')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+    def test_peek_and_ack(self):
+        """Сообщения остаются в журнале до подтверждения, в том числе
+        после перезапуска, и подтверждаются по числу первых"""
+        for i in range(5):
+            self.spool.put(message('alice', str(i)))
+        frames = self.spool.peek('alice')
+        self.assertEqual(len(frames), 5)
+        self.assertEqual(self.spool.peek('alice'), frames)
+        self.spool.ack('alice', 2)
+        self.assertEqual(self.spool.pending('alice'), 3)
+        self.spool.close()
+        self.spool = Spool(self.directory, segment_size=256)
+        self.assertEqual(self.drain(self.spool, 'alice'), ['2', '3', '4'])
+
+    def test_peek_limit(self):
+        """Выдача ограничена по размеру, но не меньше одного сообщения"""
+        for i in range(5):
+            self.spool.put(message('alice', str(i)))
+        length = len(self.spool.peek('alice')[0])
+        self.assertEqual(len(self.spool.peek('alice', 2 * length)), 2)
+        self.assertEqual(len(self.spool.peek('alice', 1)), 1)
+
+    def test_ack_after_compact(self):
+        """Отметка о доставке не относится к оставшимся сообщениям
+        после удаления сегментов с доставленными"""
+        self.spool.close()
+        self.spool = Spool(self.directory, segment_size=60)
+        for i in range(5):
+            self.spool.put(message('bob', str(i)))
+        self.assertEqual(len(self.spool.peek('bob', 200)), 2)
+        self.spool.ack('bob', 2)
+        self.spool.close()
+        self.spool = Spool(self.directory, segment_size=60)
+        self.assertEqual(self.spool.pending('bob'), 3)
+        self.assertEqual(self.drain(self.spool, 'bob'), ['2', '3', '4'])
+
+if __name__ == '__main__':
+    unittest.main()
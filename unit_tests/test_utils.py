@@ -5,7 +5,8 @@ import json
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
 from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, \
     ACTION, PRESENCE, ENCODING
-from common.utils import get_message, send_message
+from common.utils import get_message, get_messages, send_message, \
+    encode_message, FrameDecoder, FRAME_HEADER
 
 
 class TestSocket:
@@ -17,20 +18,30 @@ class TestSocket:
         self.encoded_message = None
         self.received_message = None
 
-    def send(self, message_to_send):
+    def sendall(self, message_to_send):
         """Тестовая функция отправки, корректно кодирует сообщение,
         так-же сохранет то, что должно быть отправлено в сокет.
         message_to_send - то, что отправляем в сокет"""
-        json_test_message = json.dumps(self.test_dict)
-        # кодирует сообщение
-        self.encoded_message = json_test_message.encode(ENCODING)
+        json_test_message = json.dumps(self.test_dict).encode(ENCODING)
+        # кодирует сообщение в кадр: длина и JSON
+        self.encoded_message = FRAME_HEADER.pack(len(json_test_message)) + \
+            json_test_message
         # сохраняем что должно было быть отправлено в сокет
         self.received_message = message_to_send
 
     def recv(self, max_len):
         """Получаем данные из сокета"""
-        json_test_message = json.dumps(self.test_dict)
-        return json_test_message.encode(ENCODING)
+        json_test_message = json.dumps(self.test_dict).encode(ENCODING)
+        return FRAME_HEADER.pack(len(json_test_message)) + json_test_message
+
+
+class ChunkSocket:
+    """Тестовый сокет, отдающий заранее заданные куски байтов"""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, max_len):
+        return self.chunks.pop(0) if self.chunks else b''
 
 
 class TestUtils(unittest.TestCase):
@@ -91,5 +102,47 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(get_message(test_sock_err), self.test_dict_recv_err)
 
 
+class TestFrameDecoder(unittest.TestCase):
+    """Тесты потокового декодера кадров"""
+
+    def test_coalesced_messages(self):
+        """Два сообщения в одном сегменте TCP"""
+        data = encode_message({RESPONSE: 200}) + encode_message({RESPONSE: 205})
+        self.assertEqual(FrameDecoder().feed(data),
+                         [{RESPONSE: 200}, {RESPONSE: 205}])
+
+    def test_split_message(self):
+        """Сообщение, пришедшее частями"""
+        data = encode_message({RESPONSE: 200})
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(data[:2]), [])
+        self.assertEqual(decoder.feed(data[2:7]), [])
+        self.assertEqual(decoder.feed(data[7:]), [{RESPONSE: 200}])
+
+    def test_large_message(self):
+        """Сообщение больше размера одного чтения из сокета"""
+        message = {ERROR: 'x' * 200000}
+        data = encode_message(message)
+        chunks = [data[i:i + 1024] for i in range(0, len(data), 1024)]
+        self.assertEqual(get_message(ChunkSocket(chunks)), message)
+
+    def test_get_message_keeps_rest(self):
+        """Лишние сообщения сохраняются до следующего вызова"""
+        sock = ChunkSocket([encode_message({RESPONSE: 200}) +
+                            encode_message({RESPONSE: 205})])
+        self.assertEqual(get_message(sock), {RESPONSE: 200})
+        self.assertEqual(get_message(sock), {RESPONSE: 205})
+
+    def test_get_messages_closed(self):
+        """Закрытое соединение - исключение OSError"""
+        self.assertRaises(OSError, get_messages, ChunkSocket([]))
+
+    def test_not_dict(self):
+        """В кадре не словарь"""
+        payload = json.dumps([1, 2]).encode(ENCODING)
+        self.assertRaises(ValueError, FrameDecoder().feed,
+                          FRAME_HEADER.pack(len(payload)) + payload)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,108 @@
+import sys
+import os
+import shutil
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+from database.server_db import ServerStorage
+
+
+def wait_for(condition, timeout=3):
+    """Ожидание условия, выполняемого потоком записи"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestWriteBehind(unittest.TestCase):
+    """Тесты отложенной записи статистики и истории входов"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'server.db3')
+        self.storage = None
+
+    def tearDown(self):
+        if self.storage is not None:
+            self.storage.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, interval, size=1000):
+        self.storage = ServerStorage(self.path, flush_interval=interval,
+                                     flush_size=size)
+        self.storage.add_users([('alice', b'hash'), ('bob', b'hash')])
+        return self.storage
+
+    def sent(self, name):
+        """Число отправленных сообщений пользователя в БД"""
+        return {login: sent for login, _, sent, _ in
+                self.storage.message_history()}[name]
+
+    def test_flush_on_size(self):
+        """Запись при накоплении заданного числа событий"""
+        storage = self.open(60, size=3)
+        storage.process_message('alice', 'bob')
+        storage.process_message('alice', 'bob')
+        time.sleep(0.2)
+        self.assertEqual(self.sent('alice'), 0)
+        storage.process_message('alice', 'bob')
+        self.assertTrue(wait_for(lambda: self.sent('alice') == 3))
+
+    def test_flush_on_timer(self):
+        """Запись по истечении интервала"""
+        storage = self.open(0.1)
+        storage.process_message('alice', 'bob')
+        storage.user_login('alice', '127.0.0.1', 7777, 'key')
+        self.assertTrue(wait_for(lambda: self.sent('alice') == 1))
+        self.assertEqual([row[0] for row in storage.active_users_list()],
+                         ['alice'])
+
+    def test_flush_on_close(self):
+        """Накопленное записывается при остановке"""
+        storage = self.open(60)
+        storage.process_message('alice', 'bob')
+        storage.user_login('bob', '127.0.0.1', 7777, 'key')
+        self.assertEqual(self.sent('alice'), 0)
+        self.assertEqual(storage.login_history(), [])
+        storage.close()
+        self.assertEqual(self.sent('alice'), 1)
+        self.assertEqual(len(storage.login_history('bob')), 1)
+
+    def test_events_order(self):
+        """События одной записи применяются в порядке поступления"""
+        storage = self.open(60)
+        storage.user_login('alice', '127.0.0.1', 7777, 'key')
+        storage.user_logout('alice')
+        storage.user_login('bob', '127.0.0.1', 7778, 'key')
+        storage.user_logout('bob')
+        storage.user_login('bob', '127.0.0.1', 7779, 'key')
+        storage.flush()
+        self.assertEqual([row[:3] for row in storage.active_users_list()],
+                         [('bob', '127.0.0.1', 7779)])
+        self.assertEqual(len(storage.login_history('bob')), 2)
+
+    def test_read_after_flush(self):
+        """Чтение после flush видит всё, что записано до него, а
+        удаление пользователя сначала записывает его события"""
+        storage = self.open(60)
+        for _ in range(5):
+            storage.process_message('alice', 'bob')
+        storage.user_login('bob', '127.0.0.1', 7777, 'key')
+        storage.flush()
+        self.assertEqual(self.sent('alice'), 5)
+        self.assertEqual(len(storage.active_users_list()), 1)
+
+        storage.process_message('alice', 'bob')
+        storage.user_logout('bob')
+        storage.remove_user('bob')
+        self.assertEqual(self.sent('alice'), 6)
+        self.assertEqual(storage.active_users_list(), [])
+        self.assertEqual(storage.login_history('bob'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()